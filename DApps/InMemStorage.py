@@ -2,15 +2,18 @@
 
 
 import typing
+import os
+import pathlib
 
 import fastapi
+import fastapi.responses
 import fastapi.security
 from utils.pydantic_utils import DDHbaseModel
 from core import (common_ids, dapp_attrs, keys, nodes, principals, users,
                   schemas, transactions, errors, versions)
 
 from schema_formats import py_schema
-from backend import storage
+from backend import storage, log_storage
 from frontend import fastapi_dapp, fastapi_transactionable, sessions, user_auth
 app = fastapi.FastAPI(lifespan=fastapi_dapp.lifespan)  # TODO: Workaround #41
 app.include_router(fastapi_dapp.router)
@@ -23,6 +26,10 @@ def get_apps() -> tuple[dapp_attrs.DApp]:
 
 fastapi_dapp.get_apps = get_apps
 
+if storage_dir := os.environ.get('DDH_STORAGE_DIR'):  # durable, log-structured storage instead of memory
+    storage.Storage = log_storage.LogStorageClass(directory=pathlib.Path(storage_dir))
+    storage.Storage.start_compaction()
+
 
 class _missing_class(DDHbaseModel): pass  # marker class
 
@@ -31,35 +38,60 @@ _missing = _missing_class()
 
 
 class WriteAction(transactions.Action):
-    key: common_ids.PersistId
-    data: bytes | _missing_class
+    """ Writes of a transaction; all writes of a transaction are coalesced into one WriteAction,
+        so they are committed to storage together (in one group commit for durable storage).
+    """
+    writes: dict[common_ids.PersistId, bytes | _missing_class]
 
     def added(self, transaction: transactions.Transaction):
         """ Callback after transaction is added """
-        transaction.trx_local[self.key] = self.data
+        transaction.trx_local.update(self.writes)
         return
 
+    def coalesce_key(self):
+        """ one WriteAction per transaction """
+        return WriteAction
+
+    def coalesce(self, previous: transactions.Action) -> WriteAction:
+        """ only the last write of a key is applied to storage """
+        assert isinstance(previous, WriteAction)
+        return WriteAction(writes=previous.writes | self.writes)
+
     async def commit(self, transaction):
         """ commit an action, called by transaction.commit() """
-
-        if self.data is _missing:
-            storage.Storage.delete(self.key, transaction)
-        else:
-            assert isinstance(self.data, bytes)
-            storage.Storage.store(self.key, self.data, transaction)
+        await storage.Storage.commit_writes({key: None if data is _missing else data for key, data in self.writes.items()}, transaction)
+        return
 
     async def rollback(self, transaction):
         """ rollback an action, called by transaction.rollback() """
-        transaction.trx_local.pop(self.key)
+        for key in self.writes:
+            transaction.trx_local.pop(key, None)
         return
 
 
-@app.get("/storage/{key}")
+StreamChunkSize = 2**20  # blobs larger than this are streamed in chunks of this size
+
+
+def blob_response(data: bytes) -> fastapi.Response:
+    """ raw octet-stream response, streamed without copying for large blobs """
+    if len(data) <= StreamChunkSize:
+        return fastapi.Response(content=data, media_type='application/octet-stream')
+    view = memoryview(data)
+    return fastapi.responses.StreamingResponse((view[i:i+StreamChunkSize] for i in range(0, len(view), StreamChunkSize)),
+                                               media_type='application/octet-stream', headers={'Content-Length': str(len(data))})
+
+
+@app.get("/storage/{key}", response_class=fastapi.Response)
 async def load(
     key: common_ids.PersistId,
     session: sessions.Session = fastapi.Depends(user_auth.get_current_session),
-    trxid: common_ids.TrxId = fastapi.Query(),
-) -> bytes:
+    trxid: common_ids.TrxId | None = fastapi.Query(default=None),
+) -> fastapi.Response:
+    if trxid is None:  # read-only, committed data without transaction state
+        try:
+            return blob_response(storage.Storage.load(key, None))
+        except KeyError:
+            raise errors.NotFound(f'{key=} not found').to_http()
     trx = transactions.Transaction.get_or_create_transaction_with_id(trxid=trxid, owner=session.user)
     data = trx.trx_local.get(key, _missing)
     if data is _missing:
@@ -71,18 +103,19 @@ async def load(
         trx.trx_local[key] = data  # found, cache it in trx
     else:
         assert isinstance(data, bytes)
-    return data
+    return blob_response(data)
 
 
 @app.put("/storage/{key}")
 async def store(
     key: common_ids.PersistId,
+    request: fastapi.Request,
     session: sessions.Session = fastapi.Depends(user_auth.get_current_session),
     trxid: common_ids.TrxId = fastapi.Query(),
-    data: bytes = fastapi.Body(..., media_type='data/binary')
 ):
+    """ store the raw request body """
     trx = transactions.Transaction.get_or_create_transaction_with_id(trxid=trxid, owner=session.user)
-    trx.add(WriteAction(key=key, data=data))
+    trx.add(WriteAction(writes={key: await request.body()}))
     return
 
 
@@ -96,7 +129,41 @@ async def delete(
 ):
     trx = transactions.Transaction.get_or_create_transaction_with_id(trxid=trxid, owner=session.user)
     # print(f'storage.delete {key=}, {trx.trxid=}, ')
-    trx.add(WriteAction(key=key, data=_missing))
+    trx.add(WriteAction(writes={key: _missing}))
+    return
+
+
+@app.post("/storage-batch/load")
+async def load_many(
+    keys: list[common_ids.PersistId],
+    session: sessions.Session = fastapi.Depends(user_auth.get_current_session),
+    trxid: common_ids.TrxId | None = fastapi.Query(default=None),
+) -> fastapi.Response:
+    """ load keys in one request; response is framed by storage.pack_blobs(), missing keys have no blob """
+    trx = None if trxid is None else transactions.Transaction.get_or_create_transaction_with_id(
+        trxid=trxid, owner=session.user)
+    found: dict[common_ids.PersistId, bytes | None] = {}
+    for key in keys:
+        data = _missing if trx is None else trx.trx_local.get(key, _missing)
+        if data is _missing and (trx is None or key not in trx.trx_local):
+            data = storage.Storage.load(key, trx) if key in storage.Storage else _missing
+            if trx:
+                trx.trx_local[key] = data  # trx acts as cache
+        found[key] = None if data is _missing else typing.cast(bytes, data)
+    return blob_response(storage.pack_blobs(found.items()))
+
+
+@app.post("/storage-batch/write")
+async def store_many(
+    request: fastapi.Request,
+    session: sessions.Session = fastapi.Depends(user_auth.get_current_session),
+    trxid: common_ids.TrxId = fastapi.Query(),
+):
+    """ store and delete keys in one request; body is framed by storage.pack_blobs(), keys without blob are deleted """
+    trx = transactions.Transaction.get_or_create_transaction_with_id(trxid=trxid, owner=session.user)
+    writes = {key: _missing if data is None else data for key, data in storage.unpack_blobs(await request.body())}
+    if writes:
+        trx.add(WriteAction(writes=writes))
     return
 
 
@@ -109,7 +176,7 @@ async def purge_all(
         TODO: This should be testing user only. Introduce a tester privilege? 
     """
     if confirm:
-        storage.Storage.byId.clear()
+        storage.Storage.clear()
     return
 
 
@@ -139,7 +206,6 @@ IN_MEM_STORAGE_DAPP = InMemStorageDApp(name='InMemStorageDApp', owner=users.Syst
 
 if __name__ == "__main__":  # Debugging
     import uvicorn
-    import os
     port = 9051
     os.environ['port'] = str(port)
     uvicorn.run(app, host="0.0.0.0", port=port)
@@ -14,6 +14,7 @@ class AuditRecord(persistable.Persistable):
         TODO: Subset of access, not all of it!
     """
 
+    BinaryEnvelope: typing.ClassVar[bool] = True
     access: permissions.Access
 
     @classmethod
@@ -0,0 +1,49 @@
+""" Executor for encryption and compression of large payloads, keeping them off the event loop.
+
+    Payloads below .threshold are processed inline, as handing them to another thread costs more than it saves.
+    Larger ones run in a thread pool; AES, HMAC and zstd release the GIL, so they run in parallel with the loop.
+    Optionally, functions that don't depend on state of this process (pure=True, e.g. zstd compression
+    without dictionary) run in a process pool.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import typing
+
+T = typing.TypeVar('T')
+
+
+class CryptoExecutorClass:
+
+    Threshold: typing.ClassVar[int] = 64 * 2**10  # bytes, smaller payloads are processed inline
+
+    def __init__(self, threshold: int | None = None, max_workers: int | None = None, processes: int = 0):
+        self.threshold = threshold if threshold is not None else self.Threshold
+        self.threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or min(4, os.cpu_count() or 1), thread_name_prefix='crypto')
+        self.processes = concurrent.futures.ProcessPoolExecutor(max_workers=processes) if processes else None
+        self.inline = self.offloaded = 0
+
+    async def run(self, size: int, func: typing.Callable[..., T], *args, pure: bool = False) -> T:
+        """ run func(*args) on a payload of size bytes """
+        if size < self.threshold:
+            self.inline += 1
+            return func(*args)
+        self.offloaded += 1
+        executor = self.processes if pure and self.processes else self.threads
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+    async def map(self, func: typing.Callable[..., T], args: list[tuple], sizes: list[int], pure: bool = False) -> list[T]:
+        """ run func for each tuple in args, with the payload sizes in sizes; large payloads run concurrently """
+        return list(await asyncio.gather(*(self.run(size, func, *a, pure=pure) for a, size in zip(args, sizes))))
+
+    def shutdown(self):
+        self.threads.shutdown()
+        if self.processes:
+            self.processes.shutdown()
+        return
+
+
+CryptoExecutor = CryptoExecutorClass()
@@ -0,0 +1,94 @@
+""" Versioned binary envelope for Persistables.
+
+    The envelope separates the metadata of a Persistable from its large payload fields (Persistable.LazyFields),
+    so that metadata such as owner, consents and sub_nodes decode without touching the payload. Lazy fields
+    are kept as raw JSON after decoding, and are only decoded on first access; an unchanged lazy field is
+    written back without re-encoding.
+
+    Layout: header (Magic, Version, number of lazy sections), metadata JSON with length, then per lazy field
+    its name and its JSON with lengths.
+"""
+
+import struct
+import typing
+
+import pydantic
+import pydantic_core
+
+Magic = b'\xddE'  # JSON never starts with this
+Version = 1
+
+_Header = struct.Struct('<2sBB')  # magic, version, number of lazy sections
+_Length = struct.Struct('<I')
+_NameLength = struct.Struct('<B')
+
+
+class EnvelopeError(ValueError): ...
+
+
+def is_envelope(plain: bytes) -> bool:
+    return plain[:2] == Magic
+
+
+def pack(obj) -> bytes:
+    """ pack Persistable obj; lazy fields not decoded since unpacking are copied as they are """
+    lazy = obj.LazyFields
+    meta = obj.to_json(exclude=lazy).encode() if lazy else obj.to_json().encode()
+    parts = [_Header.pack(Magic, Version, len(lazy)), _Length.pack(len(meta)), meta]
+    raw = obj.__pydantic_private__.get('_lazy_raw') or {}
+    for name in sorted(lazy):
+        j = raw[name] if name not in obj.__dict__ else pydantic_core.to_json(obj.__dict__[name])
+        bname = name.encode()
+        parts += [_NameLength.pack(len(bname)), bname, _Length.pack(len(j)), j]
+    return b''.join(parts)
+
+
+def unpack(cls: type, plain: bytes):
+    """ unpack into Persistable cls; lazy fields remain undecoded until they are accessed """
+    view = memoryview(plain)
+    magic, version, n = _Header.unpack_from(view)
+    if magic != Magic or version != Version:
+        raise EnvelopeError(f'Unsupported envelope {magic=}, {version=}')
+    offset = _Header.size
+    l, = _Length.unpack_from(view, offset)
+    offset += _Length.size
+    obj = cls.from_json(str(view[offset:offset+l], 'utf-8'))
+    offset += l
+    raw = {}
+    for i in range(n):
+        l, = _NameLength.unpack_from(view, offset)
+        name = str(view[offset+1:offset+1+l], 'utf-8')
+        offset += 1 + l
+        l, = _Length.unpack_from(view, offset)
+        offset += _Length.size
+        raw[name] = bytes(view[offset:offset+l])
+        offset += l
+    for name in raw.keys() & cls.LazyFields:
+        obj.__dict__.pop(name, None)  # attribute access decodes, see decode_lazy()
+    obj._lazy_raw = raw
+    return obj
+
+
+_adapters: dict[tuple[type, str], pydantic.TypeAdapter] = {}
+
+
+def decode_lazy(obj, name: str) -> typing.Any:
+    """ decode lazy field name of obj and set it as attribute """
+    cls = obj.__class__
+    adapter = _adapters.get((cls, name))
+    if adapter is None:
+        adapter = _adapters[(cls, name)] = pydantic.TypeAdapter(cls.model_fields[name].annotation)
+    value = adapter.validate_json(obj._lazy_raw[name])
+    set_decoded(obj, name, value)
+    return value
+
+
+def set_decoded(obj, name: str, value: typing.Any):
+    """ set lazy field name of obj to value, replacing its undecoded form """
+    cls = obj.__class__
+    fields = obj.__dict__
+    fields[name] = value
+    if len(fields) == len(cls.model_fields):  # all decoded, restore field order for serialization
+        object.__setattr__(obj, '__dict__', {n: fields[n] for n in cls.model_fields})
+    obj._lazy_raw = {n: r for n, r in obj._lazy_raw.items() if n != name}  # may be shared with copies of obj
+    return
@@ -7,10 +7,18 @@
 import logging
 import typing
 import hashlib
+import collections
+import enum
+import os
+import threading
+import time
+import cryptography.exceptions
 import cryptography.fernet
 
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, x25519
+from cryptography.hazmat.primitives.ciphers import aead
+from cryptography.hazmat.primitives.kdf import hkdf
 import base64
 from core import common_ids, errors
 
@@ -19,41 +27,373 @@ logger = logging.getLogger(__file__)
 
 from core import keys, permissions, node_types, principals
 from utils.pydantic_utils import DDHbaseModel
+from utils import utils
+
+
+class ZeroizedKeyError(Exception):
+    """ StorageKey was zeroized while in use by another thread """
+
+
+@enum.unique
+class CipherFormat(enum.IntEnum):
+    """ First byte of an encrypted blob. A binary blob is the format byte, the nonce and the AEAD ciphertext
+        including its tag; the node id is authenticated as associated data.
+        Fernet tokens, as written before, are base64 and start with b'g'.
+    """
+    aes_gcm = 1
+    chacha20_poly1305 = 2
+
+
+_Ciphers = {CipherFormat.aes_gcm: aead.AESGCM, CipherFormat.chacha20_poly1305: aead.ChaCha20Poly1305}
+_NonceSize = 12
+
+
+def is_fernet(ciphertext: bytes) -> bool:
+    """ blob in legacy Fernet format, to be re-encrypted when written """
+    return ciphertext[:1] not in (b'\x01', b'\x02')
 
 
 class StorageKey:
     """ Ephemeral storage key, never stored """
 
+    Format: typing.ClassVar[CipherFormat] = CipherFormat.aes_gcm  # format of new blobs
+
     def __init__(self, key: bytes):
         try:
             self._fernet = cryptography.fernet.Fernet(key)
         except Exception as e:
             print(e, key)
-            self._fernet = cryptography.fernet.Fernet(base64.urlsafe_b64encode(key))
+            key = base64.urlsafe_b64encode(key)
+            self._fernet = cryptography.fernet.Fernet(key)
+        self._key = bytearray(key)  # mutable, so .zeroize() can overwrite it
+        # AEAD key is derived, so it's independent of the Fernet keys:
+        self._aead_key = bytearray(hkdf.HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'DDH storage AEAD').derive(
+            base64.urlsafe_b64decode(key)))
+        self._ciphers: dict[CipherFormat, typing.Any] = {}
 
     def __repr__(self):
         return f'{self.__class__.__name__}(signing={self._fernet._signing_key}, encryption={self._fernet._encryption_key})'
 
-    def encrypt(self, plaintext: bytes) -> bytes:
-        ciphertext = self._fernet.encrypt(plaintext)
-        return ciphertext
+    def _cipher(self, format: CipherFormat):
+        if (cipher := self._ciphers.get(format)) is None:
+            ciphers = self._ciphers  # .zeroize() replaces it, so a late cipher isn't cached
+            if self._fernet is None:
+                raise ZeroizedKeyError()
+            cipher = _Ciphers[format](bytes(self._aead_key))
+            if self._fernet is None:  # zeroized meanwhile, the key copied may already be overwritten
+                raise ZeroizedKeyError()
+            ciphers[format] = cipher
+        return cipher
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes | None = None) -> bytes:
+        nonce = os.urandom(_NonceSize)
+        return bytes((self.Format,)) + nonce + self._cipher(self.Format).encrypt(nonce, plaintext, associated_data)
+
+    def decrypt(self, ciphertext: bytes, associated_data: bytes | None = None) -> bytes:
+        if is_fernet(ciphertext):
+            return self._decrypt_fernet(ciphertext)
+        view = memoryview(ciphertext)
+        try:
+            plaintext = self._cipher(CipherFormat(ciphertext[0])).decrypt(
+                view[1:1+_NonceSize], view[1+_NonceSize:], associated_data)
+        except cryptography.exceptions.InvalidTag as e:
+            raise errors.DecryptionError(f'Error accessing storage: {e!r}')
+        return plaintext
 
-    def decrypt(self, ciphertext: bytes) -> bytes:
+    def _decrypt_fernet(self, ciphertext: bytes) -> bytes:
+        if (fernet := self._fernet) is None:
+            raise ZeroizedKeyError()
         try:
-            plaintext = self._fernet.decrypt(ciphertext)
+            plaintext = fernet.decrypt(ciphertext)
         except cryptography.fernet.InvalidToken as e:
             raise errors.DecryptionError(f'Error accessing storage: {e!r}: {e.__context__}')
         return plaintext
 
+    def encrypt_fernet(self, plaintext: bytes) -> bytes:
+        """ encrypt in legacy Fernet format, for comparisons and tests only """
+        if (fernet := self._fernet) is None:
+            raise ZeroizedKeyError()
+        return fernet.encrypt(plaintext)
+
+    def zeroize(self):
+        """ overwrite our copies of the keys and drop the ciphers. Best effort only, as the ciphers'
+            immutable copies can only be released, not overwritten.
+        """
+        self._fernet = None  # type:ignore
+        self._ciphers = {}  # first, so ._cipher() cannot use the overwritten keys
+        self._key[:] = bytes(len(self._key))
+        self._aead_key[:] = bytes(len(self._aead_key))
+        return
+
+
+class StorageKeyCacheClass:
+    """ Bounded cache of unwrapped StorageKeys by nodeid and principal.id, avoiding a private key
+        decryption per encrypt_data() and decrypt_data(). Holds the keys of at most .max_entries nodes.
+        Entries expire after .ttl seconds and are zeroized when they leave the cache.
+    """
+
+    MaxEntries: typing.ClassVar[int] = 1000
+    TTL: typing.ClassVar[float] = 60.0
+
+    def __init__(self, max_entries: int | None = None, ttl: float | None = None, enabled: bool = True):
+        self.max_entries = max_entries or self.MaxEntries
+        self.ttl = ttl or self.TTL
+        self.enabled = enabled
+        self.keys: utils.LRUCache[dict[common_ids.PrincipalId, tuple[StorageKey, float]]] = utils.LRUCache(
+            self.max_entries, on_evict=self._zeroize)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, principal_id: common_ids.PrincipalId, nodeid: str) -> StorageKey | None:
+        with self.lock:
+            entry = self.keys.get(nodeid, {}).get(principal_id)
+            if entry is not None:
+                s_key, expires = entry
+                if expires > time.monotonic():
+                    self.hits += 1
+                    return s_key
+                self._evict(nodeid, principal_id)
+            self.misses += 1
+            return None
+
+    def put(self, principal_id: common_ids.PrincipalId, nodeid: str, s_key: StorageKey):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._evict(nodeid, principal_id)
+            self.keys.put(nodeid, self.keys.peek(nodeid, {}) | {principal_id: (s_key, time.monotonic() + self.ttl)})
+        return
+
+    def _evict(self, nodeid: str, principal_id: common_ids.PrincipalId | None = None):
+        """ remove and zeroize keys of nodeid, for principal_id or for all principals """
+        principals = self.keys.peek(nodeid)
+        if principals is None:
+            return
+        if principal_id is None:
+            self._zeroize(nodeid, self.keys.pop(nodeid))
+        elif (entry := principals.pop(principal_id, None)) is not None:
+            entry[0].zeroize()
+            if not principals:
+                self.keys.pop(nodeid)
+        return
+
+    @staticmethod
+    def _zeroize(nodeid: str, principals: dict[common_ids.PrincipalId, tuple[StorageKey, float]]):
+        for s_key, expires in principals.values():
+            s_key.zeroize()
+        return
+
+    def invalidate(self, nodeid: str, principal_id: common_ids.PrincipalId | None = None):
+        """ evict keys of nodeid, for principal_id or for all principals """
+        with self.lock:
+            self._evict(nodeid, principal_id)
+        return
+
+    def clear(self):
+        with self.lock:
+            for nodeid, principals in self.keys.entries.items():
+                self._zeroize(nodeid, principals)
+            self.keys.clear()
+            self.hits = self.misses = 0
+        return
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / ((self.hits + self.misses) or 1)
+
+    def stats(self) -> dict:
+        return {'entries': len(self.keys), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+
+StorageKeyCache = StorageKeyCacheClass()
+
+
+class KeyWrap:
+    """ Algorithm to wrap (encrypt) keys with the public key of a principal; subclasses register by .id """
+
+    id: typing.ClassVar[str]
+    Registry: typing.ClassVar[dict[str, type['KeyWrap']]] = {}
+
+    def __init_subclass__(cls):
+        KeyWrap.Registry[cls.id] = cls
+
+    @classmethod
+    def generate(cls) -> typing.Any:
+        """ generate private key """
+        raise NotImplementedError()
+
+    @classmethod
+    def wrap(cls, private_key, plaintext: bytes) -> bytes:
+        """ encrypt with the public key of private_key """
+        raise NotImplementedError()
+
+    @classmethod
+    def unwrap(cls, private_key, ciphertext: bytes) -> bytes:
+        raise NotImplementedError()
+
+
+class RsaOaepWrap(KeyWrap):
+    """ RSA-2048 with OAEP-SHA256. Key generation is slow, so keys are taken from the KeypairPool. """
+
+    id = 'RSA-OAEP-256'
+    KeySize: typing.ClassVar[int] = 2048
+
+    Padding: typing.ClassVar[typing.Any] = padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+    @classmethod
+    def generate(cls) -> rsa.RSAPrivateKey:
+        return KeypairPool.take()
+
+    @classmethod
+    def wrap(cls, private_key, plaintext: bytes) -> bytes:
+        return private_key.public_key().encrypt(plaintext, cls.Padding)
+
+    @classmethod
+    def unwrap(cls, private_key, ciphertext: bytes) -> bytes:
+        return private_key.decrypt(ciphertext, cls.Padding)
+
+
+class X25519SealedBox(KeyWrap):
+    """ Sealed box: ephemeral X25519 key agreement, HKDF-SHA256 and AES-GCM. The wrapped key is
+        the ephemeral public key followed by the AEAD ciphertext. As the AEAD key is used once,
+        the nonce is constant.
+    """
+
+    id = 'X25519-HKDF-SHA256-AESGCM'
+    _Nonce: typing.ClassVar[bytes] = bytes(12)
+
+    @classmethod
+    def generate(cls) -> x25519.X25519PrivateKey:
+        return x25519.X25519PrivateKey.generate()
+
+    @staticmethod
+    def _aead(shared: bytes, ephemeral: bytes, recipient: bytes) -> aead.AESGCM:
+        return aead.AESGCM(hkdf.HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                                     info=b'DDH key wrap' + ephemeral + recipient).derive(shared))
+
+    @classmethod
+    def wrap(cls, private_key, plaintext: bytes) -> bytes:
+        recipient = private_key.public_key()
+        ephemeral = x25519.X25519PrivateKey.generate()
+        e_pub = ephemeral.public_key().public_bytes_raw()
+        cipher = cls._aead(ephemeral.exchange(recipient), e_pub, recipient.public_bytes_raw())
+        return e_pub + cipher.encrypt(cls._Nonce, plaintext, None)
+
+    @classmethod
+    def unwrap(cls, private_key, ciphertext: bytes) -> bytes:
+        e_pub, ct = ciphertext[:32], ciphertext[32:]
+        cipher = cls._aead(private_key.exchange(x25519.X25519PublicKey.from_public_bytes(e_pub)),
+                           e_pub, private_key.public_key().public_bytes_raw())
+        return cipher.decrypt(cls._Nonce, ct, None)
+
 
 class AccessKey(DDHbaseModel):
     """ StorageKey for a Node encrypted by the Principal's public key.
         To access the Node, it needs to be decrypted by the Principal's private key, which is stored 
         only in the PrincipalKey.
+        If group is set, key is the GroupKey of this group instead, which in turn encrypts the StorageKey.
     """
     nodeid: str
     principal: principals.Principal
     key: bytes
+    algorithm: str = RsaOaepWrap.id  # KeyWrap.id of key, keys written before are RSA
+    group: int | None = None
+
+
+class GroupKey(DDHbaseModel):
+    """ Key-encryption key of a group of the principals accessing a node. It encrypts the node's
+        StorageKey, and is encrypted for each member (AccessKey.group) and by the node's master key,
+        which only the node owners hold.
+    """
+    nodeid: str
+    group: int
+    members: set[common_ids.PrincipalId] = set()
+    storage_key: bytes  # StorageKey encrypted by this key
+    key: bytes  # this key encrypted by the master key
+
+
+class GroupKeyVaultClass(DDHbaseModel):
+    """ Key hierarchy per node: master key -> GroupKeys -> StorageKey. Principals are assigned to
+        one of .KeyGroups groups by a hash of their id. Adding a principal wraps its GroupKey once;
+        removing one rotates the StorageKey, but wraps only the GroupKey of its group for the remaining members.
+    """
+    KeyGroups: typing.ClassVar[int] = 16  # 0 wraps the StorageKey directly for each principal
+    group_keys: dict[str, dict[int, GroupKey]] = {}  # by nodeid, group
+    master_keys: dict[str, dict[common_ids.PrincipalId, bytes]] = {}  # master key encrypted for owner, by nodeid
+
+    def clear_vault(self):
+        self.group_keys.clear()
+        self.master_keys.clear()
+
+    @classmethod
+    def group_of(cls, principal: principals.Principal) -> int:
+        return int.from_bytes(hashlib.blake2b(principal.id.encode(), digest_size=4).digest()) % cls.KeyGroups
+
+    def members(self, nodeid: str) -> set[principals.Principal]:
+        return {AccessKeyVault.access_keys[(p_id, nodeid)].principal
+                for gk in self.group_keys.get(nodeid, {}).values() for p_id in gk.members}
+
+    def get_master_key(self, nodeid: str, principal: principals.Principal) -> StorageKey | None:
+        """ master key of node, if principal is an owner """
+        cache_id = nodeid + '#master'
+        if (m_key := StorageKeyCache.get(principal.id, cache_id)) is None:
+            wrapped = self.master_keys.get(nodeid, {}).get(principal.id)
+            if wrapped is None or not (p_key := PrincipalKeyVault.key_for_principal(principal)):
+                return None
+            m_key = StorageKey(p_key.decrypt(wrapped))
+            StorageKeyCache.put(principal.id, cache_id, m_key)
+        return m_key
+
+    def set_keys(self, node: node_types.T_Node, transaction_owner: principals.Principal, members: set[principals.Principal],
+                 removed: set[principals.Principal], storage_key: bytes, keep: bool):
+        """ set GroupKeys of node for members, encrypting storage_key. GroupKeys without removed members are kept,
+            their StorageKey is re-encrypted unless keep is set (storage_key is unchanged).
+        """
+        m_key = self.get_master_key(node.id, transaction_owner)
+        if m_key is None:
+            if node.id in self.master_keys:  # only owners may change the keys of an existing node
+                raise errors.AccessError(f'{transaction_owner.id} is no owner of node {node.id} and cannot change its keys')
+            m_key = StorageKey(get_nonce())  # new node: new hierarchy, master key for the owners only
+            self.master_keys[node.id] = {owner.id: _ensure_principal_key(owner).encrypt(bytes(m_key._key))
+                                         for owner in node.owners}
+            StorageKeyCache.invalidate(node.id + '#master')
+            old = {}
+            groups = self.group_keys[node.id] = {}
+        else:
+            groups = self.group_keys[node.id]
+            old = dict(groups)
+        removed_ids = {p.id for p in removed}
+        by_group: dict[int, set[principals.Principal]] = {}
+        for p in members:
+            by_group.setdefault(self.group_of(p), set()).add(p)
+        for g in old.keys() - by_group.keys():
+            del groups[g]
+        aad = node.id.encode()
+        for g, ps in by_group.items():
+            gk = old.get(g)
+            if gk and not gk.members & removed_ids:  # keep group key, wrap it for new members only
+                g_key = StorageKey(m_key.decrypt(gk.key, aad))
+                new = {p for p in ps if p.id not in gk.members}
+                if not keep:
+                    gk.storage_key = g_key.encrypt(storage_key, aad)
+            else:
+                g_key = StorageKey(get_nonce())
+                new = ps
+                gk = groups[g] = GroupKey(
+                    nodeid=node.id, group=g, storage_key=g_key.encrypt(storage_key, aad), key=m_key.encrypt(bytes(g_key._key), aad))
+            for p in new:
+                p_key = _ensure_principal_key(p)
+                AccessKeyVault.add(AccessKey(nodeid=node.id, principal=p, key=p_key.encrypt(bytes(g_key._key)),
+                                             algorithm=p_key.algorithm, group=g))
+            gk.members = {p.id for p in ps}
+        return
+
+
+GroupKeyVault = GroupKeyVaultClass()
 
 
 class AccessKeyVaultClass(DDHbaseModel):
@@ -62,21 +402,31 @@ class AccessKeyVaultClass(DDHbaseModel):
 
     def clear_vault(self):
         self.access_keys.clear()
+        StorageKeyCache.clear()
 
     def add(self, key: AccessKey):
         self.access_keys[(key.principal.id, key.nodeid)] = key
+        StorageKeyCache.invalidate(key.nodeid, key.principal.id)
 
     def remove(self, principal: principals.Principal, nodeid: str):
         self.access_keys.pop((principal.id, nodeid), None)
+        StorageKeyCache.invalidate(nodeid, principal.id)
 
     def get_storage_key(self, principal: principals.Principal, nodeid: common_ids.PersistId) -> StorageKey:
+        if (s_key := StorageKeyCache.get(principal.id, nodeid)) is not None:
+            return s_key
         p_key = PrincipalKeyVault.key_for_principal(principal)
         if not p_key:
             raise KeyError(f'No key found for principal={principal}')
         else:
             a_key = self.access_keys[(principal.id, nodeid)]
             # s_key = StorageKey(_add_consent_hash(p_key.decrypt(a_key.key),node.consents))
-            s_key = StorageKey(p_key.decrypt(a_key.key))
+            key = p_key.decrypt(a_key.key, a_key.algorithm)
+            if a_key.group is not None:  # key is the GroupKey, which encrypts the StorageKey
+                gk = GroupKeyVault.group_keys[nodeid][a_key.group]
+                key = StorageKey(key).decrypt(gk.storage_key, nodeid.encode())
+            s_key = StorageKey(key)
+            StorageKeyCache.put(principal.id, nodeid, s_key)
         return s_key
 
 
@@ -84,36 +434,105 @@ AccessKeyVault = AccessKeyVaultClass()
 
 
 class PrincipalKey(DDHbaseModel):
-    """ Public/Private key for a principal """
+    """ Public/Private key for a principal, used with its wrap algorithm """
 
     principal: principals.Principal
     key: typing.Any  # the exact type is something deep in authlib.
-    key_params: typing.ClassVar[dict] = {'kty': 'RSA', 'crv_or_size': 2048,
-                                         'is_private': True}  # params to JsonWebKey.generate_key
+    algorithm: str = RsaOaepWrap.id  # KeyWrap.id
 
-    Padding: typing.ClassVar[typing.Any] = padding.OAEP(
-        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-        algorithm=hashes.SHA256(),
-        label=None
-    )
+    DefaultAlgorithm: typing.ClassVar[str] = RsaOaepWrap.id  # for new principals
 
     @classmethod
-    def _create(cls, principal):
-        """ Would like to be more generic with key generation here, but Padding needs to corrspond. 
-            Note: Keys must be created by PrincipalKeyVaultClass.create(), so this method is private.
+    def _create(cls, principal, algorithm: str | None = None):
+        """ Note: Keys must be created by PrincipalKeyVaultClass.create(), so this method is private.
         """
-        return cls(principal=principal, key=rsa.generate_private_key(public_exponent=65537, key_size=cls.key_params['crv_or_size'],))
+        algorithm = algorithm or cls.DefaultAlgorithm
+        return cls(principal=principal, key=KeyWrap.Registry[algorithm].generate(), algorithm=algorithm)
 
     def encrypt(self, plaintext: bytes) -> bytes:
         """ encrypt with public key """
-        public_key = self.key.public_key()
-        ciphertext = public_key.encrypt(plaintext, self.Padding)
-        return ciphertext
+        return KeyWrap.Registry[self.algorithm].wrap(self.key, plaintext)
 
-    def decrypt(self, ciphertext: bytes) -> bytes:
-        """ decryp with private key """
-        plaintext = self.key.decrypt(ciphertext, self.Padding)
-        return plaintext
+    def decrypt(self, ciphertext: bytes, algorithm: str | None = None) -> bytes:
+        """ decrypt with private key; algorithm of the ciphertext must be ours """
+        if algorithm and algorithm != self.algorithm:
+            raise KeyError(f'{algorithm} key cannot be unwrapped by {self.algorithm} key of {self.principal}')
+        return KeyWrap.Registry[self.algorithm].unwrap(self.key, ciphertext)
+
+
+class KeypairPoolClass:
+    """ Pool of pre-generated private keys, refilled by a background thread whenever it drops to
+        .low_water, so RSA key generation does not block requests. If the pool is empty, a key is
+        generated on the spot.
+    """
+
+    Size: typing.ClassVar[int] = 32
+    LowWater: typing.ClassVar[int] = 8
+
+    def __init__(self, generate: typing.Callable[[], typing.Any], size: int | None = None, low_water: int | None = None):
+        self.generate = generate
+        self.size = size or self.Size
+        self.low_water = low_water if low_water is not None else self.LowWater
+        self.keys: collections.deque = collections.deque()
+        self.refill_needed = threading.Condition()
+        self.worker: threading.Thread | None = None
+        self.stopping = False
+        self.taken = self.generated = self.misses = 0
+
+    def start(self):
+        """ start worker thread, which fills the pool """
+        with self.refill_needed:
+            if self.worker is None or not self.worker.is_alive():
+                self.stopping = False
+                self.worker = threading.Thread(target=self.run, name='KeypairPool', daemon=True)
+                self.worker.start()
+        return
+
+    def stop(self):
+        with self.refill_needed:
+            self.stopping = True
+            self.refill_needed.notify()
+        if self.worker:
+            self.worker.join()
+            self.worker = None
+        return
+
+    def run(self):
+        while True:
+            with self.refill_needed:
+                while not self.stopping and len(self.keys) > self.low_water:
+                    self.refill_needed.wait()
+                if self.stopping:
+                    return
+                missing = self.size - len(self.keys)
+            for i in range(missing):  # generate outside the lock, so take() doesn't wait
+                key = self.generate()
+                self.keys.append(key)
+                self.generated += 1
+                if self.stopping:
+                    return
+
+    def take(self):
+        """ return a pre-generated key, or generate one if the pool is empty """
+        if self.worker is None:
+            self.start()
+        self.taken += 1
+        try:
+            key = self.keys.popleft()
+        except IndexError:
+            self.misses += 1
+            key = self.generate()
+        if len(self.keys) <= self.low_water:
+            with self.refill_needed:
+                self.refill_needed.notify()
+        return key
+
+    def stats(self) -> dict:
+        return {'available': len(self.keys), 'taken': self.taken, 'generated': self.generated, 'misses': self.misses}
+
+
+KeypairPool = KeypairPoolClass(lambda: rsa.generate_private_key(
+    public_exponent=65537, key_size=RsaOaepWrap.KeySize))
 
 
 class PrincipalKeyVaultClass(DDHbaseModel):
@@ -126,10 +545,10 @@ class PrincipalKeyVaultClass(DDHbaseModel):
     def key_for_principal(self, principal: principals.Principal) -> PrincipalKey | None:
         return self.key_by_principal.get(principal.id)
 
-    def create(self, principal: principals.Principal) -> PrincipalKey:
-        """ create a user key, store and return it """
+    def create(self, principal: principals.Principal, algorithm: str | None = None) -> PrincipalKey:
+        """ create a user key using KeyWrap algorithm (default PrincipalKey.DefaultAlgorithm), store and return it """
         assert principal.id not in self.key_by_principal, 'cannot recreate user key'
-        key = PrincipalKey._create(principal=principal)
+        key = PrincipalKey._create(principal=principal, algorithm=algorithm)
         self.key_by_principal[principal.id] = key
         return key
 
@@ -152,38 +571,63 @@ def _add_consent_hash(key: bytes, consents: permissions.Consents):
     return key
 
 
+def _ensure_principal_key(principal: principals.Principal) -> PrincipalKey:
+    p_key = PrincipalKeyVault.key_for_principal(principal)
+    if not p_key:
+        p_key = PrincipalKeyVault.create(principal)
+    return p_key
+
+
 def set_new_storage_key(node: node_types.T_Node, transaction_owner: principals.Principal, effective: set[principals.Principal], removed: set[principals.Principal]):
     """ set storage key based on private key of transaction_owner and public keys of node.owner+consentees """
     # assert node.consents
 
     for p in removed:  # remove old entries
         AccessKeyVault.remove(principal=p, nodeid=node.id)
+    StorageKeyCache.invalidate(node.id)  # all principals get the new key
 
     storage_key = get_nonce()  # _add_consent_hash(get_nonce(),node.consents) # new storage key
 
-    for p in {transaction_owner} | effective:
-        p_key = PrincipalKeyVault.key_for_principal(p)
-        if not p_key:
-            p_key = PrincipalKeyVault.create(p)
-        p_storage_key = AccessKey(nodeid=node.id, principal=p, key=p_key.encrypt(storage_key))
-        AccessKeyVault.add(p_storage_key)
+    if GroupKeyVault.KeyGroups:
+        GroupKeyVault.set_keys(node, transaction_owner, {transaction_owner} | effective, removed, storage_key, keep=False)
+    else:
+        for p in {transaction_owner} | effective:
+            p_key = _ensure_principal_key(p)
+            p_storage_key = AccessKey(nodeid=node.id, principal=p, key=p_key.encrypt(storage_key), algorithm=p_key.algorithm)
+            AccessKeyVault.add(p_storage_key)
 
     return
 
 
+def grant_storage_key(node: node_types.T_Node, transaction_owner: principals.Principal, effective: set[principals.Principal]) -> bool:
+    """ give the principals in effective access to the unchanged storage key, if node has GroupKeys and
+        transaction_owner holds its master key. Return False if the storage key must be set by .set_new_storage_key().
+    """
+    if not GroupKeyVault.KeyGroups or GroupKeyVault.get_master_key(node.id, transaction_owner) is None:
+        return False
+    storage_key = AccessKeyVault.get_storage_key(transaction_owner, node.id)
+    members = {transaction_owner} | effective | GroupKeyVault.members(node.id)
+    GroupKeyVault.set_keys(node, transaction_owner, members, set(), bytes(storage_key._key), keep=True)
+    return True
+
+
 def encrypt_data(transaction_owner: principals.Principal, nodeid: common_ids.PersistId, data: bytes) -> bytes:
     """ Encrypt data going to storage for a node and accessing Principal """
-    storage_key = AccessKeyVault.get_storage_key(transaction_owner, nodeid)
     # logger.debug(f'Encrypting {transaction_owner.id=}, {nodeid=} using {storage_key=}')
-    cipherdata = storage_key.encrypt(data)
+    try:
+        cipherdata = AccessKeyVault.get_storage_key(transaction_owner, nodeid).encrypt(data, nodeid.encode())
+    except ZeroizedKeyError:  # evicted from StorageKeyCache by another thread, unwrap again
+        cipherdata = AccessKeyVault.get_storage_key(transaction_owner, nodeid).encrypt(data, nodeid.encode())
     return cipherdata
 
 
 def decrypt_data(transaction_owner: principals.Principal, nodeid: common_ids.PersistId, cipherdata: bytes) -> bytes:
     """ Decrypt data coming from storage for a node and accessing Principal """
-    storage_key = AccessKeyVault.get_storage_key(transaction_owner, nodeid)
     # logger.debug(f'Decrypting {transaction_owner.id=}, {nodeid=} using {storage_key=}')
-    data = storage_key.decrypt(cipherdata)
+    try:
+        data = AccessKeyVault.get_storage_key(transaction_owner, nodeid).decrypt(cipherdata, nodeid.encode())
+    except ZeroizedKeyError:  # evicted from StorageKeyCache by another thread, unwrap again
+        data = AccessKeyVault.get_storage_key(transaction_owner, nodeid).decrypt(cipherdata, nodeid.encode())
     return data
 
 
@@ -191,4 +635,5 @@ def clear_vaults():
     """ Clears the Vaults; useful to make tests independent of one another 
     """
     AccessKeyVault.clear_vault()
+    GroupKeyVault.clear_vault()
     PrincipalKeyVault.clear_vault()
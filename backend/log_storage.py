@@ -0,0 +1,385 @@
+""" Log-structured, durable storage engine with the interface of StorageClass.
+
+    Blocks are appended as records to segment files; an in-memory index maps ids to the location of their
+    latest block, and reads slice an mmap of the segment. Deletes append tombstones. When a sealed segment
+    contains more garbage than .garbage_ratio, compaction rewrites it with its live records only and
+    replaces it, or removes it if nothing is live.
+
+    A record is a header (crc32, kind, variant, length of id, length of blob) followed by id and blob;
+    the crc covers everything after itself. A record with a wrong crc ends a segment (torn write).
+"""
+
+import asyncio
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import typing
+import zlib
+import logging
+
+import pydantic
+from compression import zstd
+
+from core import transactions, common_ids
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+_Header = struct.Struct('<IBBHI')  # crc, kind, variant, length of id, length of blob
+_Put = 1
+_Tombstone = 2
+
+
+class Location(typing.NamedTuple):
+    """ location of a block """
+    segment: int
+    offset: int  # offset of blob
+    length: int  # length of blob
+    variant: storage.Variant
+    record_size: int
+
+
+class _Record(typing.NamedTuple):
+    offset: int
+    kind: int
+    variant: storage.Variant
+    id: common_ids.PersistId
+    location: Location
+
+
+class LogStorageClass(storage.StorageClass):
+    """ Durable storage in append-only segment files in directory """
+
+    directory: pathlib.Path
+    segment_size: int = 64 * 2**20  # active segment is sealed when it reaches this size
+    garbage_ratio: float = 0.5  # sealed segments with more garbage are compacted
+    max_batch_latency: float = 0.002  # seconds a group commit waits for further transactions
+    max_batch_size: int = 256  # max transactions per group commit
+
+    _index: dict[common_ids.PersistId, Location] = pydantic.PrivateAttr(default_factory=dict)
+    _sizes: dict[int, int] = pydantic.PrivateAttr(default_factory=dict)  # bytes per segment
+    _garbage: dict[int, int] = pydantic.PrivateAttr(default_factory=dict)  # bytes of garbage per segment
+    _maps: dict[int, mmap.mmap] = pydantic.PrivateAttr(default_factory=dict)
+    _active: int = pydantic.PrivateAttr(default=1)
+    _file: typing.BinaryIO | None = pydantic.PrivateAttr(default=None)
+    _lock: threading.RLock = pydantic.PrivateAttr(default_factory=threading.RLock)
+    _compacting: threading.Lock = pydantic.PrivateAttr(default_factory=threading.Lock)
+    _compactor: threading.Thread | None = pydantic.PrivateAttr(default=None)
+    _stop: threading.Event = pydantic.PrivateAttr(default_factory=threading.Event)
+    _pending: list[tuple[dict, asyncio.Future]] = pydantic.PrivateAttr(default_factory=list)
+    _committer: asyncio.Task | None = pydantic.PrivateAttr(default=None)
+    _batch_full: asyncio.Event | None = pydantic.PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._recover()
+        return
+
+    def _path(self, segment: int) -> pathlib.Path:
+        return self.directory / f'segment-{segment:06d}.log'
+
+    def _segments(self) -> list[int]:
+        return sorted(int(p.stem.removeprefix('segment-')) for p in self.directory.glob('segment-*.log'))
+
+    def _recover(self):
+        """ rebuild index by scanning all segments, cutting off a torn tail of the last one """
+        for path in self.directory.glob('segment-*.compacting'):  # interrupted compaction, original remains
+            path.unlink()
+        segments = self._segments()
+        for segment in segments:
+            end = 0
+            for record in self._records(segment):
+                self._apply(record)
+                end = record.offset + record.location.record_size
+            self._sizes[segment] = end
+            if self._path(segment).stat().st_size > end:
+                if segment == segments[-1]:
+                    logger.warning(f'{self._path(segment)}: cutting off torn tail at {end}')
+                    os.truncate(self._path(segment), end)
+                    self._maps.pop(segment, None)
+                else:
+                    logger.error(f'{self._path(segment)}: corrupt after {end}, remainder ignored')
+        self._open_active(segments[-1] if segments else 1)
+        return
+
+    def _apply(self, record: _Record):
+        """ apply record to index and garbage counts """
+        previous = self._index.pop(record.id, None)
+        if previous:
+            self._garbage[previous.segment] = self._garbage.get(previous.segment, 0) + previous.record_size
+        if record.kind == _Put:
+            self._index[record.id] = record.location
+        else:  # tombstones are garbage as soon as written, but must survive while older segments exist
+            self._garbage[record.location.segment] = self._garbage.get(
+                record.location.segment, 0) + record.location.record_size
+        return
+
+    def _open_active(self, segment: int):
+        if self._file:  # sealed segment must be durable, as later syncs only cover the active one
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._active = segment
+        self._file = open(self._path(segment), 'ab')
+        self._sizes.setdefault(segment, 0)
+        return
+
+    def _fsync_dir(self):
+        """ make creation and removal of segments durable """
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return
+
+    def _map(self, segment: int, needed: int = 0) -> mmap.mmap | None:
+        """ return mmap of segment covering at least needed bytes. Maps are never closed explicitly,
+            as views returned by .load_view() may still refer to them.
+        """
+        mm = self._maps.get(segment)
+        if mm is None or len(mm) < needed:
+            with open(self._path(segment), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                mm = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mm
+
+    def _records(self, segment: int) -> typing.Iterator[_Record]:
+        """ yield valid records of segment """
+        mm = self._map(segment)
+        if mm is None:
+            return
+        offset = 0
+        while offset + _Header.size <= len(mm):
+            crc, kind, variant, id_len, blob_len = _Header.unpack_from(mm, offset)
+            end = offset + _Header.size + id_len + blob_len
+            if end > len(mm) or kind not in (_Put, _Tombstone) or zlib.crc32(mm[offset+4:end]) != crc:
+                break
+            id_start = offset + _Header.size
+            id = typing.cast(common_ids.PersistId, str(mm[id_start:id_start+id_len], 'utf-8'))
+            yield _Record(offset, kind, storage.Variant(variant), id,
+                          Location(segment, id_start+id_len, blob_len, storage.Variant(variant), end-offset))
+            offset = end
+        return
+
+    @staticmethod
+    def _head(kind: int, id: common_ids.PersistId, variant: storage.Variant, blob: bytes | memoryview) -> bytes:
+        """ header and id of a record, to be followed by blob """
+        bid = id.encode()
+        header = struct.pack('<BBHI', kind, variant, len(bid), len(blob))
+        crc = zlib.crc32(blob, zlib.crc32(bid, zlib.crc32(header)))
+        return struct.pack('<I', crc) + header + bid
+
+    def _append(self, kind: int, id: common_ids.PersistId, variant: storage.Variant, blob: bytes | memoryview) -> _Record:
+        """ append record to active segment, sealing it if full """
+        assert self._file
+        head = self._head(kind, id, variant, blob)
+        offset = self._sizes[self._active]
+        self._file.write(head)
+        self._file.write(blob)
+        self._file.flush()
+        size = len(head) + len(blob)
+        record = _Record(offset, kind, variant, id,
+                         Location(self._active, offset + len(head), len(blob), variant, size))
+        self._sizes[self._active] = offset + size
+        self._apply(record)
+        if self._sizes[self._active] >= self.segment_size:
+            self._open_active(self._active+1)
+        return record
+
+    def __contains__(self, id: common_ids.PersistId) -> bool:
+        """ does id exist in storage? """
+        return id in self._index
+
+    def store(self, id: common_ids.PersistId, data: bytes, transaction: transactions.Transaction):
+        with self._lock:
+            self._append(_Put, id, storage.Variant.uncompressed, data)
+        return
+
+    def delete(self, id: common_ids.PersistId, transaction: transactions.Transaction):
+        """ delete from storage by appending a tombstone """
+        with self._lock:
+            if id in self._index:
+                self._append(_Tombstone, id, storage.Variant.uncompressed, b'')
+        return
+
+    async def commit_writes(self, writes: dict[common_ids.PersistId, bytes | None], transaction: transactions.Transaction):
+        """ Group commit: writes of concurrent transactions are queued, written together and fsync'd once
+            per batch. A batch is closed after max_batch_latency or when it has max_batch_size transactions.
+            Returns when the batch containing writes is durable.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((writes, future))
+        if self._committer is None or self._committer.done():
+            self._batch_full = asyncio.Event()
+            self._committer = asyncio.create_task(self._group_commit())
+        elif len(self._pending) >= self.max_batch_size:
+            assert self._batch_full
+            self._batch_full.set()
+        await future
+        return
+
+    async def _group_commit(self):
+        """ write batches while transactions are pending """
+        assert self._batch_full
+        while self._pending:
+            if len(self._pending) < self.max_batch_size:  # collect concurrent commits
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_batch_latency)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_full.clear()
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            try:
+                await asyncio.to_thread(self._write_batch, [writes for writes, future in batch])
+            except Exception as e:
+                for writes, future in batch:
+                    future.set_exception(e)
+            else:
+                for writes, future in batch:
+                    future.set_result(None)
+        return
+
+    def _write_batch(self, batch: list[dict[common_ids.PersistId, bytes | None]]):
+        """ append all writes of batch, then fsync once. The fsync runs outside the lock, so loads and
+            other writers are not blocked; it uses a duplicate descriptor, as the segment may be sealed meanwhile.
+        """
+        with self._lock:
+            for writes in batch:
+                for id, data in writes.items():
+                    if data is None:
+                        if id in self._index:
+                            self._append(_Tombstone, id, storage.Variant.uncompressed, b'')
+                    else:
+                        self._append(_Put, id, storage.Variant.uncompressed, data)
+            assert self._file
+            fd = os.dup(self._file.fileno())  # _append has flushed
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return
+
+    def load_view(self, id: common_ids.PersistId) -> tuple[memoryview, storage.Variant]:
+        """ zero-copy view of the stored blob and its variant """
+        with self._lock:
+            location = self._index.get(id)
+            if not location:
+                raise KeyError(id)
+            mm = self._map(location.segment, location.offset+location.length)
+            assert mm is not None
+            return memoryview(mm)[location.offset:location.offset+location.length], location.variant
+
+    def load(self, id: common_ids.PersistId, transaction: transactions.Transaction | None) -> bytes:
+        view, variant = self.load_view(id)
+        with view:
+            if variant == storage.Variant.uncompressed:
+                return bytes(view)
+            elif variant == storage.Variant.zstd:
+                return zstd.decompress(view)
+            else:
+                raise ValueError(f'Unknown storage variant {variant}')
+
+    def clear(self):
+        """ remove all segments """
+        with self._compacting, self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            for segment in self._segments():
+                self._path(segment).unlink()
+            self._index.clear(); self._sizes.clear(); self._garbage.clear(); self._maps.clear()
+            self._open_active(1)
+        return
+
+    def compact(self) -> int:
+        """ compact sealed segments with more garbage than .garbage_ratio, oldest first.
+            Returns number of segments compacted.
+        """
+        with self._compacting:
+            return sum(self._compact(segment) for segment in self._segments())
+
+    def _compact(self, segment: int) -> bool:
+        """ Rewrite segment with its live records into a new file replacing it, or remove it if nothing is live.
+            Tombstones are kept while older segments exist, as these may hold the deleted block.
+            The lock is held only to copy the live records and to swap the segments, so loads and writers
+            are not blocked by writing and fsyncs. Records stored meanwhile are newer than the copies.
+        """
+        with self._lock:
+            if segment == self._active or self._garbage.get(segment, 0) <= self.garbage_ratio * self._sizes.get(segment, 0):
+                return False
+            oldest = segment == min(self._sizes)
+            live = []
+            for record in self._records(segment):
+                if record.kind == _Put and self._index.get(record.id) == record.location:
+                    live.append((record, self._maps[segment][record.location.offset:record.location.offset+record.location.length]))
+                elif record.kind == _Tombstone and not oldest and record.id not in self._index:
+                    live.append((record, b''))
+            assert self._file
+            fd = os.dup(self._file.fileno())  # records superseding the garbage must be durable before it is gone
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        path = self._path(segment)
+        locations = []
+        if live:
+            with open(path.with_suffix('.compacting'), 'wb') as f:
+                offset = 0
+                for record, blob in live:
+                    head = self._head(record.kind, record.id, record.variant, blob)
+                    f.write(head)
+                    f.write(blob)
+                    locations.append(Location(segment, offset + len(head), len(blob), record.variant, len(head) + len(blob)))
+                    offset += len(head) + len(blob)
+                f.flush()
+                os.fsync(f.fileno())
+
+        with self._lock:
+            if live:
+                os.replace(path.with_suffix('.compacting'), path)
+            else:
+                path.unlink()
+            self._maps.pop(segment, None)  # views of the replaced segment keep their map
+            garbage = 0
+            for (record, blob), location in zip(live, locations):
+                if record.kind == _Put and self._index.get(record.id) == record.location:
+                    self._index[record.id] = location
+                else:  # tombstone, or stored again meanwhile
+                    garbage += location.record_size
+            if live:
+                self._sizes[segment] = sum(location.record_size for location in locations)
+                self._garbage[segment] = garbage
+            else:
+                self._sizes.pop(segment, None)
+                self._garbage.pop(segment, None)
+        self._fsync_dir()
+        return True
+
+    def start_compaction(self, interval: float = 60.0):
+        """ run .compact() every interval seconds in a background thread """
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.error(f'LogStorage compaction failed: {e}')
+        self._stop.clear()
+        self._compactor = threading.Thread(target=run, name='LogStorage compaction', daemon=True)
+        self._compactor.start()
+        return
+
+    def close(self):
+        self._stop.set()
+        if self._compactor:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        return
@@ -0,0 +1,126 @@
+""" Cache of decrypted Persistables, avoiding storage round trips, key unwrapping, decryption and decompression
+    for nodes that have been loaded recently.
+"""
+
+import typing
+import weakref
+
+from core import transactions, common_ids
+from utils import utils
+
+
+CacheKey = tuple[common_ids.PersistId, common_ids.PrincipalId]
+
+
+class NodeCacheTrx(transactions.TrxExtension):
+    """ Transaction level of the NodeCache: holds the loaded objects themselves, so a node loaded twice
+        within a transaction is the same object.
+    """
+    nodes: dict[CacheKey, typing.Any] = {}
+    written: set[common_ids.PersistId] = set()  # ids stored in this transaction, not yet committed
+
+    def reinit(self):
+        """ objects must not survive into the next transaction of the session """
+        self.nodes.clear()
+        self.written.clear()
+
+    def after_commit(self):
+        """ writes are committed now; invalidate again, since other transactions may have
+            cached the previous version while we were committing.
+        """
+        for id in self.written:
+            NodeCache.invalidate(id)
+        self.written.clear()
+
+
+class NodeCacheClass:
+    """ Two-level cache of decrypted Persistables, keyed by (PersistId, PrincipalId), as only a principal
+        that could decrypt a node may get it from the cache.
+
+        The first level is NodeCacheTrx. The second level is a bounded LRU across transactions holding the decrypted
+        plaintext only; objects are rebuilt from it, so no mutable state is shared between transactions.
+
+        A loader takes .generation before loading and passes it to .put(); if the id was invalidated meanwhile,
+        the loaded plaintext may be stale and is not put into the LRU.
+    """
+
+    MaxEntries: typing.ClassVar[int] = 1000
+    MaxInvalidations: typing.ClassVar[int] = 10_000  # recent invalidations remembered by id
+
+    def __init__(self, max_entries: int | None = None):
+        self.max_entries = max_entries or self.MaxEntries
+        self.generation = 0  # incremented by each invalidation
+        # generation of the last invalidation by id; forgotten ones are at most .forgotten_generation:
+        self.invalidations: utils.LRUCache[int] = utils.LRUCache(self.MaxInvalidations, on_evict=self._forget)
+        self.forgotten_generation = 0
+        # id -> {principal id -> plaintext}, so all principals' entries of an id are invalidated at once:
+        self.lru: utils.LRUCache[dict[common_ids.PrincipalId, bytes | str]] = utils.LRUCache(self.max_entries)
+        self.trx_hits = self.lru_hits = self.misses = 0
+
+    @staticmethod
+    def trx_cache(transaction: transactions.Transaction) -> NodeCacheTrx:
+        trx_cache = transaction.trx_ext.get('NodeCacheTrx')
+        if trx_cache is None:  # transaction created without extensions
+            trx_cache = transaction.trx_ext['NodeCacheTrx'] = NodeCacheTrx()
+            trx_cache._trx = weakref.ref(transaction)
+        return typing.cast(NodeCacheTrx, trx_cache)
+
+    def get(self, cls: type, id: common_ids.PersistId, transaction: transactions.Transaction) -> typing.Any | None:
+        """ return cached object of cls for the transaction owner, or None if not cached """
+        key = (id, transaction.owner.id)
+        trx_cache = self.trx_cache(transaction)
+        if (o := trx_cache.nodes.get(key)) is not None:
+            self.trx_hits += 1
+            return o
+        if (plain := self.lru.get(id, {}).get(transaction.owner.id)) is not None:
+            self.lru_hits += 1
+            o = cls.from_plain(plain)
+            trx_cache.nodes[key] = o
+            return o
+        self.misses += 1
+        return None
+
+    def put(self, obj, plain: bytes | str, transaction: transactions.Transaction, generation: int | None = None):
+        """ cache obj just loaded and decrypted for the transaction owner, with plain as its decrypted .to_plain() form.
+            generation is .generation before the load started.
+        """
+        trx_cache = self.trx_cache(transaction)
+        trx_cache.nodes[(obj.id, transaction.owner.id)] = obj
+        if obj.id not in trx_cache.written and not (  # never share uncommitted or possibly stale data
+                generation is not None and self.invalidated_since(obj.id, generation)):
+            self.lru.put(obj.id, self.lru.peek(obj.id, {}) | {transaction.owner.id: plain})
+        return
+
+    def stored(self, obj, transaction: transactions.Transaction):
+        """ obj is being stored in transaction; it becomes the current version within transaction only """
+        self.invalidate(obj.id, transaction)
+        trx_cache = self.trx_cache(transaction)
+        trx_cache.written.add(obj.id)
+        trx_cache.nodes[(obj.id, transaction.owner.id)] = obj
+        return
+
+    def invalidate(self, id: common_ids.PersistId, transaction: transactions.Transaction | None = None):
+        """ remove id for all principals, in the LRU and in transaction """
+        self.lru.pop(id, None)
+        self.generation += 1
+        self.invalidations.put(id, self.generation)
+        if transaction:
+            trx_cache = self.trx_cache(transaction)
+            for key in [k for k in trx_cache.nodes if k[0] == id]:
+                del trx_cache.nodes[key]
+        return
+
+    def invalidated_since(self, id: common_ids.PersistId, generation: int) -> bool:
+        return self.invalidations.peek(id, self.forgotten_generation) > generation
+
+    def _forget(self, id: common_ids.PersistId, generation: int):
+        """ the oldest invalidation is forgotten, so ids not remembered count as invalidated at its generation """
+        self.forgotten_generation = generation
+        return
+
+    def clear(self):
+        self.lru.clear()
+        self.trx_hits = self.lru_hits = self.misses = 0
+
+
+NodeCache = NodeCacheClass()
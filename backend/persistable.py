@@ -22,7 +22,7 @@ class DataFormat(str, enum.Enum):
     json = 'j'
 
 
-from backend import keyvault, storage
+from backend import keyvault, storage, zstd_dicts, envelope
 
 
 class NonPersistable(DDHbaseModel):
@@ -51,10 +51,15 @@ class Persistable(SupportsLoading):
     """
 
     Registry: typing.ClassVar[dict[str, type]] = {}
+    CompressionDictionary: typing.ClassVar[bool] = True  # compress with trained dictionary per class
+    BinaryEnvelope: typing.ClassVar[bool] = False  # persist in binary envelope instead of JSON
+    LazyFields: typing.ClassVar[frozenset[str]] = frozenset()  # envelope fields decoded on first access
     id: common_ids.PersistId = pydantic.Field(default_factory=secrets.token_urlsafe)
     format: DataFormat = DataFormat.dict
     owner: principals.Principal | None = None
 
+    _lazy_raw: dict[str, bytes] = pydantic.PrivateAttr(default_factory=dict)  # undecoded LazyFields
+
     @classmethod
     def __init_subclass__(cls):
         Persistable.Registry[cls.__name__] = cls
@@ -75,15 +80,77 @@ class Persistable(SupportsLoading):
         storage.Storage.delete(self.id, transaction)
         return
 
+    def __getattr__(self, name: str) -> typing.Any:
+        if name in self.LazyFields and name in (self.__pydantic_private__ or {}).get('_lazy_raw', ()):
+            return envelope.decode_lazy(self, name)
+        return super().__getattr__(name)  # type:ignore
+
+    def __setattr__(self, name: str, value: typing.Any):
+        super().__setattr__(name, value)
+        if name in self.LazyFields and name in (self.__pydantic_private__ or {}).get('_lazy_raw', ()):
+            # the assigned value replaces the undecoded one, which must not be decoded over it later:
+            envelope.set_decoded(self, name, self.__dict__[name])
+        return
+
+    def decode_lazy(self, exclude: typing.Any = None):
+        """ decode all undecoded LazyFields, except the ones in set exclude.
+            Needed wherever pydantic uses __dict__ directly instead of attribute access.
+        """
+        for name in self._lazy_raw.keys() - (exclude if isinstance(exclude, (set, frozenset)) else set()):
+            envelope.decode_lazy(self, name)
+        return
+
+    def model_dump(self, **kw) -> dict[str, typing.Any]:
+        self.decode_lazy(kw.get('exclude'))
+        return super().model_dump(**kw)
+
+    def model_dump_json(self, **kw) -> str:
+        self.decode_lazy(kw.get('exclude'))
+        return super().model_dump_json(**kw)
+
+    def __eq__(self, other: typing.Any) -> bool:
+        self.decode_lazy()
+        if isinstance(other, Persistable):
+            other.decode_lazy()
+        return super().__eq__(other)
+
+    def __copy__(self) -> typing.Self:
+        self.decode_lazy()
+        return super().__copy__()
+
+    def __deepcopy__(self, memo: dict[int, typing.Any] | None = None) -> typing.Self:
+        self.decode_lazy()
+        return super().__deepcopy__(memo)
+
     def to_compressed(self) -> bytes:
-        return zstd.compress(self.to_json().encode(), level=-1)
+        return self.compress_plain(self.to_plain())
+
+    @classmethod
+    def compress_plain(cls, plain: bytes) -> bytes:
+        """ compress .to_plain() form; without CompressionDictionary, this depends on no state of the process """
+        if cls.CompressionDictionary:
+            return zstd_dicts.Dictionaries.compress(cls.__name__, plain)
+        return zstd.compress(plain, level=zstd_dicts.DictionariesClass.Level)
 
     @classmethod
     def from_compressed(cls, data: bytes):
-        return cls.from_json(zstd.decompress(data).decode())
+        return cls.from_plain(zstd_dicts.Dictionaries.decompress(data))
+
+    def to_plain(self) -> bytes:
+        """ uncompressed persistent form """
+        return envelope.pack(self) if self.BinaryEnvelope else self.to_json().encode()
+
+    @classmethod
+    def from_plain(cls, plain: bytes | str) -> typing.Self:
+        """ reverse of .to_plain(), also accepts JSON written before the BinaryEnvelope """
+        if isinstance(plain, bytes):
+            if envelope.is_envelope(plain):
+                return envelope.unpack(cls, plain)
+            plain = plain.decode()
+        return typing.cast(typing.Self, cls.from_json(plain))
 
-    def to_json(self) -> str:
-        return self.model_dump_json()
+    def to_json(self, exclude: typing.AbstractSet[str] | None = None) -> str:
+        return self.model_dump_json(exclude=exclude)
 
     @classmethod
     def from_json(cls, j: str) -> Persistable:
@@ -106,16 +173,18 @@ class PersistableProxy(SupportsLoading):
 
     async def ensure_loaded(self, transaction: transactions.Transaction) -> Persistable:
         """ return an instantiaded Persistable subclass; idempotent """
-        cls = Persistable.Registry[self.classname]
-        cls = typing.cast(type[Persistable], cls)
-        if self.owner_id:  # get owning user
-            owner = user_auth.UserInDB.load_user(self.owner_id)
-        else:
-            owner = None
-        obj = await cls.load(self.id, owner, transaction)
+        cls = self.get_class()
+        obj = await cls.load(self.id, self.get_owner(), transaction)
         assert isinstance(obj, cls)
         return obj
 
+    def get_class(self) -> type[Persistable]:
+        return typing.cast(type[Persistable], Persistable.Registry[self.classname])
+
+    def get_owner(self):
+        """ get owning user """
+        return user_auth.UserInDB.load_user(self.owner_id) if self.owner_id else None
+
     def get_proxy(self) -> PersistableProxy:
         """ this is already a proxy """
         return self
@@ -125,6 +194,10 @@ class PersistAction(transactions.Action):
 
     obj: Persistable
 
+    def coalesce_key(self):
+        """ the last state of the object is written once """
+        return (PersistAction, self.obj.id)
+
     async def commit(self, transaction):
         """ store has currently not async support """
         await self.obj.store(transaction)
@@ -132,8 +205,8 @@ class PersistAction(transactions.Action):
 
 
 class SystemDataPersistAction(PersistAction):
-    """ Persist System Data """
-    ...
+    """ Persist System Data, such as audit records; also permitted in read-only transactions """
+    read_only_ok: typing.ClassVar[bool] = True
 
 
 class UserDataPersistAction(PersistAction):
@@ -142,6 +215,11 @@ class UserDataPersistAction(PersistAction):
     """
     add_to_dir: bool = True
 
+    def coalesce(self, previous: transactions.Action) -> UserDataPersistAction:
+        if isinstance(previous, UserDataPersistAction) and previous.add_to_dir and not self.add_to_dir:
+            return self.model_copy(update={'add_to_dir': True})
+        return self
+
     async def commit(self, transaction):
         """ store has currently not async support """
         await self.obj.store(transaction)
@@ -0,0 +1,266 @@
+""" Durable state of the NodeRegistry: a memory-mappable snapshot plus an append-only write-ahead log
+    of registry changes since the snapshot. Recovery maps the snapshot and replays the log.
+
+    To take a snapshot off the request path, .start_snapshot() renames the log to the folding log and opens
+    a new one; a background thread folds the previous snapshot and the folding log into a new snapshot and then
+    removes the folding log. Until then, recovery replays the folding log before the log.
+
+    Both files consist of a header and a sequence of records. A record is a crc32 over the record body,
+    the body being the lengths of the string fields, the supports masks and the utf-8 encoded fields.
+    A log record with a wrong crc (torn write) ends the log.
+"""
+
+import itertools
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import typing
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Record(typing.NamedTuple):
+    """ One registry entry: a persistable proxy registered at path for the supports in registered """
+    path: str  # encoded path, see .encode_path()
+    registered: int  # mask of NodeSupports the proxy is registered for
+    supports: int  # mask of NodeSupports of the proxy itself
+    classname: str
+    id: str
+    owner_id: str
+
+
+class JournalError(Exception): ...
+
+
+_Header = struct.Struct('<8sQ')  # magic, number of records (snapshot only)
+_Crc = struct.Struct('<I')
+_Body = struct.Struct('<IIIIHH')  # lengths of path, classname, id, owner_id; registered, supports masks
+
+SnapshotMagic = b'DDHRSNP1'
+LogMagic = b'DDHRLOG1'
+
+PathDelimiter = '\x1f'
+RootSegment = '\x1e'
+
+
+def encode_path(path: tuple, root: str) -> str:
+    """ encode path tuple, with root as a marker segment """
+    return PathDelimiter.join(RootSegment if s is root else str(s) for s in path)
+
+
+def decode_path(path: str, root: str) -> tuple:
+    return tuple(root if s == RootSegment else s for s in path.split(PathDelimiter)) if path else ()
+
+
+def pack(record: Record) -> bytes:
+    fields = [record.path.encode(), record.classname.encode(), record.id.encode(), record.owner_id.encode()]
+    body = _Body.pack(*map(len, fields), record.registered, record.supports) + b''.join(fields)
+    return _Crc.pack(zlib.crc32(body)) + body
+
+
+def unpack_from(buffer, offset: int) -> tuple[Record, int] | None:
+    """ unpack record at offset, return it and the offset of the next record, or None if there is no valid record """
+    if offset + _Crc.size + _Body.size > len(buffer):
+        return None
+    crc, = _Crc.unpack_from(buffer, offset)
+    *lengths, registered, supports = _Body.unpack_from(buffer, offset+_Crc.size)
+    end = offset + _Crc.size + _Body.size + sum(lengths)
+    if end > len(buffer) or zlib.crc32(buffer[offset+_Crc.size:end]) != crc:
+        return None
+    pos = offset + _Crc.size + _Body.size
+    fields = []
+    for l in lengths:
+        fields.append(str(buffer[pos:pos+l], 'utf-8'))
+        pos += l
+    path, classname, id, owner_id = fields
+    return Record(path, registered, supports, classname, id, owner_id), end
+
+
+def fold(records: typing.Iterable[Record]) -> typing.Iterator[Record]:
+    """ fold records into the state recovery leaves: the last proxy registered per path and supports bit,
+        one record per path and proxy.
+    """
+    state: dict[str, dict[int, Record]] = {}  # path -> bit -> last record registering it
+    for record in records:
+        bits = state.setdefault(record.path, {})
+        mask = record.registered
+        while mask:
+            bit = mask & -mask
+            bits[bit] = record
+            mask ^= bit
+    for path, bits in state.items():
+        by_proxy: dict[tuple, int] = {}
+        for bit, record in bits.items():
+            proxy = (record.supports, record.classname, record.id, record.owner_id)
+            by_proxy[proxy] = by_proxy.get(proxy, 0) | bit
+        for (supports, classname, id, owner_id), registered in by_proxy.items():
+            yield Record(path, registered, supports, classname, id, owner_id)
+    return
+
+
+class RegistryJournal:
+    """ Snapshot and write-ahead log in directory """
+
+    SnapshotName: typing.ClassVar[str] = 'registry.snapshot'
+    LogName: typing.ClassVar[str] = 'registry.log'
+    FoldingLogName: typing.ClassVar[str] = 'registry.log.folding'
+
+    def __init__(self, directory: pathlib.Path | str, sync: bool = False):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_path = self.directory / self.SnapshotName
+        self.log_path = self.directory / self.LogName
+        self.folding_log_path = self.directory / self.FoldingLogName
+        self.sync = sync  # fsync each log record, otherwise log survives process but not system crashes
+        self.log: typing.BinaryIO | None = None
+        self.log_records = 0  # records in the log since the snapshot
+        self.folder: threading.Thread | None = None  # background thread folding the log into a new snapshot
+
+    def recover(self) -> typing.Iterator[Record]:
+        """ yield records of snapshot, then of the folding log and log. Afterwards, the log is open for appending. """
+        yield from self._read_snapshot()
+        folding = self.folding_log_path.exists()  # fold was interrupted
+        if folding:
+            for record, end in self._read_log(self.folding_log_path):
+                yield record
+        valid_end = _Header.size
+        for record, valid_end in self._read_log(self.log_path):
+            self.log_records += 1
+            yield record
+        if folding:  # complete it, so the folding log is free for the next fold
+            self._fold()
+        self._open_log(valid_end)
+        return
+
+    def _read_snapshot(self) -> typing.Iterator[Record]:
+        if self.snapshot_path.exists() and self.snapshot_path.stat().st_size:
+            with open(self.snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, n = _Header.unpack_from(mm, 0)
+                if magic != SnapshotMagic:
+                    raise JournalError(f'{self.snapshot_path} is not a registry snapshot')
+                offset = _Header.size
+                for i in range(n):
+                    r = unpack_from(mm, offset)
+                    if r is None:
+                        raise JournalError(f'{self.snapshot_path} is corrupt at record {i}')
+                    record, offset = r
+                    yield record
+        return
+
+    def _read_log(self, path: pathlib.Path) -> typing.Iterator[tuple[Record, int]]:
+        """ yield valid records of log at path, with their end offset """
+        valid_end = _Header.size
+        if path.exists() and path.stat().st_size:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, _ = _Header.unpack_from(mm, 0)
+                if magic != LogMagic:
+                    raise JournalError(f'{path} is not a registry log')
+                while (r := unpack_from(mm, valid_end)) is not None:
+                    record, valid_end = r
+                    yield record, valid_end
+        return
+
+    def _open_log(self, valid_end: int = _Header.size):
+        """ open log for appending, cutting off a torn tail after valid_end """
+        if self.log_path.exists() and self.log_path.stat().st_size >= _Header.size:
+            self.log = open(self.log_path, 'r+b')
+            self.log.truncate(valid_end)
+            self.log.seek(valid_end)
+        else:
+            self.log = open(self.log_path, 'wb')
+            self.log.write(_Header.pack(LogMagic, 0))
+            self._flush()
+        return
+
+    def _flush(self):
+        assert self.log
+        self.log.flush()
+        if self.sync:
+            os.fsync(self.log.fileno())
+
+    def append(self, record: Record):
+        """ append record to log """
+        if self.log is None:
+            self._open_log()
+        assert self.log
+        self.log.write(pack(record))
+        self._flush()
+        self.log_records += 1
+        return
+
+    def write_snapshot(self, records: typing.Iterable[Record]):
+        """ write all records as new snapshot, atomically replacing the previous one, then reset the log """
+        self.wait()
+        self._write_snapshot_file(records)
+        self.folding_log_path.unlink(missing_ok=True)
+        if self.log:
+            self.log.close()
+        self.log = open(self.log_path, 'wb')
+        self.log.write(_Header.pack(LogMagic, 0))
+        self._flush()
+        self.log_records = 0
+        return
+
+    def _write_snapshot_file(self, records: typing.Iterable[Record]):
+        tmp = self.snapshot_path.with_suffix('.tmp')
+        n = 0
+        with open(tmp, 'wb') as f:
+            f.write(_Header.pack(SnapshotMagic, 0))
+            for record in records:
+                f.write(pack(record))
+                n += 1
+            f.seek(0)
+            f.write(_Header.pack(SnapshotMagic, n))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        return
+
+    def start_snapshot(self) -> bool:
+        """ start folding the log into a new snapshot in a background thread, unless a fold is running.
+            Further records are appended to a new log meanwhile.
+        """
+        if (self.folder and self.folder.is_alive()) or self.folding_log_path.exists():  # running or failed
+            return False
+        if self.log:
+            self.log.close()
+            self.log = None
+        os.replace(self.log_path, self.folding_log_path)
+        self._open_log()
+        self.log_records = 0
+        self.folder = threading.Thread(target=self._fold, name='RegistryJournal snapshot', daemon=True)
+        self.folder.start()
+        return True
+
+    def _fold(self):
+        """ fold snapshot and folding log into a new snapshot, then drop the folding log """
+        try:
+            log = (record for record, end in self._read_log(self.folding_log_path))
+            self._write_snapshot_file(fold(itertools.chain(self._read_snapshot(), log)))
+            self.folding_log_path.unlink()
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except Exception as e:  # folding log is kept and replayed on recovery
+            logger.error(f'registry snapshot failed: {e!r}')
+        return
+
+    def wait(self):
+        """ wait for a background snapshot to finish """
+        if self.folder:
+            self.folder.join()
+            self.folder = None
+        return
+
+    def close(self):
+        self.wait()
+        if self.log:
+            self.log.close()
+            self.log = None
+        return
@@ -3,6 +3,8 @@
 
 from compression import zstd
 import enum
+import struct
+import typing
 
 from core import keys, permissions, nodes, transactions, common_ids
 from utils.pydantic_utils import DDHbaseModel
@@ -17,6 +19,39 @@ class Variant(enum.IntEnum):
     zstd = 1
 
 
+_Length = struct.Struct('<I')
+_Missing = 0xFFFFFFFF  # length marking a missing blob
+
+
+def pack_blobs(items: typing.Iterable[tuple[str, bytes | None]]) -> bytes:
+    """ frame (id, blob) pairs for batch transport; None marks a missing or deleted blob """
+    parts = []
+    for id, blob in items:
+        bid = id.encode()
+        parts += [_Length.pack(len(bid)), bid, _Length.pack(_Missing if blob is None else len(blob))]
+        if blob is not None:
+            parts.append(blob)
+    return b''.join(parts)
+
+
+def unpack_blobs(data: bytes) -> typing.Iterator[tuple[common_ids.PersistId, bytes | None]]:
+    """ reverse of pack_blobs() """
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        l, = _Length.unpack_from(view, offset)
+        id = str(view[offset+4:offset+4+l], 'utf-8')
+        offset += 4 + l
+        l, = _Length.unpack_from(view, offset)
+        offset += 4
+        if l == _Missing:
+            yield typing.cast(common_ids.PersistId, id), None
+        else:
+            yield typing.cast(common_ids.PersistId, id), bytes(view[offset:offset+l])
+            offset += l
+    return
+
+
 class StorageBlock(DDHbaseModel):
     """ Elementary block of storage """
     variant: Variant = Variant.uncompressed
@@ -40,7 +75,21 @@ class StorageClass(DDHbaseModel):
         self.byId.pop(id, None)
         return
 
-    def load(self, id: common_ids.PersistId, transaction: transactions.Transaction) -> bytes:
+    async def commit_writes(self, writes: dict[common_ids.PersistId, bytes | None], transaction: transactions.Transaction):
+        """ apply writes of a transaction together; None deletes """
+        for id, data in writes.items():
+            if data is None:
+                self.delete(id, transaction)
+            else:
+                self.store(id, data, transaction)
+        return
+
+    def clear(self):
+        """ remove everything, testing only """
+        self.byId.clear()
+        return
+
+    def load(self, id: common_ids.PersistId, transaction: transactions.Transaction | None) -> bytes:
         sb = self.byId.get(id, None)
         if not sb:
             raise KeyError(id)
@@ -0,0 +1,139 @@
+""" Trained zstd dictionaries for small persisted records.
+
+    Small JSON records consist mostly of repeated field names, which zstd compresses poorly on its own.
+    Samples are collected per name (the Persistable class); once enough are collected, a dictionary is trained
+    and used for further records of that name. After .retrain_after records, samples are collected again and a
+    new version of the dictionary is trained; previous versions remain available for decompression.
+    Training runs in a background thread, records are compressed with the current dictionary meanwhile.
+
+    Data compressed with a dictionary is a header (DictFormat, dictionary id) followed by the zstd frame.
+    Data without dictionary is a plain zstd frame, as written before dictionaries were introduced.
+    Dictionaries are kept in storage.Storage under DictPrefix + dictionary id.
+"""
+
+import struct
+import threading
+import typing
+import logging
+
+from compression import zstd
+
+from core import common_ids
+
+logger = logging.getLogger(__name__)
+
+DictFormat = b'\x01'
+_Header = struct.Struct('<cI')  # DictFormat, dictionary id
+DictPrefix = '_zstd_dict.'
+
+
+class DictionariesClass:
+    """ Dictionaries by name for compression and by id for decompression """
+
+    Level: typing.ClassVar[int] = -1
+    SamplesNeeded: typing.ClassVar[int] = 500  # samples to train a dictionary
+    SampleMaxSize: typing.ClassVar[int] = 4096  # larger records compress well without dictionary
+    DictSize: typing.ClassVar[int] = 16 * 2**10
+    RetrainAfter: typing.ClassVar[int] = 100_000  # records compressed with a dictionary version
+    # dictionary id is in our header, checksum is redundant with the encryption of the blob:
+    _options: typing.ClassVar[dict] = {zstd.CompressionParameter.compression_level: Level,
+                                       zstd.CompressionParameter.dict_id_flag: 0,
+                                       zstd.CompressionParameter.checksum_flag: 0}
+
+    def __init__(self, samples_needed: int | None = None, retrain_after: int | None = None):
+        self.samples_needed = samples_needed or self.SamplesNeeded
+        self.retrain_after = retrain_after or self.RetrainAfter
+        self.current: dict[str, zstd.ZstdDict] = {}
+        self.by_id: dict[int, zstd.ZstdDict] = {}
+        self.samples: dict[str, list[bytes]] = {}
+        self.used: dict[str, int] = {}  # records compressed with current dictionary
+        self.training: dict[str, threading.Thread] = {}
+        self.lock = threading.Lock()
+
+    def compress(self, name: str, data: bytes) -> bytes:
+        """ compress data of records of name, with its dictionary if there is one """
+        with self.lock:
+            zdict = self.current.get(name)
+            if (zdict is None or self.used[name] >= self.retrain_after) and name not in self.training \
+                    and len(data) <= self.SampleMaxSize:
+                samples = self.samples.setdefault(name, [])
+                samples.append(data)
+                if len(samples) >= self.samples_needed:
+                    thread = self.training[name] = threading.Thread(
+                        target=self._train, args=(name, self.samples.pop(name)), name=f'zstd dictionary {name}', daemon=True)
+                    thread.start()
+            if zdict is None:
+                return zstd.compress(data, level=self.Level)
+            self.used[name] += 1
+        return _Header.pack(DictFormat, zdict.dict_id) + zstd.compress(data, options=self._options, zstd_dict=zdict)
+
+    def decompress(self, data: bytes) -> bytes:
+        if data[:1] == DictFormat:
+            _, dict_id = _Header.unpack_from(data)
+            return zstd.decompress(memoryview(data)[_Header.size:], zstd_dict=self.get(dict_id))
+        return zstd.decompress(data)
+
+    def train(self, name: str, samples: list[bytes]) -> zstd.ZstdDict | None:
+        """ train a new dictionary version for name from samples """
+        return self._train(name, list(samples))
+
+    def _train(self, name: str, samples: list[bytes]) -> zstd.ZstdDict | None:
+        """ train without holding the lock, then make the dictionary current """
+        try:
+            zdict = zstd.train_dict(samples, self.DictSize)
+        except zstd.ZstdError as e:  # e.g., samples too uniform; try again with the next samples
+            logger.warning(f'zstd dictionary training for {name} failed: {e}')
+            zdict = None
+        else:
+            self.add(zdict)
+            logger.info(f'trained zstd dictionary {zdict.dict_id} for {name} from {len(samples)} samples')
+        with self.lock:
+            if zdict:
+                self.current[name] = zdict
+                self.used[name] = 0
+            if self.training.get(name) is threading.current_thread():
+                del self.training[name]
+        return zdict
+
+    def wait(self):
+        """ wait until running trainings are done """
+        with self.lock:
+            threads = list(self.training.values())
+        for thread in threads:
+            thread.join()
+        return
+
+    def add(self, zdict: zstd.ZstdDict):
+        """ make zdict available for decompression and keep it in storage """
+        from . import storage
+        self.by_id[zdict.dict_id] = zdict
+        storage.Storage.store(typing.cast(common_ids.PersistId, f'{DictPrefix}{zdict.dict_id}'),
+                              zdict.dict_content, None)  # type:ignore
+        return
+
+    def get(self, dict_id: int) -> zstd.ZstdDict:
+        """ get dictionary by id, from storage if not yet known """
+        zdict = self.by_id.get(dict_id)
+        if zdict is None:
+            from . import storage
+            try:
+                content = storage.Storage.load(typing.cast(common_ids.PersistId, f'{DictPrefix}{dict_id}'), None)
+            except KeyError:
+                raise ValueError(f'Unknown zstd dictionary {dict_id}')
+            zdict = self.by_id[dict_id] = zstd.ZstdDict(content)
+        return zdict
+
+    def clear(self):
+        """ forget dictionaries, testing only """
+        self.wait()
+        with self.lock:
+            self.current.clear(); self.by_id.clear(); self.samples.clear(); self.used.clear()
+        return
+
+
+Dictionaries = DictionariesClass()
+
+
+def decompress(data: bytes) -> bytes:
+    """ Dictionaries.decompress(), as a function that can be passed to another process """
+    return Dictionaries.decompress(data)
@@ -72,14 +72,15 @@ class DAppProxy(DDHbaseModel):
         errors.DAppError.raise_from_response(resp)  # Pass error response to caller
         return resp.json()
 
-    async def send_url(self, urlpath, verb='get', jwt=None, headers={}, **kw):
-        """ forward execution request to DApp microservice """
+    async def send_url(self, urlpath, verb='get', jwt=None, headers={}, raw: bool = False, **kw):
+        """ forward execution request to DApp microservice; return decoded json response, or its bytes if raw """
+        headers = dict(headers)  # don't modify the default
         if jwt:
             headers['Authorization'] = 'Bearer '+jwt
         # print(f'*send_url {headers=}, {urlpath=}, {kw=}')
         resp = await self.running.client.request(verb, urlpath, headers=headers, **kw)
         errors.DAppError.raise_from_response(resp)  # Pass error response to caller
-        return resp.json()
+        return resp.content if raw else resp.json()
 
 
 class DAppManagerClass(DDHbaseModel):
@@ -157,6 +158,10 @@ class DAppResource(transactions.Resource):
         await self.dapp.send_url(f'transaction/{trx.trxid}/begin', verb='post', jwt=trx.user_token)
         return
 
+    async def prepare(self, trx: transactions.Transaction):
+        await self.dapp.send_url(f'transaction/{trx.trxid}/prepare', verb='post', jwt=trx.user_token)
+        return
+
     async def commit(self, trx: transactions.Transaction):
         await self.dapp.send_url(f'transaction/{trx.trxid}/commit', verb='post', jwt=trx.user_token)
         return
@@ -164,3 +169,8 @@ class DAppResource(transactions.Resource):
     async def abort(self, trx: transactions.Transaction):
         await self.dapp.send_url(f'transaction/{trx.trxid}/abort', verb='post', jwt=trx.user_token)
         return
+
+    async def rollback(self, trx: transactions.Transaction):
+        """ transaction.abort() and failed commits roll back resources """
+        await self.abort(trx)
+        return
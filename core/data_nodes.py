@@ -2,11 +2,12 @@
 """ DDH DataNode """
 
 import typing
+import copy
 
 
 from . import permissions, transactions, errors, keydirectory, users, common_ids, nodes, keys, dapp_proxy, storage_resource, principals, trait
-from utils import datautils
-from backend import persistable, system_services, storage, keyvault
+from utils import datautils, utils
+from backend import persistable, system_services, storage, keyvault, node_cache, zstd_dicts, crypto_executor
 
 
 class DataNode(nodes.Node, persistable.Persistable):
@@ -18,6 +19,11 @@ class DataNode(nodes.Node, persistable.Persistable):
     access_key: keyvault.AccessKey | None = None
     sub_nodes: dict[keys.DDHkey, keys.DDHkey] = {}
 
+    LoadFanOut: typing.ClassVar[int] = 16  # max. number of sub_nodes loaded concurrently
+    CompressionDictionary: typing.ClassVar[bool] = False  # dictionary would hold user data unencrypted
+    BinaryEnvelope: typing.ClassVar[bool] = True
+    LazyFields: typing.ClassVar[frozenset[str]] = frozenset({'data'})  # metadata is used without the data
+
     @classmethod
     def get_storage_dapp_id(cls, owner: principals.Principal) -> str:
         assert owner
@@ -43,10 +49,7 @@ class DataNode(nodes.Node, persistable.Persistable):
     @classmethod
     async def get_storage_resource(cls, owner: principals.Principal,  transaction: transactions.Transaction) -> storage_resource.StorageResource:
         da = cls.get_storage_dapp_id(owner)
-        res = transaction.resources.get(da)
-        if not res:
-            res = storage_resource.StorageResource.create(da)
-            await transaction.add_resource(res)
+        res = await transaction.get_or_add_resource(da, lambda: storage_resource.StorageResource.create(da))
         assert isinstance(res, storage_resource.StorageResource)
         return res
 
@@ -55,12 +58,14 @@ class DataNode(nodes.Node, persistable.Persistable):
             Does not add it to the directory, use .ensure_in_dir() for this. 
         """
         res = await self.get_storage_resource(self.owner, transaction)
-        d = self.to_compressed()
+        plain = self.to_plain()
+        d = await crypto_executor.CryptoExecutor.run(len(plain), self.compress_plain, plain, pure=not self.CompressionDictionary)
         if self.id not in storage.Storage:
             # we need a storage key first:
             keyvault.set_new_storage_key(self, transaction.owner, self.all_accessors(), set())
-        enc = keyvault.encrypt_data(transaction.owner, self.id, d)
+        enc = await crypto_executor.CryptoExecutor.run(len(d), keyvault.encrypt_data, transaction.owner, self.id, d)
         await res.store(self.id, enc, transaction)
+        node_cache.NodeCache.stored(self, transaction)
         return
 
     def ensure_in_dir(self, key, transaction: transactions.Transaction):
@@ -68,23 +73,59 @@ class DataNode(nodes.Node, persistable.Persistable):
         keydirectory.NodeRegistry.check_and_set(key, self)
 
     async def delete(self, transaction: transactions.Transaction):
-        await self.__class__.load(self.id, self.owner, transaction)  # verify encryption by loading
         res = await self.get_storage_resource(self.owner, transaction)
+        enc = await res.load(self.id, transaction)  # verify encryption by decrypting the stored blob, not the NodeCache entry
+        try:
+            await crypto_executor.CryptoExecutor.run(len(enc), keyvault.decrypt_data, transaction.owner, self.id, enc)
+        except KeyError:
+            raise errors.AccessError(f'User {transaction.owner.id} not authorized to delete node {self.id}')
         await res.delete(self.id, transaction)
+        node_cache.NodeCache.invalidate(self.id, transaction)
         return
 
     @classmethod
     async def load(cls, id: common_ids.PersistId, owner: principals.Principal,  transaction: transactions.Transaction):
+        """ Load and decrypt node, unless it is in the NodeCache for the transaction owner """
+        if (o := node_cache.NodeCache.get(cls, id, transaction)) is not None:
+            return o
+        generation = node_cache.NodeCache.generation
         res = await cls.get_storage_resource(owner, transaction)
         enc = await res.load(id, transaction)
-        # enc = storage.Storage.load(id, transaction)
+        return (await cls._from_encrypted([id], [enc], transaction, generation))[0]
+
+    @classmethod
+    async def load_many(cls, ids: list[common_ids.PersistId], owner: principals.Principal,  transaction: transactions.Transaction) -> list[DataNode]:
+        """ Load and decrypt nodes of the same owner, with a single storage request for those not in the NodeCache """
+        found = {id: o for id in ids if (o := node_cache.NodeCache.get(cls, id, transaction)) is not None}
+        if missing := [id for id in ids if id not in found]:
+            generation = node_cache.NodeCache.generation
+            res = await cls.get_storage_resource(owner, transaction)
+            encs = await res.load_many(missing, transaction)
+            for id, enc in zip(missing, encs):
+                if enc is None:
+                    raise errors.NotFound(f'{id=} not found')
+            found.update(zip(missing, await cls._from_encrypted(missing, typing.cast(list[bytes], encs), transaction, generation)))
+        return [found[id] for id in ids]
+
+    @classmethod
+    async def _from_encrypted(cls, ids: list[common_ids.PersistId], encs: list[bytes], transaction: transactions.Transaction,
+                              generation: int) -> list[DataNode]:
+        """ decrypt and decompress loaded nodes, large ones in the CryptoExecutor, and put them into the NodeCache.
+            generation is the NodeCache.generation before loading.
+        """
+        executor = crypto_executor.CryptoExecutor
         try:
-            plain = keyvault.decrypt_data(transaction.owner, id, enc)
+            plains = await executor.map(keyvault.decrypt_data, [(transaction.owner, id, enc) for id, enc in zip(ids, encs)], [len(enc) for enc in encs])
         except KeyError as e:  # there is no entry for the user in keyvault.PrincipalKeyVault, so we cannot load this node
-            raise errors.AccessError(f'User {transaction.owner.id} not authorized to load node {id}')
-        o = cls.from_compressed(plain)
-        assert o.key.key[0] is keys.DDHkey.Root
-        return o
+            raise errors.AccessError(f'User {transaction.owner.id} not authorized to load node {", ".join(ids)}')
+        plains = await executor.map(zstd_dicts.decompress, [(p,) for p in plains], [len(p) for p in plains], pure=not cls.CompressionDictionary)
+        objs = []
+        for plain in plains:  # Fernet blobs are rewritten in the current format when the owner next stores the node
+            o = cls.from_plain(plain)
+            assert o.key.key[0] is keys.DDHkey.Root
+            node_cache.NodeCache.put(o, plain, transaction, generation)
+            objs.append(o)
+        return objs
 
     async def execute(self, op: nodes.Ops, access: permissions.Access, transaction: transactions.Transaction, key_split: int, data: dict | None = None, query_params: trait.QueryParams | None = None):
         if key_split:
@@ -95,7 +136,7 @@ class DataNode(nodes.Node, persistable.Persistable):
             data = await self.unsplit_data(self.data, transaction)
             if key_split:
                 # we tolerate not found here and check in VerifyLoaded transformer:
-                data = datautils.extract_data(self.data, remainder, default=None)
+                data = datautils.extract_data(data, remainder, default=None)
         elif op == nodes.Ops.put:
             assert data is not None
             if key_split:
@@ -125,6 +166,8 @@ class DataNode(nodes.Node, persistable.Persistable):
         if added or removed:  # expensive op follows, do only if something has changed
             await self.ensure_loaded(transaction)  # we must ensure data is read
             self.consents = consents  # actually update
+            node_cache.NodeCache.invalidate(self.id, transaction)  # principals with access change
+            keydirectory.NodeRegistry[self.key] = self  # supports have changed, update directory index
 
             if remainder.key:  # change is not at this level, insert a new node:
                 node = self.split_node(remainder, consents)
@@ -135,8 +178,10 @@ class DataNode(nodes.Node, persistable.Persistable):
                 above = None
                 node = self  # top level
 
-            keyvault.set_new_storage_key(node, access.principal, eff_principals,
-                                         del_principals)  # now we can set the new key
+            # consentees only added: grant them the current key, otherwise set a new one:
+            if del_principals or node is not self or not keyvault.grant_storage_key(node, access.principal, eff_principals):
+                keyvault.set_new_storage_key(node, access.principal, eff_principals,
+                                             del_principals)  # now we can set the new key
 
             # re-encrypt on new node (may be self if there is no remainder)
             await node.store(transaction)
@@ -163,13 +208,35 @@ class DataNode(nodes.Node, persistable.Persistable):
         self.data = above
         return node
 
-    async def unsplit_data(self, data, transaction):
-        for remainder, fullkey in self.sub_nodes.items():
-            subnodeproxy = keydirectory.NodeRegistry[fullkey][nodes.NodeSupports.data]
-            if subnodeproxy:
-                subnode = await subnodeproxy.ensure_loaded(transaction)
-                assert isinstance(subnode, DataNode)  # because of lookup by type
-                data = datautils.insert_data(data, remainder, subnode.data)
+    async def unsplit_data(self, data, transaction, fan_out: int | None = None):
+        """ return data with the data of sub_nodes inserted; data is not modified in place,
+            as the node may be shared through the NodeCache.
+            Sub_nodes of the same class and owner are loaded in one batch; up to fan_out (default .LoadFanOut)
+            loads run concurrently.
+        """
+        if self.sub_nodes:
+            data = copy.deepcopy(data)
+        proxies = [(remainder, subnodeproxy) for remainder, fullkey in self.sub_nodes.items()
+                   if (subnodeproxy := keydirectory.NodeRegistry[fullkey][nodes.NodeSupports.data])]
+        # DataNodes of the same class and owner are loaded with a single storage request per batch:
+        batches: dict[tuple, list[persistable.PersistableProxy]] = {}
+        singles = []
+        for r, p in proxies:
+            if isinstance(p, persistable.PersistableProxy) and issubclass(p.get_class(), DataNode):
+                batches.setdefault((p.classname, p.owner_id), []).append(p)
+            else:
+                singles.append(p)
+        loads = [p.ensure_loaded(transaction) for p in singles] + \
+            [p_batch[0].get_class().load_many([p.id for p in p_batch], p_batch[0].get_owner(), transaction)  # type:ignore
+             for p_batch in batches.values()]
+        loaded = await utils.gather_limited(loads, fan_out or self.LoadFanOut)
+        by_proxy = {id(p): o for p, o in zip(singles, loaded)}
+        for p_batch, objs in zip(batches.values(), loaded[len(singles):]):
+            by_proxy.update((id(p), o) for p, o in zip(p_batch, objs))
+        subnodes = [by_proxy[id(p)] for r, p in proxies]
+        for (remainder, _), subnode in zip(proxies, subnodes):
+            assert isinstance(subnode, DataNode)  # because of lookup by type
+            data = datautils.insert_data(data, remainder, subnode.data)
 
         return data
 
@@ -21,7 +21,7 @@ async def ddh_get(access: permissions.Access, session: sessions.Session, raw_que
         First we get the data (and consent), then we pass it to an enode if an enode is found.
 
     """
-    async with session.get_or_create_transaction() as transaction:
+    async with session.get_or_create_transaction(read_only=True) as transaction:
         access.include_mode(permissions.AccessMode.read)
         transaction.add_and_validate(access)
 
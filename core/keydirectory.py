@@ -10,120 +10,279 @@ import typing
 from pydantic.errors import PydanticErrorMixin
 from utils.pydantic_utils import DDHbaseModel
 
-from . import nodes, keys, transactions
+from . import nodes, keys, transactions, node_types
 from utils import utils
-from backend import persistable
+from backend import persistable, registry_journal
+
+
+IndexKey = tuple[node_types.NodeSupports, bool]  # (support, with_consents)
+
+
+class _TrieNode:
+    """ Node of the path trie in _NodeRegistry; one per key segment.
+        .by_supports holds the proxies registered at the exact key of this node.
+        .nearest is the nearest-ancestor index: for each IndexKey, the closest trie node at or above
+        this one qualifying for it (see .qualifies()).
+    """
+    __slots__ = ('children', 'by_supports', 'parent', 'depth', 'nearest')
+
+    def __init__(self, parent: _TrieNode | None = None):
+        self.children: dict[typing.Any, _TrieNode] = {}
+        self.by_supports: dict[nodes.NodeSupports, nodes.NodeOrProxy] = {}
+        self.parent = parent
+        self.depth: int = parent.depth+1 if parent else 0
+        self.nearest: dict[IndexKey, _TrieNode] = dict(parent.nearest) if parent else {}
+
+    def qualifies(self, support: nodes.NodeSupports, with_consents: bool) -> bool:
+        """ True if a node supporting support is registered here; if with_consents, this node
+            must also carry consents (i.e., it is registered with NodeSupports.consents).
+        """
+        nop = self.by_supports.get(support)
+        return nop is not None and (not with_consents or self.by_supports.get(nodes.NodeSupports.consents) is nop)
 
 
 class _NodeRegistry:
-    """ Preliminary holder of nodes
+    """ Holder of nodes, as a path trie with one _TrieNode per key segment.
         Note that Nodes are held per NodeSupports, duplicating them as required
         for easy lookup by NodeSupports.
 
-        A proper realization could use a PatriciaTrie.
+        Each trie node carries a nearest-ancestor index per NodeSupports (and per NodeSupports
+        with consents), which is updated incrementally when nodes are stored. A lookup therefore
+        only locates the deepest trie node of the key (a dict hit if the key is in the registry)
+        and reads the index, without walking up and without loading candidate nodes.
 
         # TODO: Are nodes on DDHKey or DDHKeyGeneric?
     """
 
-    nodes_by_key: dict[tuple, dict[nodes.NodeSupports, nodes.NodeProxy]]  # by key, then by NodeTypes
+    IndexKeys: typing.ClassVar[tuple[IndexKey, ...]] = tuple(
+        (s, c) for s in node_types.NodeSupports for c in (False, True))
+    LoadFanOut: typing.ClassVar[int] = 16  # max. number of nodes loaded concurrently
+    SnapshotAfter: typing.ClassVar[int] = 100_000  # log records, then the log is folded into a new snapshot
+    # bits of NodeSupports in journal records; persisted, so never change or reuse a bit:
+    SupportsBits: typing.ClassVar[dict[node_types.NodeSupports, int]] = {
+        node_types.NodeSupports.schema: 1 << 0,
+        node_types.NodeSupports.data: 1 << 1,
+        node_types.NodeSupports.execute: 1 << 2,
+        node_types.NodeSupports.consents: 1 << 3,
+        node_types.NodeSupports.subscribable: 1 << 4,
+    }
+    assert set(SupportsBits) == set(node_types.NodeSupports), 'every NodeSupports needs a journal bit'
+
+    root: _TrieNode
+    by_path: dict[tuple, _TrieNode]  # all trie nodes by key tuple
+    journal: registry_journal.RegistryJournal | None  # durable state of persistable nodes, if any
 
     def __init__(self):
-        self.nodes_by_key = {}
+        self.root = _TrieNode()
+        self.by_path = {(): self.root}
+        self.journal = None
 
     def _clear(self, supports: set[nodes.NodeSupports]):
         """ clear selective supports, for testing only """
-        for s in self.nodes_by_key:
-            if s in supports:
-                self.nodes_by_key[s].clear()
+        for path, tnode in self._walk(self.root, ()):
+            for s in supports:
+                tnode.by_supports.pop(s, None)
+        self._rebuild_index()
+        return
+
+    def _find(self, path: typing.Sequence) -> _TrieNode | None:
+        """ return trie node at exact path, or None """
+        return self.by_path.get(tuple(path))
+
+    def _locate(self, path: tuple) -> _TrieNode:
+        """ return the deepest trie node along path """
+        tnode = self.by_path.get(path)
+        if tnode is None:  # path goes beyond the registry, descend as far as possible
+            tnode = self.root
+            for segment in path:
+                child = tnode.children.get(segment)
+                if child is None:
+                    break
+                tnode = child
+        return tnode
+
+    def _ensure_path(self, path: tuple) -> _TrieNode:
+        """ return trie node at path, creating missing trie nodes """
+        tnode = self.by_path.get(path)
+        if tnode is None:
+            tnode = self.root
+            for segment in path:
+                child = tnode.children.get(segment)
+                if child is None:
+                    child = tnode.children[segment] = _TrieNode(tnode)
+                    self.by_path[path[:child.depth]] = child
+                tnode = child
+        return tnode
+
+    def _walk(self, tnode: _TrieNode, path: tuple) -> typing.Iterator[tuple[tuple, _TrieNode]]:
+        """ lazily yield (path, trie node) for tnode and all its descendants, depth first """
+        stack = [(path, tnode)]
+        while stack:
+            path, tnode = stack.pop()
+            yield path, tnode
+            stack.extend((path+(segment,), child) for segment, child in tnode.children.items())
+        return
+
+    def _reindex(self, tnode: _TrieNode, index_key: IndexKey):
+        """ update the nearest-ancestor index for index_key after qualification of tnode has changed.
+            Descendants qualifying themselves shadow tnode, so their subtrees are skipped.
+        """
+        if tnode.qualifies(*index_key):
+            target = tnode
+        else:
+            target = tnode.parent.nearest.get(index_key) if tnode.parent else None
+        stack = [tnode]
+        while stack:
+            t = stack.pop()
+            if t is not tnode and t.qualifies(*index_key):
+                continue
+            if target:
+                t.nearest[index_key] = target
+            else:
+                t.nearest.pop(index_key, None)
+            stack.extend(t.children.values())
+        return
+
+    def _rebuild_index(self):
+        """ rebuild the complete nearest-ancestor index top-down """
+        for path, tnode in self._walk(self.root, ()):
+            tnode.nearest = dict(tnode.parent.nearest) if tnode.parent else {}
+            tnode.nearest.update({ik: tnode for ik in self.IndexKeys if tnode.qualifies(*ik)})
         return
 
     def __setitem__(self, key: keys.DDHkey, node: nodes.NodeOrProxy):
-        """ Store the node, with a reference per NodeSupports """
+        """ Store the node, with a reference per NodeSupports, and update the index. """
         node.key = key
         proxy = node.get_proxy()
-        by_supports = self.nodes_by_key.setdefault(key.key, {})
+        tnode = self._ensure_path(key.key)
+        before = {ik for ik in self.IndexKeys if tnode.qualifies(*ik)}
         for s in proxy.supports:
-            by_supports[s] = proxy
+            tnode.by_supports[s] = proxy
+        after = {ik for ik in self.IndexKeys if tnode.qualifies(*ik)}
+        for ik in before ^ after:  # only qualification changes need to be propagated
+            self._reindex(tnode, ik)
+        if self.journal and isinstance(proxy, nodes.NodeProxy):
+            self.journal.append(self._to_record(key.key, proxy, proxy.supports))
+            if self.journal.log_records >= self.SnapshotAfter:  # fold log in the background, not in this request
+                self.journal.start_snapshot()
+        return
+
+    @classmethod
+    def _supports_mask(cls, supports: typing.Iterable[nodes.NodeSupports]) -> int:
+        return sum(cls.SupportsBits[s] for s in set(supports))
+
+    @classmethod
+    def _supports_from_mask(cls, mask: int) -> set[nodes.NodeSupports]:
+        return {s for s, bit in cls.SupportsBits.items() if mask & bit}
+
+    def _to_record(self, path: tuple, proxy: nodes.NodeProxy, registered: typing.Iterable[nodes.NodeSupports]) -> registry_journal.Record:
+        return registry_journal.Record(registry_journal.encode_path(path, keys.DDHkey.Root), self._supports_mask(registered),
+                                       self._supports_mask(proxy.supports), proxy.classname, proxy.id, proxy.owner_id)
+
+    def recover(self, journal: registry_journal.RegistryJournal):
+        """ Load the persistable nodes from the snapshot and log of journal, and record further changes in it.
+            Records are replayed directly into the trie, the index is built once at the end.
+        """
+        for record in journal.recover():
+            proxy = nodes.NodeProxy(supports=self._supports_from_mask(record.supports), id=record.id,
+                                    classname=record.classname, owner_id=record.owner_id)
+            tnode = self._ensure_path(registry_journal.decode_path(record.path, keys.DDHkey.Root))
+            for s in self._supports_from_mask(record.registered):
+                tnode.by_supports[s] = proxy
+        self._rebuild_index()
+        self.journal = journal
+        if journal.log_records >= self.SnapshotAfter:  # don't replay a long log again on the next start
+            self.write_snapshot()
+        return
+
+    def write_snapshot(self):
+        """ write all persistable nodes to a new snapshot of the journal, which also resets its log """
+        assert self.journal, 'recover() from a journal first'
+        self.journal.write_snapshot(self._iter_records())
+        return
+
+    def _iter_records(self) -> typing.Iterator[registry_journal.Record]:
+        """ one record per distinct NodeProxy per trie node, with the supports it is registered for """
+        for path, tnode in self._walk(self.root, ()):
+            registered: dict[int, tuple[nodes.NodeProxy, list[nodes.NodeSupports]]] = {}
+            for s, proxy in tnode.by_supports.items():
+                if isinstance(proxy, nodes.NodeProxy):
+                    registered.setdefault(id(proxy), (proxy, []))[1].append(s)
+            for proxy, supports in registered.values():
+                yield self._to_record(path, proxy, supports)
+        return
+
+    def close_journal(self, snapshot: bool = False):
+        """ close journal, after writing a snapshot if requested, so the next recovery replays no log """
+        if self.journal:
+            if snapshot:
+                self.write_snapshot()
+            self.journal.close()
+            self.journal = None
         return
 
     def check_and_set(self, key: keys.DDHkey, node: nodes.NodeOrProxy) -> bool:
         """ Conditional store, do nothing if already stored under some support.
             Return True if newly inserted.
         """
-        if (inserted := key not in self.nodes_by_key):
+        if (inserted := not self[key]):
             self.__setitem__(key, node)
         return inserted
 
     def __getitem__(self, key: keys.DDHkey) -> dict[nodes.NodeSupports, persistable.PersistableProxy]:
-        return self.nodes_by_key.get(key.key, {})
+        tnode = self._find(key.key)
+        return tnode.by_supports if tnode else {}
 
-    def get_next_proxy(self, key: keys.DDHkey | None, support: nodes.NodeSupports) -> typing.Iterator[typing.Tuple[nodes.NodeOrProxy, int]]:
+    def get_next_proxy(self, key: keys.DDHkey | None, support: nodes.NodeSupports, with_consents: bool = False) -> typing.Iterator[typing.Tuple[nodes.NodeOrProxy, int]]:
         """ Generator getting next node walking up the tree from key.
             Also indicates at which point the keys.DDHkey is to be split so the first part is the
             path leading to the Node, the 2nd the rest.
+
+            If with_consents, only nodes carrying consents are returned.
+            The walk follows the nearest-ancestor index, so only matching nodes are visited.
             """
-        split = len(key.key)  # where to split: counting backwards from the end.
-        while key:
-            by_supports = self[key]
-            key = key.up()
-            split -= 1
-            nop = by_supports.get(support)  # required support?
-            if nop:
-                yield nop, split+1
-        else:
-            return
+        index_key = (support, with_consents)
+        tnode = self._locate(key.key).nearest.get(index_key) if key else None
+        while tnode and tnode.depth:
+            yield tnode.by_supports[support], tnode.depth
+            tnode = tnode.parent.nearest.get(index_key) if tnode.parent else None
+        return
 
-    def get_proxy(self, key: keys.DDHkey, support: nodes.NodeSupports) -> typing.Tuple[nodes.NodeOrProxy | None, int]:
+    def get_proxy(self, key: keys.DDHkey, support: nodes.NodeSupports, with_consents: bool = False) -> typing.Tuple[nodes.NodeOrProxy | None, int]:
         """ get closest (upward-bound) node which has nonzero attribute """
-        nop, split = next(((node, split) for node, split in self.get_next_proxy(key, support)), (None, -1))
+        nop, split = next(self.get_next_proxy(key, support, with_consents), (None, -1))
         return nop, split
 
     def get_node(self, key: keys.DDHkey, support: nodes.NodeSupports, transaction: transactions.Transaction,
-                 condition: typing.Callable | None = None) -> typing.Tuple[nodes.Node | None, int]:
+                 condition: typing.Callable | None = None, with_consents: bool = False) -> typing.Tuple[nodes.Node | None, int]:
         """ get a node that supports support, walking up the tree.
             ProxyNodes are loaded.
+            If with_consents, the closest Node carrying consents is returned directly from the index.
             If the Node doesn't meet condition, the search goes up the tree looking for a Node.
 
 
             TODO:#33: Eventually, all calls must be async.
         """
-        nop, split = self.get_proxy(key, support)
-        if nop:
+        for nop, split in self.get_next_proxy(key, support, with_consents):
             node = nop
             assert isinstance(node, nodes.Node)  # searchable Persistable must be Node
-            if condition and not condition(node):  # apply condition to loaded Node
-                key = key.up()  # go one up and recurse
-                if key:
-                    node, split = self.get_node(key, support, transaction, condition=condition)
-                    split -= 1
-                else:
-                    return (None, -1)
-        else:
-            node = None
-
-        return node, split
+            if condition is None or condition(node):  # apply condition to loaded Node
+                return node, split
+        return (None, -1)
 
     async def get_node_async(self, key: keys.DDHkey, support: nodes.NodeSupports, transaction: transactions.Transaction,
-                             condition: typing.Callable | None = None) -> typing.Tuple[nodes.Node | None, int]:
+                             condition: typing.Callable | None = None, with_consents: bool = False) -> typing.Tuple[nodes.Node | None, int]:
         """ get a node that supports support, walking up the tree.
             ProxyNodes are loaded.
+            If with_consents, the closest Node carrying consents is returned directly from the index.
             If the Node doesn't meet condition, the search goes up the tree looking for a Node.
         """
-        nop, split = self.get_proxy(key, support)
-        if nop:
+        for nop, split in self.get_next_proxy(key, support, with_consents):
             node = await nop.ensure_loaded(transaction)
             assert isinstance(node, nodes.Node)  # searchable Persistable must be Node
-            if condition and not condition(node):  # apply condition to loaded Node
-                key = key.up()  # go one up and recurse
-                if key:
-                    node, split = await self.get_node_async(key, support, transaction, condition=condition)
-                    split -= 1
-                else:
-                    return (None, -1)
-        else:
-            node = None
-
-        return node, split
+            if condition is None or condition(node):  # apply condition to loaded Node
+                return node, split
+        return (None, -1)
 
     @staticmethod
     def _get_consent_node(ddhkey: keys.DDHkey, support: nodes.NodeSupports, node: nodes.Node | None, transaction: transactions.Transaction) -> nodes.Node | None:
@@ -133,8 +292,7 @@ class _NodeRegistry:
         if node and node.has_consents():
             cnode = node
         else:
-            cnode, d = NodeRegistry.get_node(
-                ddhkey, support, transaction, condition=nodes.Node.has_consents)
+            cnode, d = NodeRegistry.get_node(ddhkey, support, transaction, with_consents=True)
             if not cnode:  # means that upper nodes don't have consent
                 cnode = node
         return cnode
@@ -145,19 +303,28 @@ class _NodeRegistry:
         if node and node.has_consents():
             cnode = node
         else:
-            cnode, d = await NodeRegistry.get_node_async(
-                ddhkey, support, transaction, condition=nodes.Node.has_consents)
+            cnode, d = await NodeRegistry.get_node_async(ddhkey, support, transaction, with_consents=True)
             if not cnode:  # means that upper nodes don't have consent
                 cnode = node
         return cnode
 
+    def iter_keys_with_prefix(self, prefix: keys.DDHkey) -> typing.Iterator[tuple]:
+        """ lazily yield all keys that match prefix and have a node, as key tuples, including prefix itself """
+        tnode = self._find(prefix.key)
+        if tnode:
+            yield from (path for path, t in self._walk(tnode, prefix.key) if t.by_supports)
+        return
+
     def get_keys_with_prefix(self, prefix: keys.DDHkey) -> tuple[tuple, ...]:
         """ get all keys that match prefix, as a tuple of key tuples; serves as input to get_nodes_from_keys """
-        return utils.filter_prefix(prefix.key, self.nodes_by_key.keys())
-
-    async def get_nodes_from_tuple_keys(self, node_keys: typing.Sequence[typing.Sequence], support: nodes.NodeSupports, transaction: transactions.Transaction) -> list[nodes.Node]:
-        """ for all keys (as tuples from .get_keys_with_prefix()) that have support, load and return their nodes. """
-        return [await node_proxy.ensure_loaded(transaction) for nk in node_keys if (node_proxy := self.nodes_by_key[nk].get(support.value, None))]
+        return tuple(self.iter_keys_with_prefix(prefix))
 
+    async def get_nodes_from_tuple_keys(self, node_keys: typing.Iterable[typing.Sequence], support: nodes.NodeSupports, transaction: transactions.Transaction, fan_out: int | None = None) -> list[nodes.Node]:
+        """ for all keys (as tuples from .get_keys_with_prefix()) that have support, load and return their nodes.
+            Up to fan_out (default .LoadFanOut) nodes are loaded concurrently, the result is in order of node_keys.
+        """
+        return await utils.gather_limited([node_proxy.ensure_loaded(transaction) for nk in node_keys
+                                           if (tnode := self._find(nk)) and (node_proxy := tnode.by_supports.get(support, None))],
+                                          fan_out or self.LoadFanOut)
 
 NodeRegistry = _NodeRegistry()
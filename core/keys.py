@@ -2,6 +2,7 @@
 
 import typing
 import enum
+import weakref
 import pydantic
 
 # from pydantic.errors import PydanticErrorMixin
@@ -55,9 +56,39 @@ def variant_with_default(v: str | None) -> VariantType:
     return VariantType(v) if v else DefaultVariant
 
 
-class DDHkey(DDHbaseModel):
+class _InterningModelMetaclass(type(DDHbaseModel)):
+    """ Metaclass interning DDHkeys: constructing a key returns the one shared instance of an equal key.
+
+        Keys are looked up first by their constructor arguments, so repeated constructions skip parsing and
+        validation, and then by value, so keys built from different arguments are still the same instance.
+        Both tables are weak, keys disappear with their last user.
+        Keys created by Pydantic validation (e.g., from JSON) are not interned, but compare equal.
+    """
+    _ByArgs: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+    _ByValue: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    def __call__(cls, *a, **kw):
+        try:
+            args = (cls, a, tuple(kw.items()))
+            key = cls._ByArgs.get(args)
+        except TypeError:  # unhashable argument, such as a list
+            args = key = None
+        if key is None:
+            key = super().__call__(*a, **kw)
+            key = cls._ByValue.setdefault((cls, key.key, key.specifiers), key)
+            if args:
+                cls._ByArgs[args] = key
+        return key
+
+
+class DDHkey(DDHbaseModel, metaclass=_InterningModelMetaclass):
     """ A key identifying a DDH resource. DDHkey is decoupled from any permissions, storage, etc.,
+
+        DDHkeys are immutable and interned (see _InterningModelMetaclass); the hash and str
+        representation as well as derived keys are computed once per instance.
     """
+    model_config = pydantic.ConfigDict(frozen=True)
+
     key: tuple
     fork: ForkType = ForkType.data
     variant: VariantType = DefaultVariant
@@ -72,6 +103,10 @@ class DDHkey(DDHbaseModel):
     Specifier_types: typing.ClassVar[list] = [ForkType.make_with_default,
                                               variant_with_default, versions.make_version_or_constraint]
 
+    _hash: int | None = None  # cached hash
+    _str: str | None = None  # cached str
+    _derived: dict = pydantic.PrivateAttr(default_factory=dict)  # memoized derived keys, by method and arguments
+
     def dict(self, **kw):
         """ We want a short representation """
         return {'key': str(self)}
@@ -136,7 +171,16 @@ class DDHkey(DDHbaseModel):
         return (self.fork, self.variant, self.version)
 
     def __hash__(self):
-        return hash((self.key)+self.specifiers)
+        if (h := self._hash) is None:
+            h = self._hash = hash((self.key)+self.specifiers)
+        return h
+
+    def _memo(self, derivation: typing.Hashable, make: typing.Callable[[], typing.Any]):
+        """ return memoized derived key, calling make() to obtain it the first time """
+        d = self._derived
+        if (r := d.get(derivation)) is None:
+            r = d[derivation] = make()
+        return r
 
     def __eq__(self, other):
         if isinstance(other, DDHkey):
@@ -146,10 +190,12 @@ class DDHkey(DDHbaseModel):
 
     def __str__(self) -> str:
         """ str representation, omitting defaults and truncating trailing ':' """
-        s = self.Delimiter.join(map(str, self.key))
-        specs = ['' if s == d else str(s) for s, d in zip(self.specifiers, Default_specifiers)]
-        p = self.SpecDelimiter+self.SpecDelimiter.join(specs)
-        return s+p.rstrip(self.SpecDelimiter)
+        if (r := self._str) is None:
+            s = self.Delimiter.join(map(str, self.key))
+            specs = ['' if s == d else str(s) for s, d in zip(self.specifiers, Default_specifiers)]
+            p = self.SpecDelimiter+self.SpecDelimiter.join(specs)
+            r = self._str = s+p.rstrip(self.SpecDelimiter)
+        return r
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}({self.__str__()})'
@@ -179,6 +225,9 @@ class DDHkey(DDHbaseModel):
         """ return key up one level; if a top, bool(key) is False
             If retain_specifiers is True, specifiers and __class__ are retained.
         """
+        return self._memo(('up', retain_specifiers), lambda: self._up(retain_specifiers))
+
+    def _up(self, retain_specifiers: bool) -> DDHkey:
         upkey = self.key[:-1]
         if retain_specifiers:
             cls = self.__class__
@@ -202,7 +251,7 @@ class DDHkey(DDHbaseModel):
     def ensure_rooted(self) -> DDHkey:
         """ return a DDHkey that is rooted """
         if len(self.key) < 1 or self.key[0] != self.Root:
-            return self.__class__((self.Root,)+self.key, specifiers=self.specifiers)
+            return self._memo('ensure_rooted', lambda: self.__class__((self.Root,)+self.key, specifiers=self.specifiers))
         else:
             return self
 
@@ -215,10 +264,13 @@ class DDHkey(DDHbaseModel):
 
     def ens(self) -> typing.Self:
         """ enusre key is a valid schema key - shortcut for without_owner().ensure_fork(schema) """
-        return self.without_owner().ensure_fork(ForkType.schema)
+        return self._memo('ens', lambda: self.without_owner().ensure_fork(ForkType.schema))
 
     def without_owner(self) -> DDHkey:
         """ return key without owner """
+        return self._memo('without_owner', self._without_owner)
+
+    def _without_owner(self) -> DDHkey:
         rooted_key = self.ensure_rooted()
         if len(rooted_key.key) > 1 and rooted_key.key != self.AnyKey:
             return self.__class__((self.Root, self.AnyKey)+rooted_key.key[2:], specifiers=rooted_key.specifiers)
@@ -243,15 +295,17 @@ class DDHkey(DDHbaseModel):
             k = self
         elif self.version == versions.Unspecified and self.variant == DefaultVariant:
             # Key is actually generic, but we cannot change class for Pydantic objects, so must recreate:
-            k = DDHkeyGeneric(self.key, fork=self.fork, variant=DefaultVariant, version=versions.Unspecified)
+            k = self._memo('without_variant_version', lambda: DDHkeyGeneric(
+                self.key, fork=self.fork, variant=DefaultVariant, version=versions.Unspecified))
         else:
-            k = DDHkeyGeneric(self.key, fork=self.fork, variant=DefaultVariant, version=versions.Unspecified)
+            k = self._memo('without_variant_version', lambda: DDHkeyGeneric(
+                self.key, fork=self.fork, variant=DefaultVariant, version=versions.Unspecified))
         return k
 
     def for_consent_grants(self) -> DDHkeyGeneric:
         """ return key for the consent grants, i.e., not a consent fork, and without versions and variants """
         if self.fork is ForkType.consents:
-            return DDHkeyGeneric(key=self.key)
+            return self._memo('for_consent_grants', lambda: DDHkeyGeneric(key=self.key))
         else:
             return self.without_variant_version()
 
@@ -276,11 +330,12 @@ class DDHkey(DDHbaseModel):
         else:
             return ()
 
-    def longest_segments(self) -> typing.Generator[DDHkey, None, None]:
-        """ Generator yielding sucessively shorter subkeys
-            specifiers are not copied. Keys are  only built as needed.
+    def longest_segments(self) -> typing.Iterator[DDHkey]:
+        """ Iterator yielding sucessively shorter subkeys
+            specifiers are not copied. Keys are built once per key and then memoized.
         """
-        return (DDHkey(self.key[:i]) for i in range(len(self.key), -1, -1))  # count downward from end to 0
+        return iter(self._memo('longest_segments', lambda: tuple(
+            DDHkey(self.key[:i]) for i in range(len(self.key), -1, -1))))  # count downward from end to 0
 
     def __add__(self, a: DDHkey | tuple | str) -> typing.Self:
         """ Add a further segment, creating a new key """
@@ -378,7 +433,7 @@ class DDHkeyVersioned0(DDHkeyVersioned):
     def __init__(self, *a, **kw):
         DDHkey.__init__(self, *a, **kw)
         if (not isinstance(self.version, versions.Version)) or self.version == versions.Unspecified:
-            self.version = versions.Version(0)
+            self.__dict__['version'] = versions.Version(0)  # key is frozen, but not yet interned
         return
 
     def __hash__(self):
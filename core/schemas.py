@@ -196,6 +196,7 @@ class AbstractSchema(DDHbaseModel, abc.ABC, typing.Iterable):
     schema_attributes: SchemaAttributes = pydantic.Field(
         default=SchemaAttributes(), description="Attributes associated with this Schema")
     mimetypes: typing.ClassVar[MimeTypes | None] = None
+    validates_raw: typing.ClassVar[bool] = False  # .validate_data() accepts unparsed JSON
     _w_container: weakref.ReferenceType[SchemaContainer] | None = None
 
     def __init__(self, *a, **kw):
@@ -392,6 +393,10 @@ class AbstractSchema(DDHbaseModel, abc.ABC, typing.Iterable):
     def _add_fields(self, fields: dict):
         raise NotImplementedError('Field adding not supported in this schema')
 
+    def validate_schema(self, no_extra: bool = True):
+        """ validate schema when it is registered, and prepare it for validating data """
+        return
+
     @staticmethod
     def get_schema_consents() -> permissions.Consents:
         """ Schema world read access consents """
@@ -490,6 +495,7 @@ class SchemaContainer(DDHbaseModel):
             self.subscribable = sbv[versions.Unspecified].schema_attributes.subscribable
         SchemaNetwork.add_schema(key, schema.schema_attributes)
         schema._w_container = weakref.ref(self)  # keep a ref to the container
+        schema.validate_schema()
         return schema
 
     def get(self, variant: SchemaVariant = '', version: versions.Version = versions.Unspecified) -> AbstractSchema | None:
@@ -3,6 +3,7 @@
 """
 
 
+import pydantic
 import pydantic.json
 import logging
 
@@ -14,6 +15,12 @@ from backend import storage
 
 
 class StorageResource(dapp_proxy.DAppResource):
+    """ Storage DApp as a transaction resource. Stores and deletes are buffered and sent to the DApp
+        in one batch in the prepare phase of the transaction commit; loads see the buffered writes.
+    """
+
+    _pending: dict[common_ids.PersistId, bytes | None] = pydantic.PrivateAttr(
+        default_factory=dict)  # buffered writes, None deletes
 
     @property
     def id(self) -> str:
@@ -24,20 +31,64 @@ class StorageResource(dapp_proxy.DAppResource):
         else:
             return '?'  # 'InProcessStorageResource'
 
-    async def load(self, key: str, trx: transactions.Transaction) -> bytes:
+    @staticmethod
+    def raise_if_read_only(trx: transactions.Transaction):
+        if trx.read_only:
+            raise transactions.TrxAccessError(f'cannot write in read-only {trx}')
+
+    def _url(self, path: str, trx: transactions.Transaction) -> str:
+        """ a read-only trx reads committed data without transaction state in the DApp """
+        return path if trx.read_only else f'{path}?trxid={trx.trxid}'
+
+    async def load(self, key: common_ids.PersistId, trx: transactions.Transaction) -> bytes:
+        """ load from DApp """
         assert self.dapp
-        d = await self.dapp.send_url(f'/storage/{key}?trxid={trx.trxid}', verb='get', jwt=trx.user_token)
+        if key in self._pending:
+            if (data := self._pending[key]) is None:
+                raise errors.NotFound(f'{key=} not found').to_http()
+            return data
+        d = await self.dapp.send_url(self._url(f'/storage/{key}', trx), verb='get', jwt=trx.user_token, raw=True)
         return d
 
-    async def store(self, key: str, data: bytes, trx: transactions.Transaction):
+    async def load_many(self, keys: list[common_ids.PersistId], trx: transactions.Transaction) -> list[bytes | None]:
+        """ load keys with one request, None for keys not found """
         assert self.dapp
-        d = await self.dapp.send_url(f'/storage/{key}?trxid={trx.trxid}', content=data, headers={'Content-Type': 'data/binary'}, verb='put', jwt=trx.user_token)
-        return d
+        found = {key: data for key in keys if key in self._pending and (data := self._pending[key]) is not None}
+        if to_load := [key for key in keys if key not in self._pending]:
+            d = await self.dapp.send_url(self._url('/storage-batch/load', trx), json=to_load, verb='post', jwt=trx.user_token, raw=True)
+            found.update(storage.unpack_blobs(d))
+        return [found.get(key) for key in keys]
+
+    async def store(self, key: common_ids.PersistId, data: bytes, trx: transactions.Transaction):
+        self.raise_if_read_only(trx)
+        self._pending[key] = data
+        return
+
+    async def delete(self, key: common_ids.PersistId, trx: transactions.Transaction):
+        self.raise_if_read_only(trx)
+        self._pending[key] = None
+        return
 
-    async def delete(self, key: str, trx: transactions.Transaction):
+    async def store_many(self, writes: dict[common_ids.PersistId, bytes | None], trx: transactions.Transaction):
+        """ send writes with one request; None deletes """
         assert self.dapp
-        d = await self.dapp.send_url(f'/storage/{key}?trxid={trx.trxid}', verb='delete', jwt=trx.user_token)
-        return d
+        self.raise_if_read_only(trx)
+        if writes:
+            await self.dapp.send_url(f'/storage-batch/write?trxid={trx.trxid}', content=storage.pack_blobs(writes.items()),
+                                     headers={'Content-Type': 'application/octet-stream'}, verb='post', jwt=trx.user_token)
+        return
+
+    async def prepare(self, trx: transactions.Transaction):
+        """ flush buffered writes, then prepare """
+        pending, self._pending = self._pending, {}
+        await self.store_many(pending, trx)
+        await super().prepare(trx)
+        return
+
+    async def abort(self, trx: transactions.Transaction):
+        self._pending.clear()
+        await super().abort(trx)
+        return
 
 
 class InProcessStorageResource(StorageResource):
@@ -49,6 +100,9 @@ class InProcessStorageResource(StorageResource):
     async def begin(self, trx: transactions.Transaction):
         return
 
+    async def prepare(self, trx: transactions.Transaction):
+        return
+
     async def commit(self, trx: transactions.Transaction):
         return
 
@@ -63,3 +117,10 @@ class InProcessStorageResource(StorageResource):
 
     async def delete(self, key: common_ids.PersistId, trx: transactions.Transaction):
         return storage.Storage.delete(key, trx)
+
+    async def load_many(self, keys: list[common_ids.PersistId], trx: transactions.Transaction) -> list[bytes | None]:
+        return [storage.Storage.load(key, trx) if key in storage.Storage else None for key in keys]
+
+    async def store_many(self, writes: dict[common_ids.PersistId, bytes | None], trx: transactions.Transaction):
+        await storage.Storage.commit_writes(writes, trx)
+        return
@@ -15,11 +15,23 @@ from utils.pydantic_utils import DDHbaseModel, CV
 from core import permissions, errors, principals, common_ids
 
 import secrets
+import heapq
+import itertools
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
 
 
 class TrxAccessError(errors.AccessError): ...
 class SessionReinitRequired(TrxAccessError): ...
 class TrxOpenError(errors.DDHerror): ...
+class TrxCommitError(errors.DDHerror): ...
+
+
+class TrxLimitExceeded(errors.DDHerror):
+    """ too many open transactions, retry later """
+    http_status = 503
 
 
 class TrxExtension(DDHbaseModel):
@@ -52,6 +64,10 @@ class TrxExtension(DDHbaseModel):
         """ Can be used to modify TrxExt when passed from a previous Trx """
         pass
 
+    def after_commit(self):
+        """ Called once all actions and resources of the Trx are committed """
+        pass
+
 
 class Transaction(DDHbaseModel):
     TrxExtensions: CV[list[type[TrxExtension]]] = []
@@ -69,10 +85,18 @@ class Transaction(DDHbaseModel):
         default_factory=dict, description="dict of resources coordinated")
 
     trx_local: dict = pydantic.Field(default_factory=dict, description="dict for storage local to transactionn")
+    write_set: dict[typing.Hashable, Action] = pydantic.Field(
+        default_factory=dict, description="pending actions by .coalesce_key(), so repeated writes are coalesced")
+    coalesced_writes: int = 0
+    read_only: bool = pydantic.Field(
+        default=False, description="resources are not begun nor committed, only actions with .read_only_ok may be added")
+    _resource_lock: asyncio.Lock = pydantic.PrivateAttr(default_factory=asyncio.Lock)
 
     Transactions: typing.ClassVar[dict[common_ids.TrxId, Transaction]] = {}
     TTL: typing.ClassVar[datetime.timedelta] = datetime.timedelta(
         seconds=120)  # max duration of a transaction in seconds (high for debugging)
+    PhaseTimeout: typing.ClassVar[float] = 10.0  # max seconds for each phase of the two-phase commit
+    CoalescedWritesTotal: typing.ClassVar[int] = 0  # over all transactions, for observability
 
     @classmethod
     def create(cls, owner: principals.Principal, user_token: str | None = None, **kw) -> Transaction:
@@ -114,9 +138,15 @@ class Transaction(DDHbaseModel):
             raise error(trxid).to_http()
 
     def begin(self):
-        """ begin this transaction """
+        """ begin this transaction; a new one is refused if there are TransactionReaper.MaxTransactions """
+        if self.trxid not in self.Transactions and len(self.Transactions) >= Reaper.MaxTransactions:
+            Reaper.start()
+            if Reaper.wakeup:  # make room by reaping expired transactions
+                Reaper.wakeup.set()
+            raise TrxLimitExceeded(f'{len(self.Transactions)} open transactions, retry later')
         self.Transactions[self.trxid] = self
         self.exp = datetime.datetime.now() + self.TTL
+        Reaper.schedule(self)
         return
 
     def end(self):
@@ -127,22 +157,59 @@ class Transaction(DDHbaseModel):
         return
 
     async def commit(self):
-        """ commit a transaction by committing all actions """
-        for action in self.actions:
+        """ commit a transaction: perform all actions, then two-phase commit all resources.
+            Each phase runs on all resources concurrently, within PhaseTimeout. If a resource fails to prepare,
+            all resources and the actions performed are rolled back and TrxCommitError is raised.
+        """
+        actions = list(self.actions)
+        for action in actions:
             await action.commit(self)
         self.actions.clear()
-        for resource in self.resources.values():
-            await resource.commit(self)
+        self.write_set.clear()
+        resources = list(self.resources.values()) if not self.read_only else []  # read-only resources hold no state
         self.resources.clear()
+        if failed := await self._run_phase('prepare', resources):
+            await self._run_phase('rollback', [*resources, *actions])
+            raise TrxCommitError(f'{self}: prepare failed, rolled back: {failed}')
+        if failed := await self._run_phase('commit', resources):  # decision is taken, we cannot roll back any more
+            raise TrxCommitError(f'{self}: commit failed for {failed}')
+        for ext in self.trx_ext.values():
+            ext.after_commit()
         return
 
+    async def prepare(self):
+        """ phase one of a two-phase commit coordinated by another process: verify we can commit """
+        self.use()
+        if failed := await self._run_phase('prepare', [*self.actions, *self.resources.values()]):
+            raise TrxCommitError(f'{self}: prepare failed: {failed}')
+        return
+
+    async def _run_phase(self, phase: str, participants: list[Action]) -> dict[str, str]:
+        """ call method phase on all participants concurrently, return failures in order of participants """
+        if not participants:
+            return {}
+        tasks = [asyncio.ensure_future(getattr(p, phase)(self)) for p in participants]
+        done, pending = await asyncio.wait(tasks, timeout=self.PhaseTimeout)
+        for task in pending:
+            task.cancel()
+        failed = {}
+        for p, task in zip(participants, tasks):
+            if task in pending:
+                failed[str(getattr(p, 'id', p))] = f'{phase} timed out'
+            elif task.exception():
+                failed[str(getattr(p, 'id', p))] = f'{phase} failed: {task.exception()!r}'
+        if failed:
+            logger.warning(f'{self}: {failed}')
+        return failed
+
     async def abort(self):
         for action in self.actions:
             await action.rollback(self)
         self.actions.clear()
-        for resource in self.resources.values():
-            await resource.rollback(self)
+        self.write_set.clear()
+        resources = list(self.resources.values()) if not self.read_only else []
         self.resources.clear()
+        await self._run_phase('rollback', resources)
         self.end()
 
     def __del__(self):
@@ -183,6 +250,11 @@ class Transaction(DDHbaseModel):
             raise TrxAccessError(f'Transaction has expired; {self.TTL=}')
         return self
 
+    def size_estimate(self) -> int:
+        """ rough estimate of bytes held by this transaction; payloads cached in trx_local dominate """
+        return (sys.getsizeof(self) + sys.getsizeof(self.trx_local) + sys.getsizeof(self.actions) + sys.getsizeof(self.resources)
+                + sum(len(v) for v in self.trx_local.values() if isinstance(v, (bytes, str))))
+
     def add_and_validate(self, access: permissions.Access):
         """ add an access and validate whether it is ok """
         if access.principal:
@@ -195,9 +267,25 @@ class Transaction(DDHbaseModel):
         return
 
     def add(self, action: Action):
-        """ Add action to this transaction """
+        """ Add action to this transaction.
+            If a pending action has the same .coalesce_key(), it is replaced by the coalesced action,
+            keeping its position, so the last state is written once at commit.
+        """
+        if self.read_only and not action.read_only_ok:
+            raise TrxAccessError(f'action {action.__class__.__name__} cannot be added to read-only {self}')
         if action.add_ok(self):
-            self.actions.append(action)
+            if (key := action.coalesce_key()) is not None:
+                previous = self.write_set.get(key)
+                i = next((i for i, a in enumerate(self.actions) if a is previous), None) if previous else None
+                if i is not None:
+                    action = self.actions[i] = action.coalesce(previous)
+                    self.coalesced_writes += 1
+                    Transaction.CoalescedWritesTotal += 1
+                else:
+                    self.actions.append(action)
+                self.write_set[key] = action
+            else:
+                self.actions.append(action)
             action.added(self)
         else:
             raise TrxAccessError(f'action {action} cannot be added to {self}')
@@ -206,10 +294,31 @@ class Transaction(DDHbaseModel):
         """ Add action to this transaction """
         if resource.add_ok(self):
             self.resources[resource.id] = resource
-            await resource.added(self)
+            if not self.read_only:  # read-only resources are not begun
+                await resource.added(self)
         else:
             raise TrxAccessError(f'action {resource} cannot be added to {self}')
 
+    def make_writable(self):
+        """ Turn a read-only transaction into a writable one. Its resources were never begun, so they are
+            dropped, to be added and begun again when used.
+        """
+        if self.read_only:
+            self.read_only = False
+            self.resources.clear()
+        return
+
+    async def get_or_add_resource(self, id: str, create: typing.Callable[[], Resource]) -> Resource:
+        """ Get resource by id, or create it and add it. Safe for concurrent callers, 
+            so a resource is added (and begun) only once. 
+        """
+        async with self._resource_lock:
+            resource = self.resources.get(id)
+            if not resource:
+                resource = create()
+                await self.add_resource(resource)
+        return resource
+
     @classmethod
     def get_or_create_transaction_with_id(cls, trxid: common_ids.TrxId, owner: principals.Principal) -> Transaction:
         """ If you need a cross-process trx with a trxid, use this method. """
@@ -224,9 +333,121 @@ class Transaction(DDHbaseModel):
         return trx
 
 
+class TransactionReaper:
+    """ Aborts and evicts expired transactions from Transaction.Transactions, in batches.
+        Transactions are kept in a heap ordered by expiry; entries of transactions that have ended or
+        were begun again are stale and skipped. Running transactions are never evicted; Transaction.begin()
+        refuses new transactions beyond MaxTransactions instead.
+        Runs as a background asyncio task, started by the first Transaction.begin() in a running loop.
+    """
+
+    Interval: typing.ClassVar[float] = 10.0  # seconds between reaping rounds
+    BatchSize: typing.ClassVar[int] = 100  # max transactions aborted concurrently
+    MaxTransactions: typing.ClassVar[int] = 10000
+
+    def __init__(self):
+        self.heap: list[tuple[datetime.datetime, int, common_ids.TrxId]] = []
+        self.counter = itertools.count()  # tie breaker, trxids are not ordered
+        self.task: asyncio.Task | None = None
+        self.wakeup: asyncio.Event | None = None
+        self.reaped = 0
+
+    def schedule(self, trx: Transaction):
+        """ record expiry of trx, start the reaper task if needed """
+        heapq.heappush(self.heap, (trx.exp, next(self.counter), trx.trxid))
+        if len(self.heap) > 2 * len(Transaction.Transactions) + self.BatchSize:  # mostly stale entries
+            self.compact()
+        self.start()
+        return
+
+    def compact(self):
+        """ drop stale heap entries """
+        self.heap = [e for e in self.heap if (t := Transaction.Transactions.get(e[2])) and t.exp == e[0]]
+        heapq.heapify(self.heap)
+        return
+
+    def start(self):
+        """ start reaper task unless running, if there is a running loop """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # no loop, reap() must be called explicitly
+        if self.task and not self.task.done() and self.task.get_loop() is loop:
+            return
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self.run())
+        return
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        return
+
+    async def run(self):
+        while True:
+            assert self.wakeup
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.Interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                while await self.reap():  # full batch, there may be more
+                    pass
+            except Exception as e:
+                logger.error(f'TransactionReaper: {e}')
+
+    def due(self, now: datetime.datetime) -> list[Transaction]:
+        """ pop up to BatchSize expired transactions """
+        trxs = []
+        while self.heap and len(trxs) < self.BatchSize:
+            exp, _, trxid = self.heap[0]
+            trx = Transaction.Transactions.get(trxid)
+            if trx is None or trx.exp != exp:  # stale entry
+                heapq.heappop(self.heap)
+            elif exp < now:
+                heapq.heappop(self.heap)
+                trxs.append(trx)
+            else:
+                break
+        return trxs
+
+    async def reap(self, now: datetime.datetime | None = None) -> int:
+        """ abort and evict one batch of transactions due, return their number """
+        trxs = self.due(now or datetime.datetime.now())
+        results = await asyncio.gather(*(trx.abort() for trx in trxs), return_exceptions=True)
+        for trx, r in zip(trxs, results):
+            if isinstance(r, BaseException):
+                logger.warning(f'TransactionReaper: abort of {trx} failed: {r}')
+            trx.actions.clear()
+            trx.write_set.clear()
+            trx.end()  # evict in any case
+        self.reaped += len(trxs)
+        return len(trxs)
+
+    def stats(self) -> dict[str, int]:
+        """ counts and bytes held by transactions """
+        return {
+            'transactions': len(Transaction.Transactions),
+            'heap_entries': len(self.heap),
+            'reaped': self.reaped,
+            'bytes': sum(trx.size_estimate() for trx in Transaction.Transactions.values()),
+        }
+
+
+Reaper = TransactionReaper()
+
+
 class Action(DDHbaseModel):
     """ actions for a transaction """
 
+    read_only_ok: CV[bool] = False  # may be added to a read-only transaction
+
     def added(self, trx: Transaction):
         """ Callback after transaction is added """
         return
@@ -235,6 +456,18 @@ class Action(DDHbaseModel):
         """ Callback to determine whether it is ok to add action to trx """
         return True
 
+    def coalesce_key(self) -> typing.Hashable | None:
+        """ Pending actions of a transaction with the same key are coalesced; None if never coalesced """
+        return None
+
+    def coalesce(self, previous: Action) -> Action:
+        """ Return action replacing previous pending action with the same .coalesce_key() """
+        return self
+
+    async def prepare(self, transaction):
+        """ prepare to commit, called in the first phase of transaction.commit(); raise an exception to veto. """
+        return
+
     async def commit(self, transaction):
         """ commit an action, called by transaction.commit() """
 
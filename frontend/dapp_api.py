@@ -4,6 +4,7 @@
     - Data App serving a User Interface
 """
 
+import contextlib
 import fastapi
 import fastapi.security
 import fastapi.responses
@@ -12,13 +13,27 @@ import pydantic
 import datetime
 import enum
 import io
+import os
+import json
 
 
 from core import pillars, schema_network
-from core import keys, permissions, schemas, facade, errors, principals, versions, dapp_proxy, dapp_attrs, pillars, users
+from core import keys, permissions, schemas, facade, errors, principals, versions, dapp_proxy, dapp_attrs, pillars, users, keydirectory
+from backend import registry_journal, keyvault
 from frontend import sessions
 
-app = fastapi.FastAPI()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    yield
+    keydirectory.NodeRegistry.close_journal(snapshot=True)  # next start maps the snapshot without replaying a log
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+if registry_dir := os.environ.get('DDH_REGISTRY_DIR'):  # durable NodeRegistry: recover by map-and-replay
+    keydirectory.NodeRegistry.recover(registry_journal.RegistryJournal(registry_dir))
+keyvault.KeypairPool.start()  # principal keys are generated ahead of use
 
 from frontend import user_auth  # provisional user management
 
@@ -67,12 +82,24 @@ async def get_data(
     return d
 
 
-@app.put("/ddh{docpath:path}")
+def json_body(body: bytes, content_type: str) -> bytes | str:
+    """ The body is passed raw to the schema for parsing and validation. A JSON string, i.e., JSON sent
+        JSON-encoded as by clients using json=model.model_dump_json(), is decoded, as FastAPI did for a Body parameter.
+    """
+    mimetype = content_type.split(';')[0].strip().lower()
+    if (mimetype == 'application/json' or mimetype.endswith('+json')) and body.lstrip()[:1] == b'"':
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise errors.ParseError(f'body is not valid JSON: {e}')
+    return body
+
+
+@app.put("/ddh{docpath:path}", openapi_extra={'requestBody': {
+    'required': True, 'description': 'The data in schema specific format, usually JSON', 'content': {'*/*': {'schema': {}}}}})
 async def put_data(
     response: fastapi.Response,
     request: fastapi.Request,
-    # data is not typed, but will be passed to the schema for parsing and conversion:
-    data: typing.Any = fastapi.Body(..., media_type="*/*", title="The data in schema specific format, usually JSON"),
     content_type: str = fastapi.Header(default='application/json'),
     docpath: str = fastapi.Path(..., title="The ddh key of the data to put"),
     session: sessions.Session = fastapi.Depends(user_auth.get_current_session),
@@ -83,8 +110,8 @@ async def put_data(
 ):
     access = permissions.Access(op=permissions.Operation.put, ddhkey=keys.DDHkey(
         docpath), principal=session.user, modes=modes, byDApp=session.dappid)
-    # data = await request.body()
     try:
+        data = json_body(await request.body(), content_type)
         d, headers = await facade.ddh_put(access, session, data,  request.query_params, content_type=content_type)
     except errors.DDHerror as e:
         raise e.to_http()
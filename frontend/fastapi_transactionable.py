@@ -22,6 +22,20 @@ async def trx_begin(
     return trx.trxid
 
 
+@router.post("/transaction/{trxid}/prepare")
+async def trx_prepare(
+    trxid: common_ids.TrxId,
+    session: sessions.Session = fastapi.Depends(user_auth.get_current_session),
+
+) -> common_ids.TrxId:
+    trx = transactions.Transaction.get_or_raise(trxid)
+    try:
+        await trx.prepare()
+    except (transactions.TrxCommitError, transactions.TrxAccessError) as e:
+        raise e.to_http()
+    return trx.trxid
+
+
 @router.post("/transaction/{trxid}/commit")
 async def trx_commit(
     trxid: common_ids.TrxId,
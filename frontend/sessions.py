@@ -24,24 +24,27 @@ class Session(DDHbaseModel):
         """ return id """
         return typing.cast(common_ids.SessionId, self.token_str)
 
-    def get_transaction(self, create=False) -> transactions.Transaction | None:
-        """ get existing trx or create new one
+    def get_transaction(self, create=False, read_only: bool = False) -> transactions.Transaction | None:
+        """ get existing trx or create new one.
+            A new trx is read_only if requested; an existing read-only trx is made writable unless read_only is requested.
         """
         trx = self.current_trx
         if trx:
+            if trx.read_only and not read_only:
+                trx.make_writable()
             return trx.use()
         elif create:
-            return self.create_transaction()
+            return self.create_transaction(read_only=read_only)
         else:
             return None
 
-    def get_or_create_transaction(self,) -> transactions.Transaction:
+    def get_or_create_transaction(self, read_only: bool = False) -> transactions.Transaction:
         """ always returns transaction, for easier type checking """
-        trx = self.get_transaction(create=True)
+        trx = self.get_transaction(create=True, read_only=read_only)
         assert trx
         return trx
 
-    def create_transaction(self, initial_trx_ext: dict = {}) -> transactions.Transaction:
+    def create_transaction(self, initial_trx_ext: dict = {}, read_only: bool = False) -> transactions.Transaction:
         """ create a new transaction. raises transactions.TrxOpenError if transaction exists (abort would make the whole thing async).
             TrxExtension dict can be passed from previous Trx. 
         """
@@ -49,7 +52,7 @@ class Session(DDHbaseModel):
             raise transactions.TrxOpenError('transaction exists, use session.ensure_new_transaction()')
         else:
             new_trx = transactions.Transaction.create(
-                owner=self.user, user_token=self.token_str, trx_ext=initial_trx_ext)
+                owner=self.user, user_token=self.token_str, trx_ext=initial_trx_ext, read_only=read_only)
             self.current_trx = new_trx
             return new_trx.use()
 
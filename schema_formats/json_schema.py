@@ -7,8 +7,10 @@ import functools
 import jsonschema
 import jsonschema.validators
 import jsonschema.exceptions
+import jsonschema.protocols
 
 from utils.pydantic_utils import CV
+from utils import utils
 
 # to overwrite jsonschema datetime format checker:
 import jsonschema._format
@@ -16,6 +18,7 @@ import datetime
 
 
 from core import schemas, keys, errors
+from . import json_schema_compiler
 
 
 class JsonSchemaElement(schemas.AbstractSchemaElement):
@@ -63,8 +66,12 @@ class JsonSchema(schemas.AbstractSchema):
     mimetypes: CV[schemas.MimeTypes] = schemas.MimeTypes(
         of_schema=['application/openapi', 'application/json'], of_data=['application/json'])
     json_schema: pydantic.Json
-    _v_validators: dict[keys.DDHkey, json_schema.validators.Validator] = {}  # Cache
-    _v_descend_cache: dict[tuple[keys.DDHkey | tuple, bool], dict | None] = {}
+    MaxCachedPaths: CV[int] = 256  # per schema, for each of the caches below
+    # compiled validators and descended sub-schemas by remainder, invalidated when the schema changes:
+    _v_validators: utils.LRUCache[json_schema_compiler.CompiledValidator] = pydantic.PrivateAttr(
+        default_factory=lambda: utils.LRUCache(JsonSchema.MaxCachedPaths))
+    _v_descend_cache: utils.LRUCache[dict | None] = pydantic.PrivateAttr(
+        default_factory=lambda: utils.LRUCache(JsonSchema.MaxCachedPaths))
 
     d_ref: CV[str] = '$ref'
     d_defs1: CV[str] = '$defs'
@@ -78,6 +85,20 @@ class JsonSchema(schemas.AbstractSchema):
         else:
             return JsonSchemaElement(definition=d)
 
+    def __setitem__(self, key: keys.DDHkey, value: type[schemas.AbstractSchemaElement], create_intermediate: bool = True) -> type[schemas.AbstractSchemaElement] | None:
+        parent = super().__setitem__(key, value, create_intermediate=create_intermediate)
+        self.invalidate_caches()
+        return parent
+
+    def invalidate_caches(self):
+        """ forget cached validators and sub-schemas, after the schema has changed """
+        self._v_validators.clear()
+        self._v_descend_cache.clear()
+        return
+
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        return {'validators': self._v_validators.stats(), 'descend': self._v_descend_cache.stats()}
+
     def __iter__(self) -> typing.Iterator[tuple[keys.DDHkey, JsonSchemaElement]]:
         # TODO: Schema Iterator
         return iter([])
@@ -100,11 +121,15 @@ class JsonSchema(schemas.AbstractSchema):
         return self.json_schema
 
     def descend_path(self, path: keys.DDHkey, create_intermediate: bool = False):
-        """ descend path with local cache """
-        v = self._v_descend_cache.get((path, create_intermediate), _empty_marker)
+        """ descend path with local cache; creating intermediate elements changes the schema """
+        if create_intermediate:
+            v = self._descend_path(path, create_intermediate=True)
+            self.invalidate_caches()
+            return v
+        v = self._v_descend_cache.get(path, _empty_marker)
         if v is _empty_marker:
-            v = self._descend_path(path, create_intermediate=create_intermediate)
-            self._v_descend_cache[(path, create_intermediate)] = v
+            v = self._descend_path(path)
+            self._v_descend_cache.put(path, v)
         return v
 
     def _descend_path(self, path: keys.DDHkey, create_intermediate: bool = False):
@@ -153,28 +178,31 @@ class JsonSchema(schemas.AbstractSchema):
         """ Validate data at subschema path remainder. 
             data is already parsed as dict. 
         """
+        self.get_validator(remainder).validate(data)
+        return data
 
-        print(f'{self.__class__.__name__}.validate_data({type(data)}, {remainder=}, {no_extra=})')
-        validator = self._v_validators.get(remainder)  # cached?
-        if not validator:
+    def get_validator(self, remainder: keys.DDHkey) -> json_schema_compiler.CompiledValidator:
+        """ compiled validator for subschema at remainder, cached """
+        validator = self._v_validators.get(remainder)
+        if validator is None:
             subs = self.descend_path(remainder)
             if not subs:
                 raise errors.NotFound(f'Path {remainder} is not in schema')
-            vcls = jsonschema.validators.validator_for(subs)  # find correct validator for schema.
-            validator = vcls(subs, format_checker=vcls.FORMAT_CHECKER)  # instantiate for subschema
-            self._v_validators[remainder] = validator  # cache it
-        error = jsonschema.exceptions.best_match(validator.iter_errors(data))
-        if error is not None:
-            raise error
-
-        return data
+            if remainder:  # $refs of the subschema refer to the $defs of the root
+                subs = {**subs, self.d_defs1: self.json_schema.get(self.d_defs1, {})}
+            validator = json_schema_compiler.CompiledValidator(subs)
+            self._v_validators.put(remainder, validator)
+        return validator
 
     def validate_schema(self, no_extra: bool = True):
-        """ validate and cache root schema """
+        """ validate root schema and warm the caches with the root and its top-level properties """
         vcls = jsonschema.validators.validator_for(self.json_schema)
         vcls.check_schema(self.json_schema)
-        validator = vcls(self.json_schema, format_checker=vcls.FORMAT_CHECKER)
-        self._v_validators[keys.DDHkey(())] = validator  # cache it
+        self.get_validator(keys.DDHkey(()))
+        for name in self.json_schema.get('properties', {}):
+            if self.descend_path(keys.DDHkey((name,))):
+                self.get_validator(keys.DDHkey((name,)))
+        return
 
     @classmethod
     def create_from_elements(cls, key: keys.DDHkey | tuple | str, **elements: typing.Mapping[str, tuple[type, typing.Any]]) -> dict:
@@ -0,0 +1,211 @@
+""" Compile JSON Schemas into Python validation functions.
+
+    The generic jsonschema validator interprets the schema for every instance it visits, which is slow
+    for large arrays. The compiler generates Python source with one function per (sub)schema, returning
+    whether an instance is valid; jsonschema is only used to report the error of an invalid instance.
+
+    Supported are the keywords generated for our schemas (types, properties, required, additionalProperties,
+    items, $defs/$ref, anyOf, allOf, enum, const, formats and the usual bounds). A schema using other keywords
+    raises Unsupported, and is validated by jsonschema only.
+"""
+
+import re
+import typing
+import logging
+
+import jsonschema.exceptions
+import jsonschema.protocols
+import jsonschema.validators
+
+logger = logging.getLogger(__name__)
+
+
+class Unsupported(Exception):
+    """ schema uses a keyword the compiler doesn't implement """
+
+
+_Types = {
+    'object': 'isinstance({x}, dict)',
+    'array': 'isinstance({x}, list)',
+    'string': 'isinstance({x}, str)',
+    'boolean': 'isinstance({x}, bool)',
+    'null': '{x} is None',
+    'number': '(isinstance({x}, (int, float)) and not isinstance({x}, bool))',
+    'integer': '((isinstance({x}, int) and not isinstance({x}, bool)) or (isinstance({x}, float) and {x}.is_integer()))',
+}
+
+_Annotations = {'title', 'description', 'default', 'examples', '$comment', 'deprecated', 'readOnly', 'writeOnly', '$schema'}
+
+_Bounds = {  # keyword: (guard, failing comparison)
+    'minimum': (_Types['number'], '{x} < {v}'),
+    'maximum': (_Types['number'], '{x} > {v}'),
+    'exclusiveMinimum': (_Types['number'], '{x} <= {v}'),
+    'exclusiveMaximum': (_Types['number'], '{x} >= {v}'),
+    'minLength': (_Types['string'], 'len({x}) < {v}'),
+    'maxLength': (_Types['string'], 'len({x}) > {v}'),
+    'minItems': (_Types['array'], 'len({x}) < {v}'),
+    'maxItems': (_Types['array'], 'len({x}) > {v}'),
+    'minProperties': (_Types['object'], 'len({x}) < {v}'),
+    'maxProperties': (_Types['object'], 'len({x}) > {v}'),
+}
+
+
+class Compiler:
+    """ Generates a module with a function per subschema of root; refs are resolved against root's $defs. """
+
+    DefsPrefix: typing.ClassVar[str] = '#/$defs/'
+
+    def __init__(self, root: dict, format_checker: jsonschema.FormatChecker | None = None):
+        self.root = root
+        self.format_checker = format_checker
+        self.functions: list[str] = []
+        self.refs: dict[str, str] = {}  # $ref -> function name
+        self.constants: dict[str, typing.Any] = {}
+
+    def compile(self, schema: dict) -> typing.Callable[[typing.Any], bool]:
+        """ return a function checking whether an instance is valid according to schema """
+        name = self._function(schema)
+        namespace = dict(self.constants)
+        exec('\n\n'.join(self.functions), namespace)
+        return namespace[name]
+
+    def source(self) -> str:
+        return '\n\n'.join(self.functions)
+
+    def _constant(self, value) -> str:
+        name = f'_c{len(self.constants)}'
+        self.constants[name] = value
+        return name
+
+    def _function(self, schema: dict | bool, name: str | None = None) -> str:
+        """ generate function for schema, return its name """
+        name = name or f'_v{len(self.functions)}'
+        index = len(self.functions)
+        self.functions.append('')  # reserve, so nested functions get their own names
+        lines = [f'def {name}(x):']
+        lines += ['    ' + line for line in self._checks(schema, 'x')]
+        lines.append('    return True')
+        self.functions[index] = '\n'.join(lines)
+        return name
+
+    def _ref(self, ref: str) -> str:
+        """ function name for $ref, generated on first use, so recursive schemas terminate """
+        if (fname := self.refs.get(ref)) is None:
+            if not ref.startswith(self.DefsPrefix):
+                raise Unsupported(f'$ref {ref}')
+            definition = self.root.get('$defs', {}).get(ref[len(self.DefsPrefix):])
+            if definition is None:
+                raise Unsupported(f'unresolvable $ref {ref}')
+            fname = self.refs[ref] = f'_d{len(self.refs)}'
+            self._function(definition, fname)
+        return fname
+
+    def _checks(self, schema: dict | bool, x: str) -> list[str]:
+        """ statements returning False if x doesn't conform to schema """
+        if schema is True:
+            return []
+        elif schema is False:
+            return ['return False']
+        lines: list[str] = []
+        for keyword, value in sorted(schema.items(), key=lambda kv: kv[0] != 'type'):  # type check first
+            if keyword in _Annotations or keyword == '$defs':
+                continue
+            elif keyword == 'additionalProperties':
+                if 'properties' not in schema:
+                    lines += self._properties(schema, x)
+            elif keyword == 'type':
+                types = [value] if isinstance(value, str) else value
+                if not all(t in _Types for t in types):
+                    raise Unsupported(f'type {value}')
+                lines.append(f"if not ({' or '.join(_Types[t].format(x=x) for t in types)}): return False")
+            elif keyword == 'properties':
+                lines += self._properties(schema, x)
+            elif keyword == 'required':
+                if value:
+                    lines.append(f"if isinstance({x}, dict) and not ({' and '.join(f'{r!r} in {x}' for r in value)}): return False")
+            elif keyword == 'items':
+                if not isinstance(value, (dict, bool)):
+                    raise Unsupported('items as array')
+                lines.append(f'if isinstance({x}, list) and not all({self._condition(value, "i")} for i in {x}): return False')
+            elif keyword == '$ref':
+                lines.append(f'if not {self._ref(value)}({x}): return False')
+            elif keyword in ('anyOf', 'allOf'):
+                fs = [self._function(s) for s in value]
+                join = ' or ' if keyword == 'anyOf' else ' and '
+                lines.append(f"if not ({join.join(f'{f}({x})' for f in fs)}): return False")
+            elif keyword in ('enum', 'const'):
+                values = value if keyword == 'enum' else [value]
+                if not all(v is None or (isinstance(v, (str, int, float)) and not isinstance(v, bool)) for v in values):
+                    raise Unsupported(f'{keyword} with {values}')  # JSON equality differs from Python's
+                lines.append(f'if isinstance({x}, bool) or {x} not in {self._constant(tuple(values))}: return False')
+            elif keyword in _Bounds:
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    raise Unsupported(f'{keyword} {value!r}')
+                guard, fails = _Bounds[keyword]
+                lines.append(f'if {guard.format(x=x)} and {fails.format(x=x, v=self._constant(value))}: return False')
+            elif keyword == 'pattern':
+                pattern = self._constant(re.compile(value).search)
+                lines.append(f'if isinstance({x}, str) and not {pattern}({x}): return False')
+            elif keyword == 'format':
+                if self.format_checker and value in self.format_checker.checkers:
+                    conforms = self._constant(self.format_checker.conforms)
+                    lines.append(f'if not {conforms}({x}, {value!r}): return False')
+            else:
+                raise Unsupported(keyword)
+        return lines
+
+    def _condition(self, schema: dict | bool, x: str) -> str:
+        """ expression whether x conforms to schema, inlined for a plain type or $ref """
+        keywords = set(schema) - _Annotations if isinstance(schema, dict) else None
+        if keywords == {'type'} and isinstance(schema['type'], str) and schema['type'] in _Types:  # type:ignore
+            return '(' + _Types[schema['type']].format(x=x) + ')'  # type:ignore
+        elif keywords == {'$ref'}:
+            return f"{self._ref(schema['$ref'])}({x})"  # type:ignore
+        return f'{self._function(schema)}({x})'
+
+    def _properties(self, schema: dict, x: str) -> list[str]:
+        """ statements for properties and additionalProperties """
+        properties = schema.get('properties', {})
+        lines = [f'if isinstance({x}, dict):']
+        for prop, subschema in properties.items():
+            if subschema is True or (isinstance(subschema, dict) and not (set(subschema) - _Annotations)):
+                continue
+            v = f'{x}[{prop!r}]'
+            lines.append(f'    if {prop!r} in {x} and not {self._condition(subschema, v)}: return False')
+        additional = schema.get('additionalProperties', True)
+        if additional is not True:
+            known = self._constant(frozenset(properties))
+            f = self._function(additional)
+            lines.append(f'    if not all({f}(v) for k, v in {x}.items() if k not in {known}): return False')
+        return lines if len(lines) > 1 else []
+
+
+class CompiledValidator:
+    """ Validates with the compiled function of schema if possible, otherwise with the jsonschema validator.
+        The jsonschema validator also explains why an instance is invalid.
+    """
+
+    def __init__(self, schema: dict, root: dict | None = None):
+        vcls = jsonschema.validators.validator_for(schema)
+        self.validator: jsonschema.protocols.Validator = vcls(schema, format_checker=vcls.FORMAT_CHECKER)
+        try:
+            self.check: typing.Callable[[typing.Any], bool] | None = Compiler(
+                root if root is not None else schema, vcls.FORMAT_CHECKER).compile(schema)
+        except Unsupported as e:
+            logger.debug(f'JSON schema not compiled, unsupported: {e}')
+            self.check = None
+        except Exception as e:  # a schema shape the compiler doesn't expect must not prevent validation
+            logger.warning(f'JSON schema not compiled, {e.__class__.__name__}: {e}')
+            self.check = None
+
+    def iter_errors(self, instance) -> typing.Iterator[jsonschema.exceptions.ValidationError]:
+        if self.check is not None and self.check(instance):
+            return iter(())
+        return self.validator.iter_errors(instance)
+
+    def validate(self, instance):
+        """ raise best matching ValidationError if instance is invalid """
+        error = jsonschema.exceptions.best_match(self.iter_errors(instance))
+        if error is not None:
+            raise error
+        return
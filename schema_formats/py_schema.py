@@ -3,7 +3,7 @@
 import typing
 import types
 import pydantic
-from utils import pydantic_utils
+from utils import pydantic_utils, utils
 import json
 
 
@@ -144,6 +144,11 @@ class PySchema(schemas.AbstractSchema):
     schema_element: typing.Type[PySchemaElement]
     mimetypes: typing.ClassVar[schemas.MimeTypes] = schemas.MimeTypes(
         of_schema=['application/openapi', 'application/json'], of_data=['application/json'])
+    validates_raw: typing.ClassVar[bool] = True
+    MaxCachedPaths: typing.ClassVar[int] = 256
+    # validators by remainder, invalidated when the schema changes:
+    _v_adapters: utils.LRUCache[pydantic.TypeAdapter] = pydantic.PrivateAttr(
+        default_factory=lambda: utils.LRUCache(PySchema.MaxCachedPaths))
 
     @pydantic.field_validator('schema_element', mode='after')
     @classmethod
@@ -154,8 +159,15 @@ class PySchema(schemas.AbstractSchema):
 
     def __getitem__(self, key: keys.DDHkey, default=None, create_intermediate: bool = False) -> type[PySchemaElement] | None:
         se = self.schema_element.descend_path(key, create_intermediate=create_intermediate)
+        if create_intermediate:
+            self._v_adapters.clear()
         return default if se is None else se
 
+    def __setitem__(self, key: keys.DDHkey, value: type[schemas.AbstractSchemaElement], create_intermediate: bool = True) -> type[schemas.AbstractSchemaElement] | None:
+        parent = super().__setitem__(key, value, create_intermediate=create_intermediate)
+        self._v_adapters.clear()
+        return parent
+
     def __iter__(self) -> typing.Iterator[tuple[keys.DDHkey, type[PySchemaElement]]]:
         """ Schema Iterator: yields (key,SchemaElement) pairs, ignoring primitive types.
         """
@@ -193,6 +205,7 @@ class PySchema(schemas.AbstractSchema):
     def _add_fields(self, fields: dict[str, tuple]):
         """ Add the field in dict to the schema element """
         self.schema_element._add_fields(**fields)
+        self._v_adapters.clear()
 
     def parse(self, data: bytes) -> dict:
         if isinstance(data, dict):
@@ -201,15 +214,23 @@ class PySchema(schemas.AbstractSchema):
             d = json.loads(data)  # make dict
         return d
 
-    def validate_data(self, data: dict, remainder: keys.DDHkey, no_extra: bool = True) -> dict:
-        subs = self.schema_element.descend_path(remainder)
-        print(f'{self.__class__.__name__}.validate_data({type(data)}, {remainder=}, {no_extra=}, {subs=})')
-        if subs:
-            data = subs.model_validate(data)
-        else:
-            raise errors.NotFound(f'Path {remainder} is not in schema')
-
-        return data
+    def validate_data(self, data: dict | bytes | str, remainder: keys.DDHkey, no_extra: bool = True) -> dict:
+        """ validate data at remainder; raw JSON is validated without decoding it into a dict first """
+        adapter = self.get_adapter(remainder)
+        if isinstance(data, (bytes, str)):
+            return adapter.validate_json(data)
+        return adapter.validate_python(data)
+
+    def get_adapter(self, remainder: keys.DDHkey) -> pydantic.TypeAdapter:
+        """ TypeAdapter for schema element at remainder, cached """
+        adapter = self._v_adapters.get(remainder)
+        if adapter is None:
+            subs = self.schema_element.descend_path(remainder)
+            if not subs:
+                raise errors.NotFound(f'Path {remainder} is not in schema')
+            adapter = pydantic.TypeAdapter(subs)
+            self._v_adapters.put(remainder, adapter)
+        return adapter
 
     def get_type(self, path, field, value) -> type:
         """ return the Python type of a path, field """
@@ -38,7 +38,7 @@ class ConsentQuery(executable_nodes.InProcessSchemedExecutableNode):
             case 'given':
                 # we get all keys descending from the owner key:
                 owner_key = keys.DDHkey(principal.id).ensure_rooted()
-                node_keys = keydirectory.NodeRegistry.get_keys_with_prefix(owner_key)
+                node_keys = keydirectory.NodeRegistry.iter_keys_with_prefix(owner_key)
                 # get the consent nodes, and consents
                 cnodes = await keydirectory.NodeRegistry.get_nodes_from_tuple_keys(node_keys, nodes.NodeSupports.consents, req.transaction)
                 grants = {str(cnode.key.for_consent_grants()): cnode.consents for cnode in cnodes}
@@ -0,0 +1,30 @@
+""" Tests for the CryptoExecutor """
+import asyncio
+import threading
+import pytest
+from compression import zstd
+from core import keys, data_nodes, transactions, users
+from backend import crypto_executor
+
+
+@pytest.mark.asyncio
+async def test_crypto_executor():
+    executor = crypto_executor.CryptoExecutorClass(threshold=100)
+    thread = lambda b: (threading.current_thread() is threading.main_thread(), len(b))
+    assert await executor.run(10, thread, b'x'*10) == (True, 10), 'small payload runs inline'
+    assert await executor.run(1000, thread, b'x'*1000) == (False, 1000), 'large payload is offloaded'
+    payloads = [b'x'*10, b'y'*1000, b'z'*2000]
+    assert await executor.map(len, [(p,) for p in payloads], [len(p) for p in payloads]) == [10, 1000, 2000]
+    assert (executor.inline, executor.offloaded) == (2, 3)
+    executor.shutdown()
+    return
+
+
+@pytest.mark.asyncio
+async def test_crypto_executor_processes():
+    executor = crypto_executor.CryptoExecutorClass(threshold=100, processes=1)
+    data = b'abc'*1000
+    c = await executor.run(len(data), zstd.compress, data, pure=True)
+    assert zstd.decompress(c) == data
+    executor.shutdown()
+    return
@@ -0,0 +1,54 @@
+""" Tests for the binary envelope of Persistables """
+from core import keys, data_nodes, transactions, users, permissions
+from backend import persistable, envelope
+
+
+def test_envelope_lazy_data():
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node = data_nodes.DataNode(owner=user, key=keys.DDHkey('/1/org'), data={'big': list(range(1000))},
+                               sub_nodes={keys.DDHkey('sub'): keys.DDHkey('/1/org/sub')})
+    plain = node.to_plain()
+    assert envelope.is_envelope(plain)
+
+    n2 = data_nodes.DataNode.from_plain(plain)
+    assert n2.consents == node.consents and n2.sub_nodes == node.sub_nodes and n2.owner == node.owner
+    assert 'data' not in n2.__dict__, 'data not decoded for metadata'
+    assert n2.to_plain() == plain, 'undecoded data is copied'
+    assert n2.data == node.data
+    assert 'data' in n2.__dict__ and not n2._lazy_raw
+
+    n3 = data_nodes.DataNode.from_plain(plain)
+    n3.data = {'small': 1}  # assignment replaces undecoded data
+    assert data_nodes.DataNode.from_plain(n3.to_plain()).data == {'small': 1}
+    assert data_nodes.DataNode.from_plain(node.to_json().encode()).data == node.data, 'JSON is still readable'
+    return
+
+
+def test_lazy_fields_pydantic():
+    """ undecoded lazy fields behave like decoded ones in comparison, dumps and copies """
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node = data_nodes.DataNode(owner=user, key=keys.DDHkey('/1/org'), data={'big': list(range(100))})
+    plain = node.to_plain()
+    assert data_nodes.DataNode.from_plain(plain) == node
+    assert node == data_nodes.DataNode.from_plain(plain)
+    assert data_nodes.DataNode.from_plain(plain).model_dump() == node.model_dump()
+    assert data_nodes.DataNode.from_plain(plain).model_dump_json() == node.model_dump_json()
+    assert 'data' not in data_nodes.DataNode.from_plain(plain).model_dump(exclude={'data'})
+    for copy in (data_nodes.DataNode.from_plain(plain).model_copy(), data_nodes.DataNode.from_plain(plain).model_copy(deep=True)):
+        assert copy.__dict__['data'] == node.data and not copy._lazy_raw
+    n2 = data_nodes.DataNode.from_plain(plain)
+    assert n2.to_plain() == plain and 'data' not in n2.__dict__, 'packing does not decode'
+    return
+
+
+def test_lazy_field_assigned():
+    """ a lazy field assigned before it is read is not overwritten by the stored value """
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node = data_nodes.DataNode(owner=user, key=keys.DDHkey('/1/org'), data={'big': list(range(100))})
+    n2 = data_nodes.DataNode.from_plain(node.to_plain())
+    n2.data = {'small': 1}
+    assert not n2._lazy_raw
+    assert n2 != node and n2.data == {'small': 1}
+    assert n2.model_dump()['data'] == {'small': 1} and n2.model_dump_json() == n2.model_copy(deep=True).model_dump_json()
+    assert data_nodes.DataNode.from_plain(n2.to_plain()) == n2, 'memory and storage agree'
+    return
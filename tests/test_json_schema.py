@@ -0,0 +1,149 @@
+""" Test JsonSchema validation and its caches """
+
+import datetime
+import json
+import time
+import typing
+import pydantic
+import pytest
+import jsonschema.exceptions
+from core import keys, schemas, errors
+from schema_formats import json_schema, json_schema_compiler
+
+
+class Item(pydantic.BaseModel):
+    name: str
+    price: float
+    bought: datetime.datetime
+
+
+class Receipt(pydantic.BaseModel):
+    shop: str
+    items: list[Item] = []
+
+
+class Receipts(pydantic.BaseModel):
+    receipts: list[Receipt] = []
+    owner: str | None = None
+
+
+def make_schema(model: type[pydantic.BaseModel] = Receipts) -> json_schema.JsonSchema:
+    return json_schema.JsonSchema.from_str(json.dumps(model.model_json_schema()), schemas.SchemaAttributes())
+
+
+def test_validator_cache():
+    schema = make_schema()
+    schema.validate_schema()
+    warm = schema.cache_stats()['validators']
+    assert warm['entries'] == 3, 'root and top-level properties are warmed at registration'
+    data = {'receipts': [{'shop': 'Migros', 'items': [{'name': 'milk', 'price': 1.5, 'bought': '2024-01-01T10:00:00'}]}]}
+    for i in range(3):
+        schema.validate_data(data, keys.DDHkey(()))
+    assert schema.cache_stats()['validators']['hits'] == warm['hits'] + 3
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        schema.validate_data({'receipts': [{'items': []}]}, keys.DDHkey(()))
+    with pytest.raises(errors.NotFound):
+        schema.validate_data({}, keys.DDHkey(('nothing',)))
+
+    other = make_schema(Receipt)  # same remainders, different schema
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        other.validate_data(data, keys.DDHkey(()))
+    schema.validate_data(data, keys.DDHkey(()))
+    return
+
+
+def test_validator_cache_invalidation(monkeypatch):
+    schema = make_schema()
+    schema.validate_data({'owner': 'x'}, keys.DDHkey(()))
+    schema.json_schema['properties']['count'] = {'type': 'integer'}
+    schema.invalidate_caches()
+    assert not len(schema._v_validators) and not len(schema._v_descend_cache)
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        schema.validate_data({'count': 'x'}, keys.DDHkey(()))
+    assert schema.descend_path(keys.DDHkey(('count',))) == {'type': 'integer'}
+    assert schema.descend_path(keys.DDHkey(('extra', 'sub'))) is None
+    schema.descend_path(keys.DDHkey(('extra', 'sub')), create_intermediate=True)
+    assert not len(schema._v_descend_cache), 'creating intermediate elements invalidates'
+    assert schema.descend_path(keys.DDHkey(('extra',))) is not None
+
+    monkeypatch.setattr(json_schema.JsonSchema, 'MaxCachedPaths', 2)
+    small = make_schema()
+    for name in ('receipts', 'owner', 'receipts'):
+        small.get_validator(keys.DDHkey((name,)))
+    small.get_validator(keys.DDHkey(()))
+    assert len(small._v_validators) == 2 and keys.DDHkey(('owner',)) not in small._v_validators
+    return
+
+
+class Tree(pydantic.BaseModel):
+    name: str = pydantic.Field(min_length=1, pattern='^[a-z]+$')
+    size: int = pydantic.Field(ge=0, lt=100)
+    kind: typing.Literal['leaf', 'node'] = 'leaf'
+    tags: dict[str, int] = {}
+    children: list['Tree'] = []
+
+
+Instances = [
+    {'name': 'root', 'size': 1},
+    {'name': 'root', 'size': 1.0, 'children': [{'name': 'a', 'size': 2, 'tags': {'x': 1}}]},
+    {'name': 'root', 'size': True},
+    {'name': 'root', 'size': 1.5},
+    {'name': 'root', 'size': 100},
+    {'name': '', 'size': 1},
+    {'name': 'Root', 'size': 1},
+    {'name': 'root', 'size': 1, 'kind': 'branch'},
+    {'name': 'root', 'size': 1, 'tags': {'x': 'y'}},
+    {'name': 'root', 'size': 1, 'children': [{'name': 'a', 'size': -1}]},
+    {'name': 'root', 'size': 1, 'children': [{'size': 1}]},
+    {'name': 'root'},
+    [],
+    None,
+]
+
+
+def test_compiled_validator():
+    """ compiled validators agree with jsonschema """
+    for model in (Tree, Receipts):
+        s = model.model_json_schema()
+        validator = json_schema_compiler.CompiledValidator(s)
+        assert validator.check, 'schema is compiled'
+        for instance in Instances + [{'receipts': [{'shop': 'M', 'items': [{'name': 'a', 'price': 1, 'bought': 'x'}]}]}]:
+            expected = validator.validator.is_valid(instance)
+            assert validator.check(instance) == expected, instance
+            if not expected:
+                with pytest.raises(jsonschema.exceptions.ValidationError):
+                    validator.validate(instance)
+    booleans = json_schema_compiler.CompiledValidator(
+        {'properties': {'a': False, 'b': True}, 'items': False, 'anyOf': [False, {'type': 'object'}]})
+    assert booleans.check, 'boolean subschemas are compiled'
+    for instance in ({}, {'a': 1}, {'b': 1}, [], [1], 1):
+        assert booleans.check(instance) == booleans.validator.is_valid(instance), instance
+    for bound in ('__import__("os")', True, None):  # schema values never become source code
+        with pytest.raises(json_schema_compiler.Unsupported):
+            json_schema_compiler.Compiler({}).compile({'minimum': bound})
+    assert json_schema_compiler.Compiler({}).compile({'maximum': float('inf'), 'minItems': 1})([1])
+    unsupported = json_schema_compiler.CompiledValidator({'oneOf': [{'type': 'string'}, {'type': 'integer'}]})
+    assert unsupported.check is None, 'falls back to jsonschema'
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        unsupported.validate(1.5)
+    return
+
+
+def test_compiled_validator_benchmark():
+    """ compiled validator vs. jsonschema on a large receipt array; timings are printed, not asserted """
+    item = {'name': 'milk', 'price': 1.5, 'bought': '2024-01-01T10:00:00'}
+    data = {'receipts': [{'shop': 'Migros', 'items': [dict(item, name=f'i{j}') for j in range(10)]} for i in range(1000)],
+            'owner': 'martin'}
+    schema = make_schema()
+    compiled = schema.get_validator(keys.DDHkey(()))
+    assert compiled.check
+    timings = {}
+    for name, validate in (('jsonschema', compiled.validator.validate),
+                           ('compiled', lambda data: schema.validate_data(data, keys.DDHkey(())))):
+        t0 = time.perf_counter()
+        for i in range(3):
+            validate(data)
+        timings[name] = (time.perf_counter() - t0) / 3
+        print(f'{name:>10}: {1000*timings[name]:8.2f} ms for 1000 receipts')
+    assert compiled.check(data), 'validated by the compiled function'
+    return
@@ -1,4 +1,5 @@
 from core import keys, versions
+import pydantic
 import pytest
 
 
@@ -158,3 +159,15 @@ def test_roundtrip_str(key):
     s = str(key)
     rkey = cls(s)
     assert key == rkey, 'mismatch: key -> str -> cls()  == key'
+
+
+def test_interning():
+    """ Equal keys are interned to one instance, derived keys are memoized """
+    ddhkey1 = keys.DDHkey('/mgf/org/subkey')
+    ddhkey2 = keys.DDHkey(key=('', 'mgf', 'org', 'subkey'))
+    assert ddhkey1 is ddhkey2
+    assert ddhkey1.up() is ddhkey2.up()
+    assert ddhkey1.ensure_rooted() is ddhkey1
+    assert hash(ddhkey1) == hash(ddhkey2) and str(ddhkey1) == '/mgf/org/subkey'
+    with pytest.raises(pydantic.ValidationError):
+        ddhkey1.key = ()  # keys are frozen, as they are shared
@@ -0,0 +1,260 @@
+""" Tests for the keyvault """
+import os
+import time
+import pytest
+from core import keys, data_nodes, transactions, users, errors
+from backend import keyvault
+
+
+def test_storage_key_cache(monkeypatch):
+    user1 = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    user2 = users.User(id='2', name='roman', email='roman.stoessel@swisscom.com')
+    cache = keyvault.StorageKeyCacheClass(max_entries=2, ttl=60)
+    monkeypatch.setattr(keyvault, 'StorageKeyCache', cache)
+    node = data_nodes.DataNode(owner=user1, key=keys.DDHkey('/1/org'))
+    keyvault.set_new_storage_key(node, user1, {user2}, set())
+    cache.hits = cache.misses = 0
+
+    enc = keyvault.encrypt_data(user1, node.id, b'secret')
+    assert keyvault.decrypt_data(user2, node.id, enc) == b'secret'
+    assert keyvault.decrypt_data(user1, node.id, enc) == b'secret'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    s_key = cache.get(user2.id, node.id)
+    keyvault.set_new_storage_key(node, user1, {user2}, set())  # new key evicts and zeroizes the old one
+    assert user2.id not in cache.keys.peek(node.id, {}) and s_key is not None and not any(s_key._key)
+    enc = keyvault.encrypt_data(user1, node.id, b'secret')
+    keyvault.set_new_storage_key(node, user1, set(), {user2})
+    assert cache.get(user2.id, node.id) is None
+
+    monkeypatch.setattr(cache, 'ttl', -1.0)  # expired entries are not returned
+    keyvault.encrypt_data(user1, node.id, b'secret')
+    assert cache.get(user1.id, node.id) is None and node.id not in cache.keys
+
+    monkeypatch.setattr(cache, 'ttl', 60.0)
+    keys1, keys2 = keyvault.StorageKey(keyvault.get_nonce()), keyvault.StorageKey(keyvault.get_nonce())
+    cache.put(user1.id, 'n1', keys1); cache.put(user2.id, 'n1', keys2); cache.put(user1.id, 'n2', keyvault.StorageKey(keyvault.get_nonce()))
+    cache.invalidate('n1', user2.id)
+    assert set(cache.keys.peek('n1')) == {user1.id} and not any(keys2._key)
+    cache.invalidate('n1')
+    assert list(cache.keys.entries) == ['n2']
+    evicted = cache.get(user1.id, 'n2')
+    cache.put(user1.id, 'n3', keyvault.StorageKey(keyvault.get_nonce()))
+    cache.put(user1.id, 'n4', keyvault.StorageKey(keyvault.get_nonce()))
+    assert list(cache.keys.entries) == ['n3', 'n4'] and not any(evicted._key), 'least recently used node evicted and zeroized'
+    return
+
+
+def test_zeroize_while_building_cipher(monkeypatch):
+    """ a cipher built while another thread zeroizes the key is neither used nor cached """
+    s_key = keyvault.StorageKey(keyvault.get_nonce())
+    aesgcm = keyvault._Ciphers[keyvault.CipherFormat.aes_gcm]
+
+    def build(key: bytes):
+        s_key.zeroize()  # another thread evicts the key meanwhile
+        return aesgcm(key)
+    monkeypatch.setitem(keyvault._Ciphers, keyvault.CipherFormat.aes_gcm, build)
+    with pytest.raises(keyvault.ZeroizedKeyError):
+        s_key.encrypt(b'secret')
+    assert not s_key._ciphers and not any(s_key._aead_key)
+    with pytest.raises(keyvault.ZeroizedKeyError):
+        s_key.encrypt(b'secret')
+    return
+
+
+def test_storage_key_cache_benchmark(monkeypatch):
+    """ crypto throughput with and without StorageKeyCache; rates are printed, not asserted """
+    user1 = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node = data_nodes.DataNode(owner=user1, key=keys.DDHkey('/1/org'))
+    keyvault.set_new_storage_key(node, user1, set(), set())
+    rates = {}
+    for enabled in (False, True):
+        monkeypatch.setattr(keyvault, 'StorageKeyCache', keyvault.StorageKeyCacheClass(enabled=enabled))
+        n = 200
+        t0 = time.perf_counter()
+        for i in range(n):
+            keyvault.decrypt_data(user1, node.id, keyvault.encrypt_data(user1, node.id, b'x'*1000))
+        rates[enabled] = n / (time.perf_counter() - t0)
+    hit_rate = keyvault.StorageKeyCache.hit_rate
+    print(f'read-modify-writes/s: without cache {rates[False]:.0f}, with cache {rates[True]:.0f}, {hit_rate=:.1%}')
+    assert hit_rate > 0.9
+    return
+
+
+def test_keypair_pool():
+    pool = keyvault.KeypairPoolClass(lambda: object(), size=4, low_water=1)
+    assert pool.take() is not None
+    for i in range(100):  # worker fills the pool
+        if len(pool.keys) == 4:
+            break
+        time.sleep(0.01)
+    assert len(pool.keys) == 4
+    keys_ = [pool.take() for i in range(3)]
+    assert len(set(map(id, keys_))) == 3
+    assert pool.stats()['taken'] == 4 and pool.stats()['misses'] <= 1
+    pool.stop()
+    return
+
+
+def test_aead_format():
+    s_key = keyvault.StorageKey(keyvault.get_nonce())
+    enc = s_key.encrypt(b'secret', b'node1')
+    assert enc[0] == keyvault.StorageKey.Format and not keyvault.is_fernet(enc)
+    assert s_key.decrypt(enc, b'node1') == b'secret'
+    with pytest.raises(errors.DecryptionError):
+        s_key.decrypt(enc, b'node2')  # blob bound to its node
+    legacy = s_key.encrypt_fernet(b'secret')
+    assert keyvault.is_fernet(legacy) and s_key.decrypt(legacy, b'node1') == b'secret', 'Fernet blobs remain readable'
+    return
+
+
+def test_aead_benchmark(monkeypatch):
+    """ size and throughput of AEAD formats vs. Fernet """
+    s_key = keyvault.StorageKey(keyvault.get_nonce())
+    for size in (100, 10_000, 1_000_000):
+        plaintext = os.urandom(size)
+        n = max(10, 2_000_000 // size)
+        for name in ['fernet'] + [f.name for f in keyvault.CipherFormat]:
+            if name != 'fernet':
+                monkeypatch.setattr(keyvault.StorageKey, 'Format', keyvault.CipherFormat[name])
+            encrypt = s_key.encrypt_fernet if name == 'fernet' else s_key.encrypt
+            t0 = time.perf_counter()
+            for i in range(n):
+                enc = encrypt(plaintext)
+                assert s_key.decrypt(enc) == plaintext
+            mbs = n * size / (time.perf_counter() - t0) / 2**20
+            print(f'{size=:>9} {name:>18}: {len(enc)/size:6.1%} of plaintext, {mbs:8.1f} MB/s')
+            if size == 1_000_000:
+                assert (len(enc) < size * 1.01) == (name != 'fernet'), 'base64 costs a third'
+    return
+
+
+def count_wraps(monkeypatch) -> list:
+    """ count public key operations """
+    wraps = []
+    encrypt = keyvault.PrincipalKey.encrypt
+    monkeypatch.setattr(keyvault.PrincipalKey, 'encrypt', lambda self, plaintext: wraps.append(1) or encrypt(self, plaintext))
+    return wraps
+
+
+def test_key_groups(monkeypatch):
+    owner = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    consentees = {users.User(id=f'c{i}', name=f'c{i}', email=f'c{i}@example.com') for i in range(40)}
+    node = data_nodes.DataNode(owner=owner, key=keys.DDHkey('/1/org'))
+    keyvault.set_new_storage_key(node, owner, consentees, set())
+    enc = keyvault.encrypt_data(owner, node.id, b'secret')
+    assert all(keyvault.decrypt_data(c, node.id, enc) == b'secret' for c in consentees)
+
+    wraps = count_wraps(monkeypatch)
+    new = users.User(id='new', name='new', email='new@example.com')
+    assert keyvault.grant_storage_key(node, owner, consentees | {new})
+    assert keyvault.decrypt_data(new, node.id, enc) == b'secret', 'storage key is unchanged'
+    assert len(wraps) == 1, 'only the group key is wrapped for the new consentee'
+
+    wraps.clear()
+    group_of = keyvault.GroupKeyVault.group_of
+    # a consentee sharing its group, chosen independently of set order (hash seed):
+    gone = min((c for c in consentees if sum(group_of(o) == group_of(c) for o in consentees) > 1), key=lambda c: c.id)
+    keyvault.set_new_storage_key(node, owner, consentees - {gone} | {new}, {gone})
+    group = keyvault.GroupKeyVault.group_keys[node.id][group_of(gone)]
+    assert len(wraps) == len(group.members), 'only the group of the removed consentee is rewrapped'
+    enc = keyvault.encrypt_data(owner, node.id, b'secret')
+    assert keyvault.decrypt_data(new, node.id, enc) == b'secret'
+    with pytest.raises(KeyError):
+        keyvault.decrypt_data(gone, node.id, enc)
+
+    groups = dict(keyvault.GroupKeyVault.group_keys[node.id])
+    with pytest.raises(errors.AccessError):
+        keyvault.set_new_storage_key(node, new, consentees, set())
+    assert keyvault.GroupKeyVault.group_keys[node.id] == groups, 'a consentee cannot replace the hierarchy'
+    assert not keyvault.grant_storage_key(node, new, {gone})
+    assert set(keyvault.GroupKeyVault.master_keys[node.id]) == {owner.id}, 'master key for owners only'
+    other = data_nodes.DataNode(owner=owner, key=keys.DDHkey('/1/other'))
+    keyvault.set_new_storage_key(other, new, set(), set())  # new node, stored by a consentee
+    assert set(keyvault.GroupKeyVault.master_keys[other.id]) == {owner.id}
+    return
+
+
+def test_key_groups_benchmark(monkeypatch):
+    """ latency of consent changes by number of consentees, with and without key groups """
+    owner = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    principals = [users.User(id=f'b{i}', name=f'b{i}', email=f'b{i}@example.com') for i in range(65)]
+    for p in [owner] + principals:  # exclude key generation from timings
+        keyvault._ensure_principal_key(p)
+    keyvault.KeypairPool.stop()  # refilling would compete for the CPU
+    wraps = count_wraps(monkeypatch)
+    for key_groups in (0, keyvault.GroupKeyVaultClass.KeyGroups):
+        monkeypatch.setattr(keyvault.GroupKeyVaultClass, 'KeyGroups', key_groups)
+        for n in (4, 16, 64):
+            consentees = set(principals[:n])
+            node = data_nodes.DataNode(owner=owner, key=keys.DDHkey('/1/org'))
+            keyvault.set_new_storage_key(node, owner, consentees, set())
+            wraps.clear()
+            t0 = time.perf_counter()
+            if not keyvault.grant_storage_key(node, owner, consentees | {principals[n]}):
+                keyvault.set_new_storage_key(node, owner, consentees | {principals[n]}, set())
+            t1 = time.perf_counter()
+            keyvault.set_new_storage_key(node, owner, consentees, {principals[n]})
+            t2 = time.perf_counter()
+            print(f'{key_groups=:2} {n=:3}: grant {1000*(t1-t0):6.2f} ms, revoke {1000*(t2-t1):6.2f} ms, {len(wraps)} wraps')
+            if key_groups and n == 64:
+                assert len(wraps) < n, 'wraps do not grow with the number of consentees'
+    return
+
+
+def test_x25519_wrap(monkeypatch):
+    """ X25519 principals share nodes with RSA principals """
+    rsa_user = users.User(id='rsa', name='rsa', email='rsa@example.com')
+    x_user = users.User(id='x25519', name='x25519', email='x25519@example.com')
+    keyvault.PrincipalKeyVault.create(x_user, keyvault.X25519SealedBox.id)
+    monkeypatch.setattr(keyvault.PrincipalKey, 'DefaultAlgorithm', keyvault.RsaOaepWrap.id)
+    for key_groups in (0, keyvault.GroupKeyVaultClass.KeyGroups):
+        monkeypatch.setattr(keyvault.GroupKeyVaultClass, 'KeyGroups', key_groups)
+        node = data_nodes.DataNode(owner=rsa_user, key=keys.DDHkey('/rsa/org'))
+        keyvault.set_new_storage_key(node, rsa_user, {x_user}, set())
+        assert keyvault.AccessKeyVault.access_keys[(x_user.id, node.id)].algorithm == keyvault.X25519SealedBox.id
+        assert keyvault.AccessKeyVault.access_keys[(rsa_user.id, node.id)].algorithm == keyvault.RsaOaepWrap.id
+        enc = keyvault.encrypt_data(rsa_user, node.id, b'secret')
+        keyvault.StorageKeyCache.clear()
+        assert keyvault.decrypt_data(x_user, node.id, enc) == b'secret'
+
+    p_key = keyvault.PrincipalKeyVault.key_for_principal(x_user)
+    assert p_key
+    wrapped = p_key.encrypt(b'k' * 44)
+    assert len(wrapped) == 32 + 44 + 16, 'ephemeral public key, ciphertext and tag'
+    assert p_key.encrypt(b'k' * 44) != wrapped, 'ephemeral key per wrap'
+    with pytest.raises(KeyError):
+        p_key.decrypt(wrapped, keyvault.RsaOaepWrap.id)
+    return
+
+
+@pytest.fixture
+def keypair_pool_stopped():
+    """ stop the global KeypairPool, so RSA generation is measured, and restart it afterwards if it was running """
+    running = keyvault.KeypairPool.worker is not None
+    keyvault.KeypairPool.stop()
+    yield keyvault.KeypairPool
+    if running:
+        keyvault.KeypairPool.start()
+    return
+
+
+def test_key_wrap_benchmark(keypair_pool_stopped):
+    """ key generation, wrap and unwrap throughput per algorithm; prints rates, timings are not asserted """
+    rates = {}
+    for alg_id, wrap in keyvault.KeyWrap.Registry.items():
+        generate = keyvault.KeypairPool.generate if wrap is keyvault.RsaOaepWrap else wrap.generate
+        t0 = time.perf_counter()
+        private_keys = [generate() for i in range(5)]
+        t1 = time.perf_counter()
+        plains = [os.urandom(44) for i in range(200)]
+        wrapped = [wrap.wrap(private_keys[i % 5], secret) for i, secret in enumerate(plains)]
+        t2 = time.perf_counter()
+        unwrapped = [wrap.unwrap(private_keys[i % 5], w) for i, w in enumerate(wrapped)]
+        t3 = time.perf_counter()
+        assert unwrapped == plains
+        rates[alg_id] = (5 / (t1-t0), 200 / (t2-t1), 200 / (t3-t2))
+        print(f'{alg_id:>26}: keygen {rates[alg_id][0]:9.1f}/s, wrap {rates[alg_id][1]:9.1f}/s, '
+              f'unwrap {rates[alg_id][2]:9.1f}/s, {len(wrapped[0])} bytes')
+    assert not keyvault.KeypairPool.worker, 'pool stays stopped during the benchmark'
+    return
@@ -0,0 +1,109 @@
+""" Tests for the log-structured storage engine """
+import asyncio
+import os
+import threading
+import pytest
+from core import keys, data_nodes
+from backend import log_storage, storage
+
+
+def test_log_storage(tmp_path):
+    st = log_storage.LogStorageClass(directory=tmp_path, segment_size=200)
+    st.store('a', b'a1'*20, None)
+    st.store('b', b'b1'*20, None)
+    st.store('a', b'a2'*20, None)  # overwrites
+    st.delete('b', None)
+    assert st.load('a', None) == b'a2'*20
+    assert 'b' not in st
+    view, variant = st.load_view('a')
+    assert view == b'a2'*20 and variant == storage.Variant.uncompressed
+    for i in range(10):  # fill more segments
+        st.store(f'k{i}', bytes([i])*50, None)
+    st.close()
+
+    # torn write at the end is cut off on recovery:
+    last = max(tmp_path.glob('segment-*.log'))
+    with open(last, 'ab') as f:
+        f.write(b'\x00torn')
+    st = log_storage.LogStorageClass(directory=tmp_path, segment_size=200)
+    assert st.load('a', None) == b'a2'*20 and 'b' not in st
+    assert all(st.load(f'k{i}', None) == bytes([i])*50 for i in range(10))
+
+    for i in range(10):
+        st.delete(f'k{i}', None)
+    n_segments = len(list(tmp_path.glob('segment-*.log')))
+    assert st.compact() > 0
+    assert len(list(tmp_path.glob('segment-*.log'))) < n_segments
+    st.close()
+    st = log_storage.LogStorageClass(directory=tmp_path, segment_size=200)
+    assert st.load('a', None) == b'a2'*20
+    assert not any(f'k{i}' in st for i in range(10)), 'deleted keys stay deleted after compaction'
+    st.clear()
+    assert 'a' not in st
+    st.close()
+
+
+def test_compaction_durable(tmp_path, monkeypatch):
+    """ copied records and records superseding the garbage are fsync'd before a segment is replaced or unlinked,
+        the swap is fsync'd too, and no fsync holds the lock
+    """
+    st = log_storage.LogStorageClass(directory=tmp_path, segment_size=200)
+    for i in range(10):
+        st.store(f'k{i}', bytes([i])*50, None)
+    for i in range(10):
+        if i % 4 != 3:
+            st.delete(f'k{i}', None)
+    events = []
+    real_fsync, real_unlink, real_replace = os.fsync, log_storage.pathlib.Path.unlink, os.replace
+
+    def try_lock():
+        if unlocked := st._lock.acquire(blocking=False):
+            st._lock.release()
+        events.append('fsync' if unlocked else 'locked')
+
+    def fsync(fd):
+        t = threading.Thread(target=try_lock)
+        t.start(); t.join()
+        if len(events) == 1:
+            st.store('k7', b'new', None)  # stored while compacting, supersedes the copy
+        real_fsync(fd)
+    monkeypatch.setattr(os, 'fsync', fsync)
+    monkeypatch.setattr(log_storage.pathlib.Path, 'unlink', lambda p: (events.append('swap'), real_unlink(p)))
+    monkeypatch.setattr(os, 'replace', lambda src, dst: (events.append('swap'), real_replace(src, dst)))
+    compacted = st.compact()
+    assert compacted > 0 and events.count('swap') == compacted and 'locked' not in events
+    for i, event in enumerate(events):
+        if event == 'swap':
+            assert events[i-1] == 'fsync' and events[i+1] == 'fsync'
+    assert st.load('k3', None) == bytes([3])*50 and st.load('k7', None) == b'new'
+    st.close()
+    assert not list(tmp_path.glob('*.compacting'))
+    st = log_storage.LogStorageClass(directory=tmp_path, segment_size=200)
+    assert st.load('k3', None) == bytes([3])*50 and st.load('k7', None) == b'new'
+    assert not any(f'k{i}' in st for i in range(10) if i % 4 != 3)
+    st.close()
+
+
+@pytest.mark.asyncio
+async def test_group_commit(tmp_path, monkeypatch):
+    st = log_storage.LogStorageClass(directory=tmp_path, max_batch_latency=0.01)
+    fsyncs = []
+    real_fsync = os.fsync
+
+    def try_lock():
+        if unlocked := st._lock.acquire(blocking=False):
+            st._lock.release()
+        fsyncs.append(unlocked)
+
+    def fsync(fd):
+        """ record whether other threads can take the lock during the fsync """
+        t = threading.Thread(target=try_lock)
+        t.start(); t.join()
+        real_fsync(fd)
+    monkeypatch.setattr(os, 'fsync', fsync)
+    await asyncio.gather(*(st.commit_writes({f'k{i}': b'x'*i, f'l{i}': b'y'}, None) for i in range(20)))
+    assert fsyncs == [True], 'one fsync for all concurrent transactions, not holding the lock'
+    assert st.load('k7', None) == b'x'*7
+    await st.commit_writes({'k7': None}, None)
+    assert 'k7' not in st and fsyncs == [True, True]
+    st.close()
@@ -0,0 +1,120 @@
+""" Tests for the NodeCache of decrypted nodes """
+import pytest
+from core import keys, data_nodes, transactions, users, storage_resource, errors
+from backend import persistable, node_cache, keyvault
+from utils import utils
+
+
+class CachedPersistable(persistable.Persistable):
+    data: dict = {}
+
+
+def test_node_cache():
+    user1 = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    user2 = users.User(id='2', name='roman', email='roman.stoessel@swisscom.com')
+    cache = node_cache.NodeCacheClass(max_entries=2)
+    trx1 = transactions.Transaction.create(user1)
+    obj = CachedPersistable(data={'a': 1})
+
+    assert cache.get(CachedPersistable, obj.id, trx1) is None
+    cache.put(obj, obj.to_json(), trx1)
+    assert cache.get(CachedPersistable, obj.id, trx1) is obj, 'same object within transaction'
+
+    trx2 = transactions.Transaction.create(user1)
+    o2 = cache.get(CachedPersistable, obj.id, trx2)
+    assert o2 == obj and o2 is not obj, 'rebuilt from plaintext across transactions'
+    assert cache.get(CachedPersistable, obj.id, transactions.Transaction.create(user2)) is None, 'other principal'
+    assert (cache.trx_hits, cache.lru_hits) == (1, 1)
+
+    # store is visible in its transaction only, until it is committed:
+    o2.data = {'a': 2}
+    cache.stored(o2, trx2)
+    assert cache.get(CachedPersistable, obj.id, trx2) is o2
+    assert cache.get(CachedPersistable, obj.id, transactions.Transaction.create(user1)) is None
+    cache.put(o2, o2.to_json(), trx2)
+    assert obj.id not in cache.lru, 'uncommitted data must not be shared'
+
+    # LRU is bounded:
+    trx3 = transactions.Transaction.create(user1)
+    objs = [CachedPersistable(data={'i': i}) for i in range(3)]
+    for o in objs:
+        cache.put(o, o.to_json(), trx3)
+    assert list(cache.lru.entries) == [objs[1].id, objs[2].id]
+    cache.invalidate(objs[2].id, trx3)
+    assert cache.get(CachedPersistable, objs[2].id, trx3) is None
+    return
+
+
+@pytest.mark.asyncio
+async def test_delete_verifies_stored_node(monkeypatch):
+    """ delete decrypts the stored node, a cached copy doesn't prove access """
+    res = storage_resource.InProcessStorageResource(dapp=None)
+
+    async def get_storage_resource(cls, owner, transaction):
+        return res
+    monkeypatch.setattr(data_nodes.DataNode, 'get_storage_resource', classmethod(get_storage_resource))
+    user1 = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    trx = transactions.Transaction.create(user1)
+    node = data_nodes.DataNode(owner=user1, key=keys.DDHkey('/1/cached'), data={'a': 1})
+    await node.store(trx)
+    assert await data_nodes.DataNode.load(node.id, user1, trx) is node, 'cached'
+    keyvault.AccessKeyVault.remove(user1, node.id)
+    with pytest.raises(errors.AccessError):
+        await node.delete(trx)
+    return
+
+
+@pytest.mark.asyncio
+async def test_fernet_load_no_rewrite(monkeypatch):
+    """ loading a Fernet node is read-only; a consentee's transaction must not re-store the owner's node """
+    res = storage_resource.InProcessStorageResource(dapp=None)
+
+    async def get_storage_resource(cls, owner, transaction):
+        return res
+    monkeypatch.setattr(data_nodes.DataNode, 'get_storage_resource', classmethod(get_storage_resource))
+    user1 = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    trx = transactions.Transaction.create(user1)
+    node = data_nodes.DataNode(owner=user1, key=keys.DDHkey('/1/fernet'), data={'a': 1})
+    await node.store(trx)
+    legacy = keyvault.AccessKeyVault.get_storage_key(user1, node.id).encrypt_fernet(node.compress_plain(node.to_plain()))
+    await res.store(node.id, legacy, trx)
+    node_cache.NodeCache.invalidate(node.id)
+    trx2 = transactions.Transaction.create(user1)
+    loaded = await data_nodes.DataNode.load(node.id, user1, trx2)
+    assert loaded.data == {'a': 1} and not trx2.actions, 'no write triggered by the load'
+    return
+
+
+@pytest.mark.asyncio
+async def test_invalidated_during_load(monkeypatch):
+    """ a node invalidated by a commit while it is being loaded is not shared in the LRU """
+    res = storage_resource.InProcessStorageResource(dapp=None)
+
+    async def get_storage_resource(cls, owner, transaction):
+        return res
+    monkeypatch.setattr(data_nodes.DataNode, 'get_storage_resource', classmethod(get_storage_resource))
+    user1 = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node = data_nodes.DataNode(owner=user1, key=keys.DDHkey('/1/loading'), data={'a': 1})
+    await node.store(transactions.Transaction.create(user1))
+    node_cache.NodeCache.invalidate(node.id)
+    load = res.load
+
+    async def load_and_commit(key, trx):
+        enc = await load(key, trx)
+        node_cache.NodeCache.invalidate(key)  # another transaction commits meanwhile
+        return enc
+    monkeypatch.setattr(res, 'load', load_and_commit)
+    assert (await data_nodes.DataNode.load(node.id, user1, transactions.Transaction.create(user1))).data == {'a': 1}
+    assert node.id not in node_cache.NodeCache.lru, 'possibly stale'
+    monkeypatch.setattr(res, 'load', load)
+    await data_nodes.DataNode.load(node.id, user1, transactions.Transaction.create(user1))
+    assert node.id in node_cache.NodeCache.lru
+
+    cache = node_cache.NodeCacheClass()
+    monkeypatch.setattr(cache, 'invalidations', utils.LRUCache(2, on_evict=cache._forget))
+    generation = cache.generation
+    for id in ('a', 'b', 'c'):
+        cache.invalidate(id)
+    assert cache.invalidated_since('a', generation), 'forgotten invalidations count as recent'
+    assert not cache.invalidated_since('a', cache.generation)
+    return
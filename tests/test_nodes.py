@@ -1,6 +1,7 @@
 import pytest
 
 from core import keys, nodes, data_nodes, permissions, schemas, facade, keydirectory, transactions, users
+from backend import persistable, registry_journal
 from frontend import sessions
 from schema_formats import py_schema
 
@@ -55,3 +56,133 @@ async def test_schema_node(node_registry):
     assert schema_element is None, 'missing intermediate nodes must not be created'
     d, h = await facade.ddh_get(access, session)
     assert d is None  # this should be same in one go.
+
+
+class DummyDataNode(nodes.Node, persistable.NonPersistable):
+    @property
+    def supports(self):
+        return {nodes.NodeSupports.data}
+
+
+def test_registry_trie(node_registry):
+    """ closest node lookup and prefix scan on the registry trie """
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node_top = DummyDataNode(owner=user)
+    node_sub = DummyDataNode(owner=user)
+    keydirectory.NodeRegistry[keys.DDHkey(key='/mgf/p/finance')] = node_top
+    keydirectory.NodeRegistry[keys.DDHkey(key='/mgf/p/finance/holdings/portfolio')] = node_sub
+    keydirectory.NodeRegistry[keys.DDHkey(key='/lise/p/finance')] = DummyDataNode(owner=user)
+
+    ddhkey = keys.DDHkey(key='/mgf/p/finance/holdings/portfolio/2023')
+    assert [(n, split) for n, split in keydirectory.NodeRegistry.get_next_proxy(ddhkey, nodes.NodeSupports.data)] == [
+        (node_sub, 5), (node_top, 3)], 'closest node first, split at node key'
+    assert keydirectory.NodeRegistry.get_proxy(keys.DDHkey(
+        key='/mgf/p/finance/holdings'), nodes.NodeSupports.data) == (node_top, 3)
+    assert keydirectory.NodeRegistry.get_proxy(ddhkey, nodes.NodeSupports.schema) == (None, -1)
+    assert keydirectory.NodeRegistry.get_proxy(keys.DDHkey(key='/mgf/p'), nodes.NodeSupports.data) == (None, -1)
+
+    prefixed = keydirectory.NodeRegistry.get_keys_with_prefix(keys.DDHkey(key='/mgf'))
+    assert set(prefixed) == {node_top.key.key, node_sub.key.key}, 'only keys with nodes, only below prefix'
+    assert not keydirectory.NodeRegistry.get_keys_with_prefix(keys.DDHkey(key='/unknown'))
+
+    assert not keydirectory.NodeRegistry.check_and_set(node_top.key, DummyDataNode(owner=user)), 'already present'
+    assert keydirectory.NodeRegistry[node_top.key][nodes.NodeSupports.data] is node_top
+    return
+
+
+class DummyConsentNode(nodes.Node, persistable.NonPersistable):
+    @property
+    def supports(self):
+        return {nodes.NodeSupports.data, nodes.NodeSupports.consents}
+
+
+def test_registry_consents_index(node_registry):
+    """ nearest node with consents is found from the index, also when registered after its descendants """
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    node_sub = DummyDataNode(owner=user)
+    keydirectory.NodeRegistry[keys.DDHkey(key='/mgf/p/family/children/anna')] = node_sub
+    ddhkey = keys.DDHkey(key='/mgf/p/family/children/anna/school')
+    assert keydirectory.NodeRegistry.get_proxy(ddhkey, nodes.NodeSupports.data, with_consents=True) == (None, -1)
+
+    node_c = DummyConsentNode(owner=user, consents=permissions.Consents(consents=[]))
+    keydirectory.NodeRegistry[keys.DDHkey(key='/mgf/p/family')] = node_c
+    assert keydirectory.NodeRegistry.get_proxy(ddhkey, nodes.NodeSupports.data) == (node_sub, 5)
+    assert keydirectory.NodeRegistry.get_proxy(ddhkey, nodes.NodeSupports.data, with_consents=True) == (node_c, 3)
+    assert keydirectory.NodeRegistry.get_proxy(ddhkey, nodes.NodeSupports.consents) == (node_c, 3)
+    return
+
+
+def test_registry_journal(tmp_path):
+    """ persistable nodes survive a restart through snapshot and log """
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    registry = keydirectory._NodeRegistry()
+    registry.recover(registry_journal.RegistryJournal(tmp_path))  # empty
+    assert registry._supports_mask([nodes.NodeSupports.data, nodes.NodeSupports.consents]) == 0b1010, 'persisted bits are stable'
+    assert registry._supports_from_mask(0b10001) == {nodes.NodeSupports.schema, nodes.NodeSupports.subscribable}
+    node_top = data_nodes.DataNode(owner=user, consents=permissions.Consents(consents=[]))
+    registry[keys.DDHkey(key='/mgf/p/finance')] = node_top
+    registry.write_snapshot()
+    node_sub = data_nodes.DataNode(owner=user, consents=None)
+    registry[keys.DDHkey(key='/mgf/p/finance/holdings')] = node_sub  # in log only
+    registry[keys.DDHkey(key='/mgf/p/finance/transient')] = DummyDataNode(owner=user)  # not persistable
+    registry.close_journal()
+    with open(tmp_path / registry_journal.RegistryJournal.LogName, 'ab') as f:
+        f.write(b'torn')
+
+    recovered = keydirectory._NodeRegistry()
+    recovered.recover(registry_journal.RegistryJournal(tmp_path))
+    ddhkey = keys.DDHkey(key='/mgf/p/finance/holdings/portfolio')
+    assert [(p.id, split) for p, split in recovered.get_next_proxy(ddhkey, nodes.NodeSupports.data)] == [
+        (node_sub.id, 5), (node_top.id, 4)]
+    proxy, split = recovered.get_proxy(ddhkey, nodes.NodeSupports.data, with_consents=True)
+    assert (proxy.id, proxy.classname, proxy.owner_id, split) == (node_top.id, 'DataNode', user.id, 4)
+    assert not recovered[keys.DDHkey(key='/mgf/p/finance/transient')]
+    recovered[keys.DDHkey(key='/mgf/p/other')] = data_nodes.DataNode(owner=user)  # appended after torn tail
+    recovered.close_journal()
+    again = keydirectory._NodeRegistry()
+    again.recover(registry_journal.RegistryJournal(tmp_path))
+    assert set(again.get_keys_with_prefix(keys.DDHkey(key='/mgf'))) == {
+        node_top.key.key, node_sub.key.key, keys.DDHkey(key='/mgf/p/other').key}
+    return
+
+
+def test_registry_snapshot_trigger(tmp_path, monkeypatch):
+    """ the log is folded into a snapshot after SnapshotAfter records, and when the journal is closed """
+    monkeypatch.setattr(keydirectory._NodeRegistry, 'SnapshotAfter', 3)
+    user = users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+    registry = keydirectory._NodeRegistry()
+    registry.recover(journal := registry_journal.RegistryJournal(tmp_path))
+    for i in range(4):
+        registry[keys.DDHkey(key=f'/mgf/p/n{i}')] = data_nodes.DataNode(owner=user)
+    assert journal.log_records == 1, 'log rotated after the third record'
+    journal.wait()
+    assert not journal.folding_log_path.exists(), 'folded into the snapshot in the background'
+    registry[keys.DDHkey(key='/mgf/p/n0')] = data_nodes.DataNode(owner=user)  # replaces n0
+    registry.close_journal()
+    recovered = keydirectory._NodeRegistry()
+    recovered.recover(journal := registry_journal.RegistryJournal(tmp_path))
+    assert journal.log_records == 2, 'records after the rotation are replayed'
+    assert len(list(journal._read_snapshot())) == 3
+    assert recovered.get_proxy(keys.DDHkey(key='/mgf/p/n0'), nodes.NodeSupports.data)[0].id == \
+        registry.get_proxy(keys.DDHkey(key='/mgf/p/n0'), nodes.NodeSupports.data)[0].id
+    recovered.close_journal(snapshot=True)
+    recovered = keydirectory._NodeRegistry()
+    recovered.recover(journal := registry_journal.RegistryJournal(tmp_path))
+    assert journal.log_records == 0, 'nothing to replay'
+    assert len(recovered.get_keys_with_prefix(keys.DDHkey(key='/mgf/p'))) == 4
+    monkeypatch.setattr(registry_journal.RegistryJournal, '_fold', lambda self: None)  # crash before folding
+    recovered[keys.DDHkey(key='/mgf/p/n4')] = data_nodes.DataNode(owner=user)
+    journal.start_snapshot()
+    recovered.close_journal()
+    monkeypatch.undo()
+    assert journal.folding_log_path.exists()
+    recovered = keydirectory._NodeRegistry()
+    recovered.recover(journal := registry_journal.RegistryJournal(tmp_path))
+    assert len(recovered.get_keys_with_prefix(keys.DDHkey(key='/mgf/p'))) == 5, 'folding log is replayed'
+    assert not journal.folding_log_path.exists() and len(list(journal._read_snapshot())) == 5, 'and folded'
+    recovered.close_journal()
+
+    r = registry_journal.Record('p', 0b11, 0b11, 'DataNode', 'a', 'o')
+    assert list(registry_journal.fold([r, r._replace(registered=0b10, id='b')])) == [
+        r._replace(registered=0b01), r._replace(registered=0b10, id='b')], 'last registration per bit wins'
+    return
@@ -3,7 +3,10 @@
 import pytest
 import typing
 import datetime
-from core import keys, schemas, pillars, keydirectory, nodes, schema_root
+import json
+import time
+import pydantic
+from core import keys, schemas, pillars, keydirectory, nodes, schema_root, errors
 from frontend import sessions
 from schema_formats import py_schema
 
@@ -82,3 +85,54 @@ class Garantie(py_schema.PySchemaElement):
     """ Details of a product """
     issuer: str = 'Migros'
     garantie_bis: datetime.date
+
+
+class Purchase(py_schema.PySchemaElement):
+    article: str
+    price: float
+    bought: datetime.datetime
+
+
+class Purchases(py_schema.PySchemaElement):
+    purchases: list[Purchase] = []
+
+
+class Shopping(py_schema.PySchemaElement):
+    shop: Purchases
+
+
+def test_validate_cached_adapter():
+    schema = py_schema.PySchema(schema_element=Shopping)
+    raw = '{"purchases": [{"article": "milk", "price": 1.5, "bought": "2024-01-01T10:00:00"}]}'
+    for i in range(3):
+        assert schema.validate_data(raw, keys.DDHkey('shop')).purchases[0].price == 1.5
+    assert schema.validate_data({'purchases': []}, keys.DDHkey('shop')).purchases == []
+    assert schema._v_adapters.stats() == {'entries': 1, 'hits': 3, 'misses': 1}
+    with pytest.raises(pydantic.ValidationError):
+        schema.validate_data(b'{"purchases": [{"article": "milk"}]}', keys.DDHkey('shop'))
+    with pytest.raises(errors.NotFound):
+        schema.validate_data(raw, keys.DDHkey('nothing'))
+    schema._add_fields({'comment': (str, None)})
+    assert not len(schema._v_adapters), 'schema change invalidates'
+    return
+
+
+def test_validate_raw_benchmark():
+    """ PySchema.validate_data() on raw JSON vs. descend_path and model_validate on a decoded dict;
+        timings are printed, not asserted
+    """
+    schema = py_schema.PySchema(schema_element=Shopping)
+    purchases = [{'article': f'a{i}', 'price': i / 10, 'bought': '2024-01-01T10:00:00'} for i in range(20_000)]
+    raw = json.dumps({'purchases': purchases}).encode()
+    remainder = keys.DDHkey('shop')
+    timings, results = {}, {}
+    for name, validate in (('dict', lambda: Shopping.descend_path(remainder).model_validate(json.loads(raw))),
+                           ('raw', lambda: schema.validate_data(raw, remainder))):
+        timings[name] = 1e9
+        for i in range(6):  # best of, first run warms up
+            t0 = time.perf_counter()
+            results[name] = validate()
+            timings[name] = min(timings[name], time.perf_counter() - t0)
+        print(f'{name:>5}: {1000*timings[name]:8.2f} ms for {len(purchases)} purchases')
+    assert results['raw'] == results['dict'] and len(results['raw'].purchases) == len(purchases)
+    return
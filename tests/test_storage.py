@@ -1,7 +1,9 @@
 """ Tests Storage over DApp  """
 import pytest
 from tests import service_fixtures
+from core import keys, data_nodes, transactions, users, storage_resource
 from frontend import user_auth, sessions
+from backend import storage
 
 
 @pytest.fixture(scope="session")
@@ -14,6 +16,43 @@ def storage_user1(httpx_processes):
     return
 
 
+def test_pack_blobs():
+    items = [('a', b'xxx'), ('b', None), ('ä', b''), ('c', bytes(range(256)))]
+    assert list(storage.unpack_blobs(storage.pack_blobs(items))) == items
+    assert list(storage.unpack_blobs(b'')) == []
+    return
+
+
+class RecordingDApp:
+    """ stands in for the DAppProxy of a storage DApp """
+
+    def __init__(self):
+        self.requests = []
+
+    async def send_url(self, urlpath, verb='get', **kw):
+        self.requests.append((verb, urlpath.partition('?')[0]))
+        if urlpath.startswith('/storage-batch/load'):
+            return storage.pack_blobs((key, None) for key in kw['json'])
+        return None
+
+
+@pytest.mark.asyncio
+async def test_buffered_writes():
+    trx = transactions.Transaction.create(users.User(id='1', name='martin', email='martin.gfeller@swisscom.com'))
+    dapp = RecordingDApp()
+    res = storage_resource.StorageResource.model_construct(dapp=dapp)
+    await res.store('a', b'xxx', trx)
+    await res.store('b', b'yyy', trx)
+    await res.delete('b', trx)
+    assert await res.load('a', trx) == b'xxx', 'buffered write is visible'
+    assert await res.load_many(['a', 'b', 'c'], trx) == [b'xxx', None, None]
+    assert dapp.requests == [('post', '/storage-batch/load')], 'only c is requested'
+    await res.prepare(trx)
+    assert dapp.requests[1:] == [('post', '/storage-batch/write'), ('post', f'transaction/{trx.trxid}/prepare')]
+    assert not res._pending
+    return
+
+
 @pytest.mark.asyncio
 async def test_store_load_commit_data(storage_user1, httpx_processes):
     storage_user1.delete(f'/storage?confirm=True').raise_for_status()
@@ -29,6 +68,11 @@ async def test_store_load_commit_data(storage_user1, httpx_processes):
     r.raise_for_status()
     r = storage_user1.get(f'/storage/aaa?trxid={trx.trxid}')
     r.raise_for_status()
+    assert r.content == b'xxx' and r.headers['content-type'] == 'application/octet-stream'
+
+    big = bytes(range(256)) * 12000  # > StreamChunkSize, streamed
+    r = storage_user1.put(f'/storage/big?trxid={trx.trxid}', content=big)
+    r.raise_for_status()
 
     r = storage_user1.post(f'/transaction/{trx.trxid}/commit')
     r.raise_for_status()
@@ -41,6 +85,9 @@ async def test_store_load_commit_data(storage_user1, httpx_processes):
 
     r = storage_user1.get(f'/storage/aaa?trxid={trx.trxid}')
     r.raise_for_status()
+    r = storage_user1.get('/storage/big')  # read-only, committed data
+    r.raise_for_status()
+    assert r.content == big
     return
 
 
@@ -106,3 +153,32 @@ async def test_store_delete_commit_data(storage_user1, httpx_processes):
     r = storage_user1.get(f'/storage/aaa?trxid={trx.trxid}')
     assert r.status_code == 404, 'was deleted and committed'
     return
+
+
+@pytest.mark.asyncio
+async def test_batch_store_load(storage_user1, httpx_processes):
+    storage_user1.delete(f'/storage?confirm=True').raise_for_status()
+
+    user = user_auth.UserInDB.load(storage_user1.headers['x-user'])
+    session = sessions.Session(token_str=storage_user1.headers['authorization'], user=user)
+    trx = await session.ensure_new_transaction()
+
+    r = storage_user1.post(f'/transaction/{trx.trxid}/begin')
+    r.raise_for_status()
+
+    body = storage.pack_blobs([('aaa', b'xxx'), ('bbb', b'yyy')])
+    r = storage_user1.post(f'/storage-batch/write?trxid={trx.trxid}', content=body)
+    r.raise_for_status()
+    r = storage_user1.post(f'/storage-batch/load?trxid={trx.trxid}', json=['aaa', 'bbb', 'ccc'])
+    r.raise_for_status()
+    assert dict(storage.unpack_blobs(r.content)) == {'aaa': b'xxx', 'bbb': b'yyy', 'ccc': None}
+
+    r = storage_user1.post(f'/storage-batch/write?trxid={trx.trxid}', content=storage.pack_blobs([('aaa', None)]))
+    r.raise_for_status()
+    r = storage_user1.post(f'/transaction/{trx.trxid}/commit')
+    r.raise_for_status()
+
+    r = storage_user1.post('/storage-batch/load', json=['aaa', 'bbb'])  # read-only, committed data
+    r.raise_for_status()
+    assert dict(storage.unpack_blobs(r.content)) == {'aaa': None, 'bbb': b'yyy'}, 'aaa was deleted'
+    return
@@ -0,0 +1,126 @@
+""" Tests for Transactions """
+import asyncio
+import datetime
+import pytest
+from core import keys, data_nodes, transactions, users
+from backend import persistable
+
+
+@pytest.fixture
+def user():
+    return users.User(id='1', name='martin', email='martin.gfeller@swisscom.com')
+
+
+@pytest.mark.asyncio
+async def test_reaper(user, monkeypatch):
+    reaper = transactions.Reaper
+    trxs = [transactions.Transaction.create(user) for i in range(3)]
+    trxs[0].trx_local['data'] = b'x'*1000
+    stats = reaper.stats()
+    assert stats['transactions'] >= 3 and stats['bytes'] >= 1000
+    assert reaper.task is not None, 'reaper runs in background'
+
+    expired = datetime.datetime.now() + transactions.Transaction.TTL + datetime.timedelta(seconds=1)
+    assert await reaper.reap(expired) >= 3
+    assert not any(trx.trxid in transactions.Transaction.Transactions for trx in trxs)
+
+    monkeypatch.setattr(transactions.TransactionReaper, 'MaxTransactions', len(transactions.Transaction.Transactions)+2)
+    trxs = [transactions.Transaction.create(user) for i in range(2)]
+    with pytest.raises(transactions.TrxLimitExceeded):
+        transactions.Transaction.create(user)
+    await asyncio.sleep(0.01)
+    assert all(trx.trxid in transactions.Transaction.Transactions for trx in trxs), 'running transactions are not evicted'
+    trxs[0].begin()  # begin again is not a new transaction
+    assert await reaper.reap(expired) >= 2
+    transactions.Transaction.create(user)
+    await reaper.stop()
+
+
+class DummyResource(transactions.Resource):
+    id: str
+    fail_in: str | None = None
+    delay: float = 0.0
+    calls: list[str] = []
+
+    async def _phase(self, phase):
+        await asyncio.sleep(self.delay)
+        if phase == self.fail_in:
+            raise ValueError(f'{self.id} fails in {phase}')
+        self.calls.append(phase)
+
+    async def prepare(self, transaction): await self._phase('prepare')
+    async def commit(self, transaction): await self._phase('commit')
+    async def rollback(self, transaction): await self._phase('rollback')
+
+
+class DummyAction(transactions.Action):
+    calls: list[str] = []
+
+    async def commit(self, transaction): self.calls.append('commit')
+    async def rollback(self, transaction): self.calls.append('rollback')
+
+
+@pytest.mark.asyncio
+async def test_two_phase_commit(user, monkeypatch):
+    trx = transactions.Transaction.create(user)
+    resources = [DummyResource(id=f'r{i}', delay=0.05) for i in range(3)]
+    for r in resources:
+        await trx.add_resource(r)
+    t0 = asyncio.get_running_loop().time()
+    await trx.commit()
+    assert asyncio.get_running_loop().time() - t0 < 0.25, 'participants run concurrently'
+    assert all(r.calls == ['prepare', 'commit'] for r in resources)
+
+    trx = transactions.Transaction.create(user)
+    resources = [DummyResource(id='ok'), DummyResource(id='veto', fail_in='prepare'), DummyResource(id='slow', delay=1)]
+    for r in resources:
+        await trx.add_resource(r)
+    monkeypatch.setattr(transactions.Transaction, 'PhaseTimeout', 0.2)
+    with pytest.raises(transactions.TrxCommitError, match='veto'):
+        await trx.commit()
+    assert resources[0].calls == ['prepare', 'rollback']
+    assert 'commit' not in resources[2].calls
+    await trx.abort()
+
+    trx = transactions.Transaction.create(user)
+    action = DummyAction()
+    trx.add(action)
+    await trx.add_resource(DummyResource(id='veto', fail_in='prepare'))
+    with pytest.raises(transactions.TrxCommitError, match='veto'):
+        await trx.commit()
+    assert action.calls == ['commit', 'rollback'], 'actions performed are rolled back when a resource vetoes'
+    await trx.abort()
+
+
+@pytest.mark.asyncio
+async def test_write_set_coalescing(user):
+    trx = transactions.Transaction.create(user)
+    node = data_nodes.DataNode(owner=user, key=keys.DDHkey('/mgf/p/test'))
+    other = data_nodes.DataNode(owner=user, key=keys.DDHkey('/mgf/p/other'))
+    trx.add(persistable.UserDataPersistAction(obj=node))
+    trx.add(persistable.UserDataPersistAction(obj=other))
+    trx.add(persistable.UserDataPersistAction(obj=node, add_to_dir=False))
+    assert trx.coalesced_writes == 1
+    assert [a.obj for a in trx.actions] == [node, other], 'written once, in original order'
+    assert trx.actions[0].add_to_dir, 'directory update is kept'
+    trx.actions.clear()
+    trx.write_set.clear()
+    await trx.abort()
+
+
+@pytest.mark.asyncio
+async def test_read_only(user):
+    trx = transactions.Transaction.create(user, read_only=True)
+    resource = DummyResource(id='storage')
+    await trx.add_resource(resource)
+    with pytest.raises(transactions.TrxAccessError):
+        trx.add(persistable.UserDataPersistAction(obj=data_nodes.DataNode(owner=user)))
+    trx.add(persistable.SystemDataPersistAction(obj=persistable.Persistable()))  # system data such as audit is ok
+    trx.actions.clear()
+    await trx.commit()
+    assert resource.calls == [], 'no begin, prepare or commit for read-only transactions'
+
+    trx.make_writable()
+    trx.add(persistable.UserDataPersistAction(obj=data_nodes.DataNode(owner=user)))
+    trx.actions.clear()
+    await trx.abort()
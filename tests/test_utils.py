@@ -0,0 +1,27 @@
+""" Tests for utils.utils """
+import asyncio
+import pytest
+from utils import utils
+
+
+@pytest.mark.asyncio
+async def test_gather_limited():
+    running = []
+    max_running = 0
+
+    async def load(i):
+        nonlocal max_running
+        running.append(i)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.001 * (10 - i))  # finish out of order
+        running.remove(i)
+        return i
+
+    assert await utils.gather_limited([load(i) for i in range(10)], 3) == list(range(10))
+    assert max_running == 3
+
+    async def fail():
+        raise KeyError('failed')
+
+    with pytest.raises(KeyError):
+        await utils.gather_limited([load(1), fail(), load(2)], 1)
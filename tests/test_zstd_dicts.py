@@ -0,0 +1,53 @@
+""" Tests for trained zstd dictionaries """
+import threading
+from core import keys, data_nodes, transactions, users
+from backend import persistable, storage, zstd_dicts
+
+
+class SmallRecord(persistable.Persistable):
+    subject: str
+    event: str
+    count: int
+
+
+def test_dictionary_compression(monkeypatch):
+    dicts = zstd_dicts.DictionariesClass(samples_needed=200, retrain_after=100)
+    monkeypatch.setattr(zstd_dicts, 'Dictionaries', dicts)
+    records = [SmallRecord(subject=f'user{i%17}', event=('read', 'write', 'consent')[i % 3], count=i) for i in range(600)]
+    plain = [r.to_compressed() for r in records[:199]]
+    assert not dicts.current and not dicts.training, 'still sampling'
+    plain.append(records[199].to_compressed())
+    dicts.wait()
+    first = dicts.current['SmallRecord']
+    compressed = [r.to_compressed() for r in records[200:]]
+    assert compressed[0][:1] == zstd_dicts.DictFormat
+    assert sum(map(len, compressed[:200])) < sum(map(len, plain)) * 0.7, 'dictionary pays off'
+    dicts.wait()
+    assert dicts.current['SmallRecord'] is not first, 'rotated after retrain_after'
+
+    dicts.by_id.clear()  # dictionaries are recovered from storage
+    assert [SmallRecord.from_compressed(c) for c in plain + compressed] == records
+    assert SmallRecord.from_compressed(records[0].to_compressed()) == records[0]
+    return
+
+
+def test_background_training(monkeypatch):
+    """ records are compressed with the current dictionary while the next one is trained """
+    dicts = zstd_dicts.DictionariesClass(samples_needed=200, retrain_after=100)
+    monkeypatch.setattr(zstd_dicts, 'Dictionaries', dicts)
+    records = [SmallRecord(subject=f'user{i%17}', event=('read', 'write', 'consent')[i % 3], count=i) for i in range(400)]
+    for r in records[:200]:
+        r.to_compressed()
+    dicts.wait()
+    first = dicts.current['SmallRecord']
+    release = threading.Event()
+    train_dict = zstd_dicts.zstd.train_dict
+    monkeypatch.setattr(zstd_dicts.zstd, 'train_dict', lambda *a: (release.wait(5), train_dict(*a))[1])
+    compressed = [r.to_compressed() for r in records[:400]]  # 100 with first, then 200 samples start training
+    assert 'SmallRecord' in dicts.training and dicts.current['SmallRecord'] is first
+    assert compressed[-1][:1] == zstd_dicts.DictFormat, 'still compressed with the current dictionary'
+    release.set()
+    dicts.wait()
+    assert dicts.current['SmallRecord'] is not first and not dicts.training
+    assert [SmallRecord.from_compressed(c) for c in compressed] == records
+    return
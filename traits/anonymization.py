@@ -133,6 +133,7 @@ class Pseudonymize(Anonymize):
 
 class PseudonymMap(persistable.Persistable):
     """ This is the saved map persisted by the tid key """
+    BinaryEnvelope: typing.ClassVar[bool] = True
     cache: dict
     inverted_cache: dict | None = None  # for writing
 
@@ -141,14 +142,14 @@ class PseudonymMap(persistable.Persistable):
         self.inverted_cache = {(path, field, anon): value for (path, field, value), anon in self.cache.items()}
         return
 
-    def to_json(self) -> str:
+    def to_json(self, exclude: typing.AbstractSet[str] | None = None) -> str:
         """ JSON export doesn't support dicts with tuple keyes. So convert them to str and convert back in .from_json() """
         if self.inverted_cache is None:
             self.invert()
         e = self.model_copy()
         e.cache.clear()  # original cache is not exported
         e.inverted_cache = {tuple_key_to_str(k): v for k, v in e.inverted_cache.items()}
-        return e.model_dump_json()
+        return e.model_dump_json(exclude=exclude)
 
     @classmethod
     def from_json(cls, j: str) -> typing.Self:
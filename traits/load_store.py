@@ -18,12 +18,12 @@ class AccessTransformer(trait.Transformer):
     only_modes: CV[frozenset[permissions.AccessMode]] = frozenset({permissions.AccessMode.write})  # no checks for read
     phase: CV[trait.Phase] = trait.Phase.validation
 
-    async def get_or_create_dnode(self, trstate: trait.TransformerState, create: bool = False, condition: typing.Callable | None = None) -> tuple[data_nodes.DataNode | None, int, keys.DDHkey]:
-        if create and condition:
-            raise ValueError('create and condition may not be set simultaneously')
+    async def get_or_create_dnode(self, trstate: trait.TransformerState, create: bool = False, with_consents: bool = False) -> tuple[data_nodes.DataNode | None, int, keys.DDHkey]:
+        if create and with_consents:
+            raise ValueError('create and with_consents may not be set simultaneously')
         try:
             data_node, d_key_split = await keydirectory.NodeRegistry.get_node_async(
-                trstate.access.ddhkey, nodes.NodeSupports.data, trstate.transaction, condition=condition)
+                trstate.access.ddhkey, nodes.NodeSupports.data, trstate.transaction, with_consents=with_consents)
         except errors.AccessError as e:
             raise errors.AccessError(
                 f'User {trstate.access.principal.id} not authorized to read {trstate.access.ddhkey}')
@@ -74,7 +74,7 @@ class LoadFromStorage(AccessTransformer):
                 data = await data_node.execute(nodes.Ops.get, trstate.access, trstate.transaction, d_key_split, None, trstate.query_params)
             trstate.data_node = data_node
         else:  # we have no data_node, but need a consent node to check whether we can read here:
-            data_node, d_key_split, remainder = await self.get_or_create_dnode(trstate, condition=nodes.Node.has_consents)
+            data_node, d_key_split, remainder = await self.get_or_create_dnode(trstate, with_consents=True)
             *d, consentees, msg = trstate.access.raise_if_not_permitted(data_node)
 
             data = None  # we'll check this later in VerifyLoaded
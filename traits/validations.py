@@ -89,6 +89,9 @@ class ParseData(DataValidation):
     phase: CV[trait.Phase] = trait.Phase.parse
 
     async def apply(self,  traits: trait.Traits, trstate: trait.TransformerState, **kw):
+        if (trstate.nschema.validates_raw and isinstance(trstate.orig_data, (bytes, str))
+                and MustValidate in traits and not trstate.query_params.includes_owner):
+            return  # MustValidate validates the raw data directly
         try:
             trstate.parsed_data = trstate.nschema.parse(trstate.orig_data)
         except Exception as e:
@@ -103,8 +106,10 @@ class MustValidate(DataValidation):
         owners = trstate.access.original_ddhkey.owners  # original, in case of Pseudonymized
         if len(owners) != 1:
             raise errors.NotSelectable(f"Cannot have multiple owners in key: {','.join(owners)}")
-        assert isinstance(trstate.parsed_data, dict)
-        if trstate.query_params.includes_owner:
+        if trstate.parsed_data is None:  # not parsed by ParseData, schema validates raw data
+            data = trstate.orig_data
+        elif trstate.query_params.includes_owner:
+            assert isinstance(trstate.parsed_data, dict)
             if len(trstate.parsed_data) > 1:
                 raise errors.NotSelectable('Cannot have multiple owners in data')
             else:
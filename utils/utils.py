@@ -1,5 +1,6 @@
 """ Utilities """
 import sys, threading, traceback, collections, inspect, typing, itertools
+import asyncio
 from time import time as _time, sleep as _sleep
 import heapq
 import logging
@@ -77,6 +78,29 @@ def batched(iterable, n):
         yield batch
 
 
+async def gather_limited(aws: typing.Iterable[typing.Awaitable[T]], limit: int) -> list[T]:
+    """ await all aws with at most limit of them running concurrently, return results in order of aws.
+        If one fails, the others are cancelled and the exception is raised.
+    """
+    semaphore = asyncio.Semaphore(max(limit, 1))
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    aws = list(aws)
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        for aw in aws:  # avoid warnings for coroutines that never started
+            if inspect.iscoroutine(aw) and inspect.getcoroutinestate(aw) == inspect.CORO_CREATED:
+                aw.close()
+        raise
+
+
 def allin(a, b):
     """ return True if all items of sequence a are in sequence b """
     return not False in [x in b for x in a]
@@ -223,6 +247,56 @@ class Invalidatable:
         return
 
 
+class LRUCache(typing.Generic[T]):
+    """ dict-like cache holding at most max_entries, evicting the least recently used entry.
+        Counts hits and misses of .get(). on_evict(key, value) is called for entries evicted to make room.
+    """
+
+    def __init__(self, max_entries: int, on_evict: typing.Callable[[typing.Hashable, T], None] | None = None):
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.entries: collections.OrderedDict[typing.Hashable, T] = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key: typing.Hashable, default=None) -> T | None:
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key: typing.Hashable, default=None) -> T | None:
+        """ get without counting and without making key the most recently used """
+        return self.entries.get(key, default)
+
+    def put(self, key: typing.Hashable, value: T):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted = self.entries.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(*evicted)
+        return
+
+    def pop(self, key: typing.Hashable, default=None) -> T | None:
+        return self.entries.pop(key, default)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self):
+        """ remove all entries, counters remain """
+        self.entries.clear()
+        return
+
+    def stats(self) -> dict[str, int]:
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
 class _DummyContext(object):
     """ A context that does nothing on entry and exit and also offers dummy lock methods """
 